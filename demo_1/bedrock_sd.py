@@ -2,7 +2,9 @@ import base64
 import io
 import json
 import boto3
+import threading
 from PIL import Image
+from botocore.config import Config
 from langchain_core.pydantic_v1 import BaseModel, Field
 from botocore.exceptions import ClientError
 from enum import Enum
@@ -26,6 +28,24 @@ class ImageError(Exception):
         self.message = message
 
 
+_client_lock = threading.Lock()
+_bedrock_client = None
+
+def get_bedrock_client():
+    """
+        create the bedrock-runtime client once per process and reuse its connection pool
+    """
+    global _bedrock_client
+    if _bedrock_client is None:
+        with _client_lock:
+            if _bedrock_client is None:
+                config = Config(max_pool_connections=50,
+                                retries={'max_attempts': 5, 'mode': 'adaptive'},
+                                tcp_keepalive=True)
+                _bedrock_client = boto3.client(service_name='bedrock-runtime', config=config)
+    return _bedrock_client
+
+
 class ImageGenerator(BaseModel):
     model_id: str = Field(default="stability.stable-diffusion-xl-v1")
     cfg_scale: int = Field( default=7)
@@ -44,7 +64,7 @@ class ImageGenerator(BaseModel):
 
         # logger.info("Generating image with SDXL model %s", model_id)
 
-        bedrock = boto3.client(service_name='bedrock-runtime')
+        bedrock = get_bedrock_client()
     
         accept = "application/json"
         content_type = "application/json"
@@ -0,0 +1,1254 @@
+"""
+    micro benchmarks for story_agents, run from demo_2 with:
+    python -m bench.benchmarks [name ...]
+"""
+import os
+import sys
+import json
+import time
+
+
+def _set_dummy_aws_env():
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+
+def bench_client_pool(calls:int = 50):
+    """
+        per-call overhead of a fresh boto3 Session + client per image (old behaviour) vs the pooled client
+    """
+    import boto3
+    from bench.fakes import StubBedrockServer
+    from story_agents.client_pool import get_bedrock_runtime_client, clear_client_pool
+    _set_dummy_aws_env()
+    body = json.dumps({"taskType": "TEXT_IMAGE", "textToImageParams": {"text": "bench"}})
+    model_id = "amazon.titan-image-generator-v2:0"
+
+    with StubBedrockServer() as server:
+        start = time.perf_counter()
+        for _ in range(calls):
+            bedrock = boto3.Session().client(service_name='bedrock-runtime', endpoint_url=server.endpoint_url)
+            bedrock.invoke_model(body=body, modelId=model_id, accept="application/json", contentType="application/json")["body"].read()
+        fresh = (time.perf_counter() - start) / calls
+
+        clear_client_pool()
+        start = time.perf_counter()
+        for _ in range(calls):
+            bedrock = get_bedrock_runtime_client(endpoint_url=server.endpoint_url)
+            bedrock.invoke_model(body=body, modelId=model_id, accept="application/json", contentType="application/json")["body"].read()
+        pooled = (time.perf_counter() - start) / calls
+
+    return {"calls": calls,
+            "fresh_session_ms_per_call": round(fresh * 1000, 2),
+            "pooled_client_ms_per_call": round(pooled * 1000, 2),
+            "speedup": round(fresh / pooled, 1)}
+
+
+def bench_image_batch(images:int = 20, latency:float = 0.2, max_concurrency:int = 10):
+    """
+        wall time of rendering a book's worth of images one by one vs generate_images_batch / agenerate_images_batch
+    """
+    import asyncio
+    from bench.fakes import StubBedrockServer
+    from story_agents.image_utils import ImageGenerator
+    _set_dummy_aws_env()
+    prompts = [f"portrait {i}" for i in range(images)]
+
+    with StubBedrockServer(latency=latency) as server:
+        generator = ImageGenerator(endpoint_url=server.endpoint_url)
+        start = time.perf_counter()
+        serial = [generator.generate_image(p) for p in prompts]
+        serial_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        batch = generator.generate_images_batch(prompts, max_concurrency=max_concurrency)
+        batch_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        abatch = asyncio.run(generator.agenerate_images_batch(prompts, max_concurrency=max_concurrency))
+        abatch_s = time.perf_counter() - start
+
+    return {"images": images,
+            "latency_s": latency,
+            "max_concurrency": max_concurrency,
+            "serial_s": round(serial_s, 3),
+            "batch_s": round(batch_s, 3),
+            "async_batch_s": round(abatch_s, 3),
+            "all_ok": all(img is not None for img in serial + batch + abatch)}
+
+
+def bench_image_cache(images:int = 10, latency:float = 0.2):
+    """
+        rerun of the same portraits with a cold vs warm ImageCache
+    """
+    import tempfile
+    from bench.fakes import StubBedrockServer
+    from story_agents.image_cache import ImageCache
+    from story_agents.image_utils import ImageGenerator
+    _set_dummy_aws_env()
+    prompts = [f"portrait {i}" for i in range(images)]
+
+    with tempfile.TemporaryDirectory() as cache_dir, StubBedrockServer(latency=latency) as server:
+        cache = ImageCache(cache_dir=cache_dir)
+        generator = ImageGenerator(endpoint_url=server.endpoint_url, cache=cache)
+        start = time.perf_counter()
+        for p in prompts:
+            generator.generate_image(p)
+        cold = (time.perf_counter() - start) / images
+
+        start = time.perf_counter()
+        for p in prompts:
+            generator.generate_image(p)
+        warm = (time.perf_counter() - start) / images
+
+    return {"images": images,
+            "cold_ms_per_image": round(cold * 1000, 2),
+            "warm_ms_per_image": round(warm * 1000, 2),
+            **cache.stats()}
+
+
+def bench_storyd_waiter(latency:float = 1.3, fixed_delay:float = 10.0, chapters:int = 5):
+    """
+        result latency of StoryDiffusion calls against a fake async endpoint and in-memory S3:
+        fixed-delay polling (old WaiterConfig) vs backoff polling vs SQS notification, then
+        chapters in flight at once through agenerate_images
+    """
+    import asyncio
+    from bench.fakes import FakeS3Client, FakeSqsClient, FakeAsyncEndpoint
+    from story_agents.async_waiter import BackoffWaiter, SqsCompletionListener
+    from story_agents.image_utils import StoryDiffusionGenerator
+
+    def make_generator(waiter_kwargs, with_sqs=False):
+        s3 = FakeS3Client()
+        sqs = FakeSqsClient() if with_sqs else None
+        endpoint = FakeAsyncEndpoint(s3, latency=latency, sqs_client=sqs)
+        listener = SqsCompletionListener(sqs, endpoint.queue_url, wait_time_seconds=1) if with_sqs else None
+        waiter = BackoffWaiter(s3, listener=listener, **waiter_kwargs)
+        return StoryDiffusionGenerator("fake-endpoint", waiter=waiter, predictor_async=endpoint, s3_client=s3), listener
+
+    def timed(generator):
+        start = time.perf_counter()
+        generator.generate_images(general_prompt="[Liam] a boy", prompt_array="[Liam] reads a book")
+        return round(time.perf_counter() - start, 3)
+
+    results = {"endpoint_latency_s": latency}
+    fixed, _ = make_generator({"initial_delay": fixed_delay, "factor": 1.0, "max_delay": fixed_delay})
+    results["fixed_poll_s"] = timed(fixed)
+    backoff, _ = make_generator({})
+    results["backoff_poll_s"] = timed(backoff)
+    notified, listener = make_generator({"initial_delay": 5.0}, with_sqs=True)
+    results["sqs_notification_s"] = timed(notified)
+    listener.stop()
+
+    async def run_chapters(generator):
+        return await asyncio.gather(*[generator.agenerate_images(general_prompt="[Liam] a boy",
+                                                                 prompt_array=f"[Liam] chapter {i}")
+                                      for i in range(chapters)])
+    start = time.perf_counter()
+    asyncio.run(run_chapters(backoff))
+    results[f"async_{chapters}_chapters_s"] = round(time.perf_counter() - start, 3)
+    return results
+
+
+def bench_storyd_pipeline(chapters:int = 10, latency:float = 1.0, max_in_flight:int = 5):
+    """
+        panel rendering wall time for a book, chapter by chapter vs pipelined through agenerate_chapter_images
+    """
+    import asyncio
+    import tempfile
+    from bench.fakes import FakeS3Client, FakeAsyncEndpoint
+    from story_agents.async_waiter import BackoffWaiter
+    from story_agents.image_utils import StoryDiffusionGenerator
+    from story_agents.storyd_pipeline import agenerate_all_chapter_images
+
+    s3 = FakeS3Client()
+    endpoint = FakeAsyncEndpoint(s3, latency=latency)
+    generator = StoryDiffusionGenerator("fake-endpoint", waiter=BackoffWaiter(s3, initial_delay=0.05, max_delay=0.5),
+                                        predictor_async=endpoint, s3_client=s3)
+    prompts = [{'prompt_array': [f"[Liam] chapter {i}"], 'id_length': 1, 'ref_imgs': [], 'general_prompt': "[Liam] a boy img"}
+               for i in range(chapters)]
+
+    start = time.perf_counter()
+    for p in prompts:
+        generator.generate_images(general_prompt=p['general_prompt'], prompt_array='\n'.join(p['prompt_array']),
+                                  id_length=p['id_length'], ref_imgs=p['ref_imgs'])
+    serial_s = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        start = time.perf_counter()
+        asyncio.run(agenerate_all_chapter_images(generator, iter(prompts), max_in_flight=max_in_flight, output_dir=output_dir))
+        pipelined_s = time.perf_counter() - start
+        start = time.perf_counter()
+        asyncio.run(agenerate_all_chapter_images(generator, iter(prompts), max_in_flight=max_in_flight, output_dir=output_dir))
+        resumed_s = time.perf_counter() - start
+
+    return {"chapters": chapters,
+            "endpoint_latency_s": latency,
+            "max_in_flight": max_in_flight,
+            "serial_s": round(serial_s, 3),
+            "pipelined_s": round(pipelined_s, 3),
+            "resume_from_disk_s": round(resumed_s, 3)}
+
+
+def bench_reference_images(characters:int = 4, chapters:int = 10, size:int = 768):
+    """
+        cost of building the reference images for every chapter payload:
+        Image2base64 (PIL decode + re-encode) vs ReferenceImageStore, and inline base64 vs s3 references
+    """
+    import tempfile
+    from PIL import Image
+    from bench.fakes import FakeS3Client
+    from story_agents.image_utils import Image2base64
+    from story_agents.reference_images import ReferenceImageStore
+
+    with tempfile.TemporaryDirectory() as folder:
+        paths = []
+        for i in range(characters):
+            path = os.path.join(folder, f"character{i}.png")
+            Image.frombytes('RGB', (size, size), os.urandom(size*size*3)).save(path)
+            paths.append(path)
+
+        start = time.perf_counter()
+        for _ in range(chapters):
+            inline = [Image2base64(p) for p in paths]
+        pil_s = time.perf_counter() - start
+
+        store = ReferenceImageStore()
+        start = time.perf_counter()
+        for _ in range(chapters):
+            stored = [store.get_base64(p) for p in paths]
+        store_s = time.perf_counter() - start
+
+        s3 = FakeS3Client()
+        s3_store = ReferenceImageStore(s3_prefix="s3://fake-bucket/story-diffusion/refs", s3_client=s3)
+        refs = [s3_store.get_reference(p) for p in paths]
+
+    return {"characters": characters,
+            "chapters": chapters,
+            "image2base64_s": round(pil_s, 3),
+            "reference_store_s": round(store_s, 3),
+            "inline_payload_bytes": sum(len(x) for x in stored),
+            "s3_reference_payload_bytes": sum(len(x) for x in refs),
+            "s3_uploads": s3.calls['put_object']}
+
+
+def _result_reader_worker(mode:str, path:str, output_dir:str):
+    # runs in a fresh interpreter so ru_maxrss only reflects this reader
+    import resource
+    import base64
+    from io import BytesIO
+    from PIL import Image
+    from story_agents.result_stream import iter_base64_images, write_base64_images
+    with open(path, 'rb') as stream:
+        if mode == 'json_loads':
+            respobj = json.loads(stream.read().decode("utf-8"))
+            images = [Image.open(BytesIO(base64.b64decode(img))) for img in respobj['images_base64']]
+        elif mode == 'stream':
+            images = [Image.open(BytesIO(img)) for img in iter_base64_images(stream)]
+        elif mode == 'stream_to_disk':
+            images = [Image.open(fname) for fname in write_base64_images(stream, output_dir)]
+        else:
+            images = []
+    print(json.dumps({"images": len(images), "maxrss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+
+
+def bench_result_reader(images:int = 20, size:int = 1024):
+    """
+        peak RSS of reading a synthetic StoryDiffusion response with images of size x size:
+        read + json.loads + b64decode (old) vs the streaming reader, in memory and straight to disk
+    """
+    import base64
+    import tempfile
+    import subprocess
+    from io import BytesIO
+    from PIL import Image
+
+    with tempfile.TemporaryDirectory() as folder:
+        buffer = BytesIO()
+        Image.frombytes('RGB', (size, size), os.urandom(size*size*3)).save(buffer, format="PNG")
+        image_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
+        path = os.path.join(folder, "response.json")
+        with open(path, 'w') as f:
+            json.dump({"images_base64": [image_base64]*images}, f)
+
+        results = {"images": images, "response_mb": round(os.path.getsize(path) / 1024**2, 1)}
+        for mode in ("baseline", "json_loads", "stream", "stream_to_disk"):
+            code = ("from bench.benchmarks import _result_reader_worker; "
+                    f"_result_reader_worker({mode!r}, {path!r}, {os.path.join(folder, mode)!r})")
+            out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                                 cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            results[f"{mode}_peak_rss_mb"] = round(json.loads(out.stdout.strip().splitlines()[-1])["maxrss_kb"] / 1024, 1)
+    return results
+
+
+def _synthetic_book(chapters:int, characters:int, lines:int = 5, seed:int = 0):
+    import random
+    from types import SimpleNamespace
+    rand = random.Random(seed)
+    names = [f"Name{i}" for i in range(characters)]
+    persona = lambda name: SimpleNamespace(name=name, figure=f"a person called {name}")
+    cast = SimpleNamespace(main_character=persona(names[0]), supporting_character=[persona(n) for n in names[1:]])
+    story_lines = []
+    for _ in range(chapters):
+        chapter = []
+        for _ in range(lines):
+            who = rand.sample(names, rand.randint(0, 3))
+            chapter.append(' '.join([f"[{n}] meets" for n in who] + ["someone in the forest"]) if who else "[NC] leaves are falling")
+        story_lines.append('\n'.join(chapter))
+    return story_lines, cast, {n: f"ref-{n}" for n in names}
+
+
+def bench_storyd_prompts(chapters:int = 300, characters:int = 30):
+    """
+        prepare_storyd_prompts over a long synthetic book, time per chapter should stay flat as the book grows
+    """
+    from story_agents.image_utils import prepare_storyd_prompts
+    results = {"characters": characters}
+    for n in (chapters // 3, chapters):
+        story_lines, cast, img_dicts = _synthetic_book(n, characters)
+        start = time.perf_counter()
+        list(prepare_storyd_prompts(story_lines, cast, img_dicts))
+        elapsed = time.perf_counter() - start
+        results[f"{n}_chapters_ms"] = round(elapsed * 1000, 2)
+        results[f"{n}_chapters_us_per_chapter"] = round(elapsed / n * 1e6, 1)
+    return results
+
+
+def _write_refine_workflow(llm, max_turns:int = 2):
+    # the book_writing_02 write/refine loop, reduced to plain text chains
+    from langgraph.graph import StateGraph, END
+    from langchain_core.messages import AIMessage
+    from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+    from langchain_core.output_parsers import StrOutputParser
+    from story_agents.graph_utils import AgentState
+
+    def node(name):
+        prompt = ChatPromptTemplate.from_messages([("system", f"You are the {name}."), MessagesPlaceholder(variable_name="messages")])
+        chain = prompt | llm | StrOutputParser()
+
+        async def _node(state):
+            content = await chain.ainvoke({"messages": state["messages"]})
+            env_var = {**state["env_var"], name: content}
+            return {"messages": [AIMessage(content=content, name=name)], "env_var": env_var}
+        return _node
+
+    def should_repeat(state):
+        return 'end' if len([m for m in state['messages'] if isinstance(m, AIMessage)]) > max_turns else 'refine_chapter'
+
+    graph = StateGraph(AgentState)
+    graph.add_node("write_chapter", node("cartoonist"))
+    graph.add_node("refine_chapter", node("editor"))
+    graph.set_entry_point("write_chapter")
+    graph.add_edge("refine_chapter", "write_chapter")
+    graph.add_conditional_edges("write_chapter", should_repeat, {"end": END, "refine_chapter": "refine_chapter"})
+    return graph.compile()
+
+
+def bench_graph_runner(chapters:int = 20, requests_per_second:int = 10, latency:float = 0.05):
+    """
+        20 write/refine chapter workflows in parallel against a fake model that throttles above
+        requests_per_second: unlimited fan-out vs rate_limited llm sharing one token bucket
+    """
+    import asyncio
+    from langchain_core.messages import HumanMessage
+    from bench.fakes import FakeChatModel
+    from story_agents.graph_runner import run_graphs, rate_limited, ModelRateLimiter
+
+    init_states = [{"env_var": {"chapter": i}, "messages": [HumanMessage(content=f"Here is the origin content: chapter {i}")]}
+                   for i in range(chapters)]
+    results = {"chapters": chapters, "quota_requests_per_second": requests_per_second}
+
+    fake = FakeChatModel(latency=latency, requests_per_window=requests_per_second, window=1.0)
+    start = time.perf_counter()
+    finals = asyncio.run(run_graphs(_write_refine_workflow(fake), init_states, "write_chapter", max_concurrency=chapters))
+    results["unlimited_s"] = round(time.perf_counter() - start, 3)
+    results["unlimited_failed_chapters"] = sum(f is None for f in finals)
+    results["unlimited_throttled_calls"] = fake.calls['throttled']
+
+    fake = FakeChatModel(latency=latency, requests_per_window=requests_per_second, window=1.0)
+    limiter = ModelRateLimiter(fake.model_id, requests_per_minute=requests_per_second * 60,
+                               tokens_per_minute=10**7, burst_seconds=0.5)
+    llm = rate_limited(fake, limiter=limiter, base_delay=0.2)
+    start = time.perf_counter()
+    finals = asyncio.run(run_graphs(_write_refine_workflow(llm), init_states, "write_chapter", max_concurrency=chapters))
+    elapsed = time.perf_counter() - start
+    results["rate_limited_s"] = round(elapsed, 3)
+    results["rate_limited_failed_chapters"] = sum(f is None for f in finals)
+    results["rate_limited_throttled_calls"] = fake.calls['throttled']
+    results["rate_limited_requests_per_second"] = round(fake.calls['requests'] / elapsed, 2)
+    return results
+
+
+def bench_retry_repair(calls:int = 40, latency:float = 0.5, malformed_rate:float = 0.5, seed:int = 0):
+    """
+        chapter chains against a fake model whose answers are malformed malformed_rate of the time
+        (raw newlines, trailing commas, truncated tail). old recursive retry_call regenerates every
+        failure, aretry_invoke repairs locally first
+    """
+    import random
+    import asyncio
+    from json import JSONDecodeError
+    from langchain_core.messages import HumanMessage
+    from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+    from langchain_core.pydantic_v1 import ValidationError
+    from langchain_core.runnables import RunnableLambda
+    from bench.fakes import FakeChatModel
+    from story_agents.llm_utils import CustJsonOuputParser, dict_to_obj
+    from story_agents.retry import aretry_invoke, retry_stats, reset_retry_stats
+    from story_agents.structure_objects import Title
+
+    def respond_factory():
+        rng = random.Random(seed)
+        answers = ['```json\n{"title": "The Lighthouse"}\n```',
+                   '```json\n{"title": "The\nLighthouse",}\n```',
+                   'Here you go:\n```json\n{"title": "The "Lighthouse" Keeper"}\n```',
+                   '```json\n{"title": "The Lighthouse']
+        return lambda text: answers[0] if rng.random() >= malformed_rate else rng.choice(answers[1:])
+
+    prompt = ChatPromptTemplate.from_messages([("system", "Give the chapter a title."), MessagesPlaceholder(variable_name="messages")])
+    args = {"messages": [HumanMessage(content="chapter text")]}
+
+    async def legacy_retry_call(chain, args, times=5):
+        try:
+            return await chain.ainvoke(args)
+        except (JSONDecodeError, ValidationError):
+            if times:
+                return await legacy_retry_call(chain, args, times=times-1)
+            raise
+
+    results = {"calls": calls, "malformed_rate": malformed_rate}
+    for name, call in (("legacy", legacy_retry_call), ("repair", aretry_invoke)):
+        fake = FakeChatModel(latency=latency, respond=respond_factory())
+        chain = prompt | fake | CustJsonOuputParser(verbose=False) | RunnableLambda(dict_to_obj).bind(target=Title)
+        reset_retry_stats()
+
+        async def run():
+            return await asyncio.gather(*[call(chain, args) for _ in range(calls)], return_exceptions=True)
+
+        start = time.perf_counter()
+        outs = asyncio.run(run())
+        results[f"{name}_s"] = round(time.perf_counter() - start, 3)
+        results[f"{name}_model_calls"] = fake.calls['requests']
+        results[f"{name}_failed"] = sum(isinstance(o, Exception) for o in outs)
+    results["repair_stats"] = retry_stats()
+    return results
+
+
+# (model answer json, expected value) pairs the sanitizer has to get right
+SANITIZER_CASES = [
+    ('{"a": "line1\nline2"}', {"a": "line1\nline2"}),
+    ('{"a": "tab\there"}', {"a": "tab\there"}),
+    ('{"a": "He said "hello", and left"}', {"a": 'He said "hello", and left'}),
+    ('{"a": "He said \\"hi\\""}', {"a": 'He said "hi"'}),
+    ('{"a": "path C:\\\\dir"}', {"a": 'path C:\\dir'}),
+    ('{"a": "over\\\\nescaped"}', {"a": "over\nescaped"}),
+    ('{"a": "it\\\'s"}', {"a": "it's"}),
+    ('{"a": "bad \\x escape"}', {"a": "bad \\x escape"}),
+    ('{"a": "crlf\r\nend"}', {"a": "crlf\nend"}),
+    ('{\n  "a": ["x", "y"],\n  "b": 1\n}', {"a": ["x", "y"], "b": 1}),
+    ('{"a": "unicode \\u00e9"}', {"a": "unicode \u00e9"}),
+    ('{"a": "quote at end ""}', {"a": 'quote at end "'}),
+]
+
+
+def _legacy_preprocess_answer_json(raw_text):
+    # CustJsonOuputParser's cleanup before the single-pass sanitizer, kept for comparison
+    import re
+    content = re.sub(r'(?:\\+)n', '\n', raw_text)
+    content = content.replace('\n', ' ').replace('\r', '').replace('\t', ' ')
+    content = content.replace('\\"', '"').replace('\\', '\\\\')
+    content = re.sub(r'(?<!\\)"', '\\"', content)
+    return content.replace('\\"', '"')
+
+
+def _sloppy_answer(obj) -> str:
+    # how models tend to break json: raw newlines instead of \n and unescaped quotes inside strings
+    text = json.dumps(obj, indent=2, ensure_ascii=False)
+    return text.replace('\\n', '\n').replace('\\"', '"')
+
+
+def bench_json_sanitizer(repeat:int = 200, synthetic_bytes:int = 100*1024):
+    """
+        parse success and cpu per parse of the legacy cleanup vs load_answer_json (single-pass sanitizer)
+        over the correctness corpus, the json files in demo_2 (clean and sloppy) and a ~100 KB answer
+    """
+    import glob
+    from story_agents.llm_utils import load_answer_json
+
+    here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    docs = []
+    for path in sorted(glob.glob(os.path.join(here, '*.json'))):
+        with open(path) as f:
+            obj = json.load(f)
+        docs.append((json.dumps(obj, indent=2, ensure_ascii=False), obj))
+        docs.append((_sloppy_answer(obj), obj))
+    paragraph = 'She whispered "wait", then ran.\nThe door\tcreaked. '
+    synthetic = {"chapters": [{"chapter_title": f"Chapter {i}", "content": paragraph * 40} for i in range(synthetic_bytes // (len(paragraph) * 40) + 1)]}
+    bigs = {"synthetic_clean": json.dumps(synthetic, indent=2, ensure_ascii=False), "synthetic_sloppy": _sloppy_answer(synthetic)}
+
+    results = {"corpus_cases": len(SANITIZER_CASES), "documents": len(docs), "synthetic_chars": len(bigs["synthetic_sloppy"])}
+    def legacy_load(text):
+        return json.loads(_legacy_preprocess_answer_json(text))
+
+    for name, load in (("legacy", legacy_load), ("single_pass", load_answer_json)):
+        def ok(text, expected):
+            try:
+                return load(text) == expected
+            except ValueError:
+                return False
+        results[f"{name}_corpus_correct"] = sum(ok(t, e) for t, e in SANITIZER_CASES)
+        results[f"{name}_documents_correct"] = sum(ok(t, e) for t, e in docs)
+        for kind, big in bigs.items():
+            results[f"{name}_{kind}_correct"] = ok(big, synthetic)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for text, _ in docs:
+                try:
+                    load(text)
+                except ValueError:
+                    pass
+        results[f"{name}_documents_us_per_parse"] = round((time.perf_counter() - start) / (repeat * len(docs)) * 1e6, 1)
+        for kind, big in bigs.items():
+            start = time.perf_counter()
+            for _ in range(repeat // 10):
+                try:
+                    load(big)
+                except ValueError:
+                    pass
+            results[f"{name}_{kind}_ms_per_parse"] = round((time.perf_counter() - start) / (repeat // 10) * 1e3, 3)
+    return results
+
+
+def bench_prompt_cache(chapters:int = 10, latency:float = 0.0, repeat:int = 200):
+    """
+        book_writing_02 chapter calls: ChatPromptTemplate re-rendering the whole system prompt (outline,
+        characters, fc_desc with the schema twice) per call vs cached_prefix_prompt with a cachePoint,
+        input tokens per chapter against a fake model that reports Bedrock style cache usage
+    """
+    import asyncio
+    from langchain_core.messages import HumanMessage
+    from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+    from bench.fakes import FakeChatModel
+    from story_agents.prompts import fc_desc
+    from story_agents.prompt_cache import (cached_prefix_prompt, render_prefix, schema_json, track_cache_usage,
+                                           prompt_cache_stats, reset_prompt_cache_stats)
+    from story_agents.structure_objects import Outline, Character, DetailChapter
+
+    here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with open(os.path.join(here, 'outline.json')) as f:
+        outline = Outline.parse_obj(json.load(f))
+    with open(os.path.join(here, 'characters.json')) as f:
+        characters = Character.parse_obj(json.load(f))
+    system = ("You are woking in a cartoon studio, the best and creative cartoon studio in the world.\nYou are a cartoonist.\n"
+              "Here is the outline of the story:\n<outline>\n{outline}\n</outline>\n"
+              "Here is the characters of the story:\n<characters>\n{characters}\n</characters>\n"
+              "You are now required to write stories for specific chapter based on the outline and characters." + fc_desc)
+    model_id = "us.anthropic.claude-3-7-sonnet-20250219-v1:0"
+    answer = '```json\n{"chapter_title": "t", "content": "c"}\n```'
+    results = {"chapters": chapters}
+
+    baseline = ChatPromptTemplate.from_messages([("system", system), MessagesPlaceholder(variable_name="messages")])
+    cached = cached_prefix_prompt(system, model_id=model_id)
+
+    def args(i, schema):
+        return {"outline": outline.json(), "characters": characters.as_str, "schema": schema,
+                "messages": [HumanMessage(content=f"Here is the origin content: chapter {i}")]}
+
+    outline_json, characters_str = outline.json(), characters.as_str
+    messages = [HumanMessage(content="Here is the origin content: chapter 1")]
+    # rendering only, the runnable/callback overhead around it is the same for both
+    start = time.perf_counter()
+    for _ in range(repeat):
+        baseline.format_prompt(outline=outline_json, characters=characters_str,
+                               schema=DetailChapter.schema_json(), messages=messages)
+    results["template_render_us"] = round((time.perf_counter() - start) / repeat * 1e6, 1)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        render_prefix(system, outline=outline_json, characters=characters_str, schema=schema_json(DetailChapter))
+    results["cached_prefix_render_us"] = round((time.perf_counter() - start) / repeat * 1e6, 1)
+
+    for name, prompt in (("template", baseline), ("cached_prefix", cached)):
+        fake = FakeChatModel(latency=latency, respond=lambda text: answer, model_id=model_id, prompt_cache=True)
+        chain = prompt | fake | track_cache_usage()
+        reset_prompt_cache_stats()
+
+        async def run():
+            # the first chapter writes the cache, the rest run concurrently behind it
+            await chain.ainvoke(args(0, schema_json(DetailChapter)))
+            await asyncio.gather(*[chain.ainvoke(args(i, schema_json(DetailChapter))) for i in range(1, chapters)])
+
+        asyncio.run(run())
+        stats = prompt_cache_stats()
+        results[f"{name}_uncached_input_tokens_per_chapter"] = round(stats.get("uncached", 0) / chapters, 1)
+        results[f"{name}_cache_read_tokens"] = stats.get("cache_read", 0)
+        results[f"{name}_cache_write_tokens"] = stats.get("cache_write", 0)
+        results[f"{name}_cached_ratio"] = round(stats["cached_ratio"], 3)
+    return results
+
+
+# fc_desc before it embedded the schema only once
+_LEGACY_FC_DESC = """
+You will ALWAYS follow the below guidelines when you are answering a question:
+<guidelines>
+- Think through the user's question, extract all data from the question and the previous conversations before creating a plan.
+- Your response must be follow the pydantic schema as:
+<schema>
+{schema}
+</shema>
+- output your answer in json markdown format, so that the user can use pydantic basemodel.parse_obj() to parse the json string into an object which defined as:
+ <schema>
+ {schema}
+ </shema>
+- Avoid quotation mark within a quotation mark, if encountering a quotation mark within a quotation mark, it needs to be single quotation mark instead
+- if the content has quotation mark, please change to single quotation mark instead
+</guidelines>
+"""
+
+
+def bench_schema_tokens(repeat:int = 200):
+    """
+        estimated input tokens of the fc_desc block per output model: legacy (schema_json twice) vs
+        the schema once as json, minified and typescript, and the cost of building the schema per call
+    """
+    from story_agents.graph_runner import estimate_tokens
+    from story_agents.prompts import fc_desc
+    from story_agents.schema_registry import get_schema, registered_models
+
+    results = {}
+    for name in ('Title', 'Outline', 'Character', 'DetailChapter', 'EditorSuggestion', 'Story'):
+        model = registered_models()[name]
+        row = {"legacy": estimate_tokens(_LEGACY_FC_DESC.format(schema=model.schema_json()))}
+        for style in ('json', 'minified', 'typescript'):
+            row[style] = estimate_tokens(fc_desc.format(schema=get_schema(model, style)))
+        row["typescript_saving"] = f"{1 - row['typescript'] / row['legacy']:.0%}"
+        results[name] = row
+
+    model = registered_models()['Character']
+    start = time.perf_counter()
+    for _ in range(repeat):
+        model.schema_json()
+    results["schema_json_us"] = round((time.perf_counter() - start) / repeat * 1e6, 1)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        get_schema(model, 'typescript')
+    results["get_schema_us"] = round((time.perf_counter() - start) / repeat * 1e6, 2)
+    return results
+
+
+def bench_response_cache(chapters:int = 10, latency:float = 0.5):
+    """
+        a book run (outline, characters, chapters, image prompts) through CustJsonOuputParser chains
+        against a fake Bedrock chat model: cold with recording, warm rerun, and replay only
+    """
+    import asyncio
+    import tempfile
+    from langchain_core.globals import set_llm_cache
+    from langchain_core.messages import HumanMessage
+    from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+    from bench.fakes import FakeBedrockChatModel
+    from story_agents.llm_utils import CustJsonOuputParser
+    from story_agents.response_cache import install_response_cache, CacheMissError
+
+    def respond(text):
+        return '```json\n' + json.dumps({"echo": text[-40:]}) + '\n```'
+
+    llm = FakeBedrockChatModel(model_id="mistral.mistral-large-2407-v1:0", latency=latency, respond=respond)
+    prompt = ChatPromptTemplate.from_messages([("system", "You are the {role}."), MessagesPlaceholder(variable_name="messages")])
+    chain = prompt | llm | CustJsonOuputParser(verbose=False)
+
+    async def book(topic):
+        # outline and characters in turn, then every chapter and its image prompt concurrently
+        outline = await chain.ainvoke({"role": "cartoonist", "messages": [HumanMessage(content=f"outline about {topic}")]})
+        characters = await chain.ainvoke({"role": "screenwriter", "messages": [HumanMessage(content=json.dumps(outline))]})
+        calls = []
+        for i in range(chapters):
+            calls.append(chain.ainvoke({"role": "cartoonist", "messages": [HumanMessage(content=f"chapter {i} {characters}")]}))
+            calls.append(chain.ainvoke({"role": "illustrator", "messages": [HumanMessage(content=f"image prompt {i}")]}))
+        return [outline, characters, *await asyncio.gather(*calls)]
+
+    results = {"llm_calls_per_book": 2 + 2 * chapters}
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'llm_cache.sqlite')
+        try:
+            install_response_cache(path)
+            start = time.perf_counter()
+            first = asyncio.run(book("a lighthouse"))
+            results["cold_s"] = round(time.perf_counter() - start, 3)
+            results["cold_model_calls"] = llm.calls
+
+            llm.calls = 0
+            start = time.perf_counter()
+            second = asyncio.run(book("a lighthouse"))
+            results["warm_s"] = round(time.perf_counter() - start, 3)
+            results["warm_model_calls"] = llm.calls
+
+            cache = install_response_cache(path, replay_only=True)
+            start = time.perf_counter()
+            third = asyncio.run(book("a lighthouse"))
+            results["replay_s"] = round(time.perf_counter() - start, 3)
+            results["replay_identical"] = first == second == third
+            try:
+                asyncio.run(book("a different topic"))
+                results["replay_miss_raises"] = False
+            except CacheMissError:
+                results["replay_miss_raises"] = True
+            results["cache"] = cache.stats()
+        finally:
+            set_llm_cache(None)
+    return results
+
+
+def bench_pipeline(chapters:int = 6, latency:float = 0.2, endpoint_latency:float = 1.0):
+    """
+        the whole book (outline to docx, with translation) against a fake model and StoryDiffusion endpoint:
+        staged vs overlapped, then a run in which one chapter fails and the resumed run that finishes it
+    """
+    import asyncio
+    import tempfile
+    from bench.fakes import (FakeBedrockChatModel, FakeS3Client, FakeAsyncEndpoint, fake_book_respond,
+                                    fake_storyd_book_response)
+    from story_agents.async_waiter import BackoffWaiter
+    from story_agents.image_utils import StoryDiffusionGenerator
+    from story_agents.pipeline import BookPipeline, PipelineError
+
+    def make(work_dir, overlap, fail_chapters=()):
+        llm = FakeBedrockChatModel(latency=latency, respond=fake_book_respond(chapters, fail_chapters=fail_chapters))
+        s3 = FakeS3Client()
+        endpoint = FakeAsyncEndpoint(s3, latency=endpoint_latency, response_factory=fake_storyd_book_response)
+        generator = StoryDiffusionGenerator("fake-endpoint", waiter=BackoffWaiter(s3, initial_delay=0.05, max_delay=0.2),
+                                            predictor_async=endpoint, s3_client=s3)
+        pipeline = BookPipeline(llm, work_dir=work_dir, image_generator=generator, target_lang="French", country="France",
+                                max_concurrency=chapters, max_in_flight=chapters, overlap=overlap, verbose=False)
+        return pipeline, llm, endpoint
+
+    results = {"chapters": chapters, "llm_latency_s": latency, "endpoint_latency_s": endpoint_latency}
+    with tempfile.TemporaryDirectory() as tmp:
+        for overlap in (False, True):
+            pipeline, llm, endpoint = make(os.path.join(tmp, f"overlap_{overlap}"), overlap)
+            start = time.perf_counter()
+            book = pipeline.run("a lighthouse")
+            key = "overlapped" if overlap else "staged"
+            results[f"{key}_s"] = round(time.perf_counter() - start, 3)
+            results[f"{key}_model_calls"] = llm.calls
+            results[f"{key}_endpoint_requests"] = len(endpoint.requests)
+            results[f"{key}_docx"] = [os.path.basename(f) for f in book['docx']]
+
+        work_dir = os.path.join(tmp, "resume")
+        pipeline, llm, endpoint = make(work_dir, True, fail_chapters=(3,))
+        try:
+            pipeline.run("a lighthouse")
+            results["crashed_run_raised"] = False
+        except PipelineError:
+            results["crashed_run_raised"] = True
+        results["crashed_run_failed_units"] = sorted(pipeline.failed)
+        results["crashed_run_completed_units"] = pipeline.stats['completed']
+
+        pipeline, llm, endpoint = make(work_dir, True)
+        start = time.perf_counter()
+        book = pipeline.run()
+        results["resumed_s"] = round(time.perf_counter() - start, 3)
+        results["resumed_stats"] = book['stats']
+        results["resumed_model_calls"] = llm.calls
+        results["resumed_endpoint_requests"] = len(endpoint.requests)
+        results["resumed_docx"] = [os.path.basename(f) for f in book['docx']]
+    return results
+
+
+def bench_stage_queue(chapters:int = 10, write_s:float = 1.0, prompt_s:float = 0.2, render_s:float = 1.0, workers:int = 2):
+    """
+        write -> image prompt -> render for a book: every stage over all chapters before the next
+        (write_all_chapters, then book_writing_03) vs a StagePipeline with bounded queues
+    """
+    import asyncio
+    from story_agents.stage_queue import Stage, StagePipeline
+
+    def step(seconds):
+        async def _step(key, value):
+            await asyncio.sleep(seconds)
+            return value
+        return _step
+
+    async def staged():
+        semaphore = asyncio.Semaphore(workers)
+
+        async def _limited(fn, key, value):
+            async with semaphore:
+                return await fn(key, value)
+        values = list(range(chapters))
+        for seconds in (write_s, prompt_s, render_s):
+            values = await asyncio.gather(*[_limited(step(seconds), i, v) for i, v in enumerate(values)])
+        return values
+
+    pipeline = StagePipeline([Stage('write', step(write_s), workers=workers),
+                              Stage('image_prompt', step(prompt_s), workers=workers),
+                              Stage('render', step(render_s), workers=workers)])
+    start = time.perf_counter()
+    asyncio.run(staged())
+    staged_s = time.perf_counter() - start
+    start = time.perf_counter()
+    results = asyncio.run(pipeline.arun((i, i) for i in range(chapters)))
+    pipelined_s = time.perf_counter() - start
+    return {"chapters": chapters,
+            "workers_per_stage": workers,
+            "stage_seconds": {"write": write_s, "image_prompt": prompt_s, "render": render_s},
+            "staged_s": round(staged_s, 3),
+            "pipelined_s": round(pipelined_s, 3),
+            "slowest_stage_s": round(chapters / workers * max(write_s, prompt_s, render_s), 3),
+            "completed": len(results),
+            "stats": {name: dict(c) for name, c in pipeline.stats.items()}}
+
+
+def _legacy_save_as_docx(characters, story, fname):
+    # save_as_docx before book_assembler: the source images go into the document as they are
+    from docx import Document
+    from docx.shared import Inches
+    document = Document()
+    document.add_heading(story.story_title, 0)
+    document.add_heading('Characters introduction', level=1)
+    for character, id_img in zip([characters.main_character, *characters.supporting_character], story.identity_images):
+        document.add_heading(f"{character.name}", level=2)
+        document.add_paragraph(f"Role: {character.role}\nBackground: {character.background}")
+        document.add_picture(id_img, width=Inches(4))
+    for chapter, images in zip(story.chapters, story.images):
+        document.add_heading(chapter.chapter_title, level=1)
+        document.add_paragraph(chapter.content)
+        for image in images:
+            document.add_picture(image, width=Inches(6))
+    document.save(fname)
+
+
+def bench_book_assembler(chapters:int = 20, pages:int = 2, size:tuple = (1536, 1024)):
+    """
+        docx of a book whose pages are large PNGs on disk: the previous save_as_docx vs BookAssembler
+        (cold, then with the print images cached). peak traced python memory and document size
+    """
+    import tracemalloc
+    import tempfile
+    from PIL import Image
+    from story_agents.structure_objects import Story, DetailChapter, Character
+    from story_agents.book_assembler import BookAssembler, PrintImageCache
+
+    def measure(fn):
+        tracemalloc.start()
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return round(elapsed, 3), round(peak / 1024**2, 1)
+
+    characters = Character.parse_obj({"main_character": {"name": "Liam", "role": "hero", "background": "b", "figure": "a boy", "appearance": "a"},
+                                      "supporting_character": [{"name": "Mia", "role": "friend", "background": "b", "figure": "a girl", "appearance": "a"}]})
+    results = {"chapters": chapters, "pages_per_chapter": pages, "page_size": list(size)}
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = []
+        for i in range(chapters * pages + 2):
+            path = os.path.join(tmp, f"{i}.png")
+            Image.merge('RGB', [Image.effect_noise(size, 20 + i % 7)] * 2 + [Image.linear_gradient('L').resize(size)]).save(path)
+            paths.append(path)
+        story = Story(story_title="The Lighthouse",
+                      chapters=[DetailChapter(chapter_title=f"Chapter {i}", content="Liam sails. " * 200) for i in range(chapters)],
+                      images=[paths[2 + i*pages: 2 + (i+1)*pages] for i in range(chapters)], identity_images=paths[:2])
+        results["source_mb"] = round(sum(os.path.getsize(p) for p in paths) / 1024**2, 1)
+
+        legacy = os.path.join(tmp, "legacy.docx")
+        results["legacy_s"], results["legacy_peak_mb"] = measure(lambda: _legacy_save_as_docx(characters, story, legacy))
+        results["legacy_docx_mb"] = round(os.path.getsize(legacy) / 1024**2, 1)
+
+        cache = PrintImageCache(os.path.join(tmp, 'print'))
+
+        def assemble(fname):
+            assembler = BookAssembler(fname, story.story_title, image_cache=cache)
+            assembler.add_characters(characters, story.identity_images)
+            # chapters arrive out of order, as they do from the stage pipeline
+            for i in reversed(range(chapters)):
+                assembler.add_chapter(i, story.chapters[i], story.images[i])
+            assembler.save()
+
+        fname = os.path.join(tmp, "assembled.docx")
+        results["assembler_cold_s"], results["assembler_cold_peak_mb"] = measure(lambda: assemble(fname))
+        results["assembler_warm_s"], results["assembler_warm_peak_mb"] = measure(lambda: assemble(fname))
+        results["assembler_docx_mb"] = round(os.path.getsize(fname) / 1024**2, 1)
+        results["print_cache"] = cache.stats()
+    return results
+
+
+def bench_image_writer(panels:int = 50, size:tuple = (1024, 1024)):
+    """
+        saving a 50 panel book: one full PNG at a time on the calling thread (save_image_file), then
+        BatchImageWriter in a process pool per preset. wall time and total bytes written
+    """
+    import tempfile
+    from PIL import Image
+    from story_agents.image_writer import BatchImageWriter
+
+    def panel(i):
+        # smooth shading with some grain, closer to a rendered panel than pure noise
+        base = Image.linear_gradient('L').resize(size).rotate(i * 7)
+        grain = Image.effect_noise(size, 12)
+        return Image.merge('RGB', [base, Image.blend(base, grain, 0.3), grain])
+
+    images = [panel(i) for i in range(panels)]
+    results = {"panels": panels, "size": list(size), "cpus": os.cpu_count()}
+
+    def folder_mb(folder):
+        return round(sum(e.stat().st_size for e in os.scandir(folder) if e.is_file()) / 1024**2, 2)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        folder = os.path.join(tmp, "legacy")
+        os.makedirs(folder)
+        start = time.perf_counter()
+        for i, img in enumerate(images):
+            img.save(os.path.join(folder, f"{i}.png"))
+        results["legacy_png"] = {"s": round(time.perf_counter() - start, 3), "mb": folder_mb(folder)}
+
+        start = time.perf_counter()
+        for img in images:
+            f"temp_{hash(img.tobytes())}.png"
+        results["legacy_name_hash_s"] = round(time.perf_counter() - start, 3)
+
+        for preset in ("png", "png_fast", "webp", "jpeg", "jpeg_small"):
+            folder = os.path.join(tmp, preset)
+            start = time.perf_counter()
+            with BatchImageWriter(folder, preset=preset, thumbnail=(256, 256)) as writer:
+                writer.write(images)
+            results[preset] = {"s": round(time.perf_counter() - start, 3), "mb": folder_mb(folder),
+                               "thumbs_mb": folder_mb(os.path.join(folder, "thumbs"))}
+    return results
+
+
+def bench_telemetry(chapters:int = 4, latency:float = 0.1, endpoint_latency:float = 0.5, spans:int = 100000):
+    """
+        the per-stage summary a traced book run leaves in telemetry.json (fake model and endpoint),
+        and what a span costs with and without a tracer set
+    """
+    import tempfile
+    from bench.fakes import FakeBedrockChatModel, FakeS3Client, FakeAsyncEndpoint, fake_book_respond, fake_storyd_book_response
+    from story_agents.async_waiter import BackoffWaiter
+    from story_agents.image_utils import StoryDiffusionGenerator
+    from story_agents.pipeline import BookPipeline
+    from story_agents.telemetry import Tracer, set_tracer, span
+
+    results = {"chapters": chapters}
+    with tempfile.TemporaryDirectory() as tmp:
+        llm = FakeBedrockChatModel(latency=latency, respond=fake_book_respond(chapters))
+        s3 = FakeS3Client()
+        endpoint = FakeAsyncEndpoint(s3, latency=endpoint_latency, response_factory=fake_storyd_book_response)
+        generator = StoryDiffusionGenerator("fake-endpoint", waiter=BackoffWaiter(s3, initial_delay=0.05, max_delay=0.2),
+                                            predictor_async=endpoint, s3_client=s3)
+        pipeline = BookPipeline(llm, work_dir=tmp, image_generator=generator, target_lang="French", country="France",
+                                max_concurrency=2, max_in_flight=2, overlap=True, verbose=False)
+        book = pipeline.run("a lighthouse")
+        with open(book['telemetry']) as f:
+            summary = json.load(f)
+    results["wall_s"] = summary["wall_s"]
+    results["spans"] = summary["spans"]
+    keys = ("count", "total_s", "p95_s", "queue_wait_s", "retries", "input_tokens", "output_tokens", "bytes")
+    results["stages"] = {name: {k: v for k, v in entry.items() if k in keys} for name, entry in summary["stages"].items()}
+
+    def _loop():
+        start = time.perf_counter()
+        for _ in range(spans):
+            with span("x") as s:
+                s.add("bytes", 1)
+        return (time.perf_counter() - start) / spans * 1e6
+
+    previous = set_tracer(None)
+    results["span_us_untraced"] = round(_loop(), 3)
+    set_tracer(Tracer(max_spans=spans))
+    results["span_us_traced"] = round(_loop(), 3)
+    set_tracer(previous)
+    return results
+
+
+def bench_suite(sizes:tuple = (5, 20, 100)):
+    """
+        the bench_suite scenarios (fake Bedrock, SageMaker async endpoint and S3) at each book size,
+        see bench.suite for the command line with baseline comparison
+    """
+    from bench.suite import run_suite
+    return run_suite(sizes)
+
+
+def bench_memory(chapters:int = 3, turns:tuple = (2, 4, 8, 16), budget:int = 600):
+    """
+        input tokens of the write/refine loop as max_turns grows: the whole history sent back on every
+        turn vs a ConversationMemory view (latest draft and suggestions verbatim, the rest summarised),
+        without and with a history token budget
+    """
+    import asyncio
+    from langchain_core.messages import HumanMessage
+    from bench.fakes import FakeChatModel, fake_book_respond
+    from story_agents.memory import ConversationMemory
+    from story_agents.graph_utils import aget_final_env_var
+    from story_agents.pipeline import build_write_workflow
+    from story_agents.structure_objects import Outline, Character
+    from story_agents.telemetry import Tracer, set_tracer, traced_llm
+
+    respond = fake_book_respond(chapters)
+    outline = Outline.parse_raw(respond('Your task is to write an outline')[8:-4])
+    characters = Character.parse_raw(respond('You are a Screenwriter')[8:-4])
+
+    async def run(workflow):
+        init_states = [{"env_var": {"outline": outline, "characters": characters, "chapter": None},
+                        "messages": [HumanMessage(content=f"Here is the origin content:\n {c.json()}", name='editor')]}
+                       for c in outline.chapters]
+        await asyncio.gather(*[aget_final_env_var(workflow, state, 'write_chapter') for state in init_states])
+
+    results = {"chapters": chapters}
+    for max_turns in turns:
+        for label, memory in (("full", None), ("memory", ConversationMemory()),
+                              ("budget", ConversationMemory(token_budget=budget))):
+            tracer = Tracer()
+            previous = set_tracer(tracer)
+            llm = traced_llm(FakeChatModel(latency=0.0, respond=respond))
+            start = time.perf_counter()
+            asyncio.run(run(build_write_workflow(llm, max_turns=max_turns, memory=memory)))
+            elapsed = time.perf_counter() - start
+            set_tracer(previous)
+            stages = tracer.summary()['stages']
+            results[f"turns_{max_turns}_{label}_input_tokens"] = stages['llm']['input_tokens']
+            results[f"turns_{max_turns}_{label}_s"] = round(elapsed, 3)
+            if memory is not None:
+                results[f"turns_{max_turns}_{label}_saved_per_node"] = {node: r['saved_tokens'] for node, r in memory.report().items()}
+    return results
+
+
+def _legacy_swap_roles(messages, name):
+    from langchain_core.messages import AIMessage, HumanMessage
+    converted = []
+    for message in messages:
+        if isinstance(message, AIMessage) and message.name != name:
+            message = HumanMessage(**message.dict(exclude={"type"}))
+        converted.append(message)
+    return converted
+
+
+def _legacy_reconstruct_to_claude_messages(messages):
+    from langchain_core.messages import AIMessage, HumanMessage
+    from story_agents.llm_utils import convert_message_name
+    rec_messages = []
+    for message in messages:
+        message = convert_message_name(message)
+        if rec_messages:
+            if isinstance(rec_messages[0], AIMessage):
+                rec_messages[0] = HumanMessage(content=rec_messages[0].content)
+            last_msg = rec_messages[-1]
+            last_role = 'assistant' if isinstance(last_msg, AIMessage) else 'user'
+            current_role = 'assistant' if isinstance(message, AIMessage) else 'user'
+            if last_role == current_role:
+                last_msg_content = last_msg.content[-1]['text'] if isinstance(last_msg.content, list) else last_msg.content
+                current_msg_content = message.content[-1]['text'] if isinstance(message.content, list) else message.content
+                new_content = last_msg_content + "\n\n" + current_msg_content
+                rec_messages[-1] = HumanMessage(content=new_content) if last_role == 'user' else AIMessage(content=new_content)
+            else:
+                rec_messages.append(message)
+        else:
+            rec_messages.append(message)
+    return rec_messages
+
+
+def bench_role_view(messages:int = 1000, agents:tuple = ('cartoonist', 'editor', 'screenwriter'), sample:int = 10):
+    """
+        a transcript growing to `messages` messages, each agent taking its role-swapped (and merged) view
+        on every turn: swap_roles + reconstruct_to_claude_messages rebuilt from scratch (timed on the
+        last `sample` turns only, the whole transcript takes minutes) vs role_view over the whole transcript
+    """
+    from langchain_core.messages import AIMessage, HumanMessage
+    from story_agents.llm_utils import role_view
+
+    def _turns():
+        log = [HumanMessage(content="Here is the topic: a lighthouse", name='editor')]
+        for i in range(messages - 1):
+            # agents answering each other, and sometimes the same agent twice in a row
+            name = agents[i % len(agents)] if i % 7 else agents[(i - 1) % len(agents)]
+            log = log + [AIMessage(content=f"turn {i}: " + "the keeper climbs the stairs. " * 20, name=name)]
+            yield log
+
+    def _run(view, first_turn:int = 0):
+        elapsed, turns, out = 0.0, 0, None
+        for i, log in enumerate(_turns()):
+            if i < first_turn:
+                continue
+            start = time.perf_counter()
+            for name in agents:
+                out = view(log, name)
+            elapsed += time.perf_counter() - start
+            turns += 1
+        return elapsed, turns, out
+
+    results = {"messages": messages, "agents": len(agents)}
+    for merge in (False, True):
+        label = "merged" if merge else "swapped"
+        legacy = ((lambda log, name: _legacy_reconstruct_to_claude_messages(_legacy_swap_roles(log, name))) if merge
+                  else _legacy_swap_roles)
+        legacy_s, legacy_turns, legacy_out = _run(legacy, first_turn=messages - 1 - sample)
+        view_s, view_turns, view_out = _run(lambda log, name: role_view(log, name, merge=merge))
+        assert [(m.type, m.content) for m in legacy_out] == [(m.type, m.content) for m in view_out]
+        results[f"{label}_rebuild_ms_per_turn_at_{messages}"] = round(legacy_s / legacy_turns * 1000, 3)
+        results[f"{label}_role_view_ms_per_turn_avg"] = round(view_s / view_turns * 1000, 4)
+        results[f"{label}_role_view_whole_transcript_s"] = round(view_s, 3)
+    return results
+
+
+def bench_final_state(runs:int = 40, max_turns:int = 8):
+    """
+        `runs` parallel chapter workflows (an outline has at most 10 chapters, they repeat): every astream event collected into steps for get_final_state_env_var
+        (the notebooks) vs folded by FinalStateReducer as it arrives, without and with the audit spill.
+        peak python memory comes from a second run under tracemalloc
+    """
+    import asyncio
+    import tempfile
+    import tracemalloc
+    from langchain_core.messages import HumanMessage
+    from bench.fakes import FakeChatModel, fake_book_respond
+    from story_agents.graph_utils import FinalStateReducer, get_final_state_env_var
+    from story_agents.pipeline import build_write_workflow
+    from story_agents.structure_objects import Outline, Character
+
+    respond = fake_book_respond(10)
+    outline = Outline.parse_raw(respond('Your task is to write an outline')[8:-4])
+    characters = Character.parse_raw(respond('You are a Screenwriter')[8:-4])
+    workflow = build_write_workflow(FakeChatModel(latency=0.0, respond=respond), max_turns=max_turns, memory=None)
+    init_states = [{"env_var": {"outline": outline, "characters": characters, "chapter": None},
+                    "messages": [HumanMessage(content=f"Here is the origin content:\n {outline.chapters[i % 10].json()}",
+                                              name='editor')]}
+                   for i in range(runs)]
+
+    async def _steps(i, state, spill_path):
+        steps = [event async for event in workflow.astream(input=state)]
+        return get_final_state_env_var(steps, 'write_chapter')
+
+    async def _reducer(i, state, spill_path):
+        with FinalStateReducer(spill_path, run_id=str(i)) as reducer:
+            async for event in workflow.astream(input=state):
+                reducer.update(event)
+        return reducer.env_var('write_chapter')
+
+    async def _run(consume, spill_path):
+        return await asyncio.gather(*[consume(i, state, spill_path) for i, state in enumerate(init_states)])
+
+    results = {"runs": runs, "max_turns": max_turns}
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, consume, spill in (("steps", _steps, False), ("reducer", _reducer, False), ("reducer_spill", _reducer, True)):
+            spill_path = os.path.join(tmp, f"{label}.jsonl") if spill else None
+            start = time.perf_counter()
+            env_vars = asyncio.run(_run(consume, spill_path))
+            results[f"{label}_s"] = round(time.perf_counter() - start, 3)
+            assert all(e['chapter'] is not None for e in env_vars)
+            tracemalloc.start()
+            try:
+                asyncio.run(_run(consume, spill_path))
+                results[f"{label}_peak_mem_mb"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 3)
+            finally:
+                tracemalloc.stop()
+            if spill_path:
+                results[f"{label}_audit_kb"] = round(os.path.getsize(spill_path) / 1024, 1)
+    return results
+
+
+def bench_early_stop(calls:int = 10, latency:float = 2.0, commentary_chars:int = 1500):
+    """
+        answers followed by commentary_chars of commentary (latency is the time of the whole completion):
+        invoke and parse vs early_stop_llm, for CustJsonOuputParser (stream closed at the json fence) and
+        TextOuputParser (</answer> stop sequence, or the stream closed at </answer>). output tokens per call
+        are estimated from the characters the model generated
+    """
+    import asyncio
+    from langchain_core.prompts import ChatPromptTemplate
+    from bench.fakes import FakeChatModel
+    from story_agents.graph_runner import estimate_tokens
+    from story_agents.llm_utils import (CustJsonOuputParser, TextOuputParser, early_stop_llm, early_stop_stats,
+                                        reset_early_stop_stats)
+
+    commentary = "\n\nA few notes on the choices above: " + "the pacing follows the outline closely. " * (commentary_chars // 40)
+    answers = {
+        "json": lambda text: '```json\n' + json.dumps({"chapter_title": text[-12:], "content": "Liam sails on. " * 80}) + '\n```' + commentary,
+        "text": lambda text: "<thinking>the tone should be warm</thinking>\n<answer>" + "Mia waves from the shore. " * 80 + "</answer>" + commentary,
+    }
+    prompt = ChatPromptTemplate.from_messages([("user", "write chapter {index}")])
+
+    async def _run(llm, parser):
+        # summed latency of the (concurrent) calls
+        chain = prompt | llm | parser
+        elapsed = []
+
+        async def _one(i):
+            start = time.perf_counter()
+            parsed = await chain.ainvoke({"index": i})
+            elapsed.append(time.perf_counter() - start)
+            return parsed
+        parsed = await asyncio.gather(*[_one(i) for i in range(calls)])
+        return sum(elapsed), parsed
+
+    results = {"calls": calls, "latency_s": latency, "commentary_chars": commentary_chars}
+    for kind, modes in (("json", (("early_stop", CustJsonOuputParser(verbose=False), True),)),
+                        ("text", (("stop_sequence", TextOuputParser(verbose=False), True),
+                                  ("early_stop", TextOuputParser(verbose=False), False)))):
+        parser = CustJsonOuputParser(verbose=False) if kind == "json" else TextOuputParser(verbose=False)
+        llm = FakeChatModel(latency=latency, respond=answers[kind], stream_chunk_chars=64)
+        full_s, expected = asyncio.run(_run(llm, parser))
+        full_tokens = estimate_tokens(answers[kind]("write chapter 0"))
+        results[f"{kind}_full_ms_per_call"] = round(full_s / calls * 1000, 1)
+        results[f"{kind}_full_output_tokens_per_call"] = full_tokens
+        for label, mode_parser, stop_sequences in modes:
+            llm = FakeChatModel(latency=latency, respond=answers[kind], stream_chunk_chars=64)
+            reset_early_stop_stats()
+            # measure_every=0: no call reads its commentary, the tokens below are what all of them cost
+            mode_s, parsed = asyncio.run(_run(early_stop_llm(llm, mode_parser, stop_sequences, measure_every=0), mode_parser))
+            assert parsed == expected
+            tokens = estimate_tokens('x' * (llm.calls['streamed_chars'] // calls))
+            results[f"{kind}_{label}_ms_per_call"] = round(mode_s / calls * 1000, 1)
+            results[f"{kind}_{label}_output_tokens_per_call"] = tokens
+            results[f"{kind}_{label}_saved_ms_per_call"] = round((full_s - mode_s) / calls * 1000, 1)
+            results[f"{kind}_{label}_saved_output_tokens_per_call"] = full_tokens - tokens
+            results[f"{kind}_{label}_stats"] = {k: round(v, 3) for k, v in early_stop_stats().items()}
+
+    # the estimate early_stop_stats makes at run time, measuring every other early stop
+    llm = FakeChatModel(latency=latency, respond=answers["json"], stream_chunk_chars=64)
+    reset_early_stop_stats()
+
+    async def _measured():
+        await _run(early_stop_llm(llm, CustJsonOuputParser(verbose=False), measure_every=2), CustJsonOuputParser(verbose=False))
+        while early_stop_stats().get('measured_calls', 0) < calls // 2:
+            await asyncio.sleep(0.05)
+    asyncio.run(_measured())
+    stats = early_stop_stats()
+    results["json_measured_saved_tokens_per_call"] = round(stats['saved_tokens_per_call'], 1)
+    results["json_measured_saved_ms_per_call"] = round(stats['saved_seconds_per_call'] * 1000, 1)
+    return results
+
+
+BENCHMARKS = {
+    "client_pool": bench_client_pool,
+    "image_batch": bench_image_batch,
+    "image_cache": bench_image_cache,
+    "storyd_waiter": bench_storyd_waiter,
+    "storyd_pipeline": bench_storyd_pipeline,
+    "reference_images": bench_reference_images,
+    "result_reader": bench_result_reader,
+    "storyd_prompts": bench_storyd_prompts,
+    "graph_runner": bench_graph_runner,
+    "retry_repair": bench_retry_repair,
+    "json_sanitizer": bench_json_sanitizer,
+    "prompt_cache": bench_prompt_cache,
+    "schema_tokens": bench_schema_tokens,
+    "response_cache": bench_response_cache,
+    "pipeline": bench_pipeline,
+    "stage_queue": bench_stage_queue,
+    "book_assembler": bench_book_assembler,
+    "image_writer": bench_image_writer,
+    "telemetry": bench_telemetry,
+    "suite": bench_suite,
+    "memory": bench_memory,
+    "role_view": bench_role_view,
+    "final_state": bench_final_state,
+    "early_stop": bench_early_stop,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print(name, json.dumps(BENCHMARKS[name](), indent=2))
@@ -0,0 +1,527 @@
+"""
+    local stand-ins for the AWS services used by story_agents, so the helpers can be
+    exercised and benchmarked without an AWS account
+"""
+import io
+import json
+import time
+import base64
+import uuid
+import queue
+import random
+import asyncio
+import threading
+from types import SimpleNamespace
+from typing import Any, Optional, Tuple
+from functools import lru_cache
+from collections import Counter, deque
+from botocore.exceptions import ClientError
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.runnables import Runnable
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 1x1 transparent png
+TINY_PNG_BASE64 = "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+
+
+class _BedrockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.path.startswith("/model/stability"):
+            payload = {"artifacts": [{"base64": TINY_PNG_BASE64, "finishReason": "SUCCESS"}]}
+        else:
+            payload = {"images": [TINY_PNG_BASE64], "error": None}
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubBedrockServer():
+    """
+        minimal bedrock-runtime `invoke_model` endpoint on localhost, answers every call with a tiny image
+        after `latency` seconds. use as a context manager and pass `endpoint_url` to the boto3 client
+    """
+
+    def __init__(self, host:str = "127.0.0.1", port:int = 0, latency:float = 0.0):
+        self.server = ThreadingHTTPServer((host, port), _BedrockHandler)
+        self.server.latency = latency
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def endpoint_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _FakeBody():
+    def __init__(self, data:bytes):
+        self._stream = io.BytesIO(data)
+
+    def read(self, amt=None):
+        return self._stream.read(-1 if amt is None else amt)
+
+    def iter_chunks(self, chunk_size:int = 1024):
+        while True:
+            chunk = self._stream.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        pass
+
+
+class FakeS3Client():
+    """
+        in-memory stand-in for the handful of boto3 s3 client calls used here
+    """
+
+    def __init__(self):
+        self._objects = {}
+        self._lock = threading.Lock()
+        self.calls = Counter()
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.calls['put_object'] += 1
+        data = Body.encode('utf-8') if isinstance(Body, str) else Body if isinstance(Body, bytes) else Body.read()
+        with self._lock:
+            self._objects[(Bucket, Key)] = data
+        return {}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, **kwargs):
+        self.put_object(Bucket=Bucket, Key=Key, Body=Fileobj.read())
+
+    def _get(self, Bucket, Key, operation):
+        with self._lock:
+            data = self._objects.get((Bucket, Key))
+        if data is None:
+            raise ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, operation)
+        return data
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self.calls['head_object'] += 1
+        return {'ContentLength': len(self._get(Bucket, Key, 'HeadObject'))}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self.calls['get_object'] += 1
+        data = self._get(Bucket, Key, 'GetObject')
+        return {'Body': _FakeBody(data), 'ContentLength': len(data)}
+
+
+class FakeSqsClient():
+    """
+        in-memory SQS queue, receive_message long-polls like the real one
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        self._queue.put(MessageBody)
+        return {'MessageId': str(uuid.uuid4())}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, **kwargs):
+        messages = []
+        try:
+            if WaitTimeSeconds:
+                messages.append(self._queue.get(timeout=WaitTimeSeconds))
+            while len(messages) < MaxNumberOfMessages:
+                messages.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return {'Messages': [{'Body': body, 'ReceiptHandle': str(uuid.uuid4())} for body in messages]}
+
+    def delete_message(self, QueueUrl, ReceiptHandle, **kwargs):
+        return {}
+
+
+def fake_storyd_response(images:int = 4, image_base64:str = TINY_PNG_BASE64) -> bytes:
+    return json.dumps({"images_base64": [image_base64]*images}).encode('utf-8')
+
+
+@lru_cache(maxsize=None)
+def page_png_base64(width:int = 1100, height:int = 8) -> str:
+    """
+        a blank png wider than 1024, what StoryDiffusion's assembled comic pages look like to the book code
+    """
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), 'white').save(buffer, format='PNG')
+    return base64.b64encode(buffer.getvalue()).decode('utf-8')
+
+
+def fake_storyd_book_response(data=None, panels:int = 3) -> bytes:
+    """
+        single panels plus one comic page, like a StoryDiffusion response for a chapter
+    """
+    return json.dumps({"images_base64": [TINY_PNG_BASE64]*panels + [page_png_base64()]}).encode('utf-8')
+
+
+class FakeAsyncEndpoint():
+    """
+        stands in for sagemaker's AsyncPredictor: predict_async returns right away and the result
+        object lands in the (fake) s3 bucket `latency` seconds later. with a sqs client and queue url
+        it also publishes the SNS style success notification
+    """
+
+    def __init__(self, s3_client, latency:float = 1.0, images:int = 4, bucket:str = 'fake-bucket',
+                 fail_rate:float = 0.0, sqs_client=None, queue_url:str = 'fake-queue', response_factory=None):
+        self.s3_client = s3_client
+        self.latency = latency
+        self.images = images
+        self.bucket = bucket
+        self.fail_rate = fail_rate
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+        self.response_factory = response_factory or (lambda data: fake_storyd_response(self.images))
+        self.requests = []
+        self._rand = random.Random(0)
+
+    def predict_async(self, data=None, **kwargs):
+        self.requests.append(data)
+        inference_id = uuid.uuid4().hex
+        output_path = f"s3://{self.bucket}/story-diffusion/asyncinvoke/out/{inference_id}.out"
+        failure_path = f"s3://{self.bucket}/story-diffusion/asyncinvoke/failure/{inference_id}-error.out"
+        failed = self._rand.random() < self.fail_rate
+        timer = threading.Timer(self.latency, self._finish, args=(data, output_path, failure_path, failed))
+        timer.daemon = True
+        timer.start()
+        return SimpleNamespace(output_path=output_path, failure_path=failure_path, inference_id=inference_id)
+
+    def _finish(self, data, output_path, failure_path, failed):
+        path = failure_path if failed else output_path
+        body = b'{"error": "fake failure"}' if failed else self.response_factory(data)
+        bucket, key = path[5:].split('/', 1)
+        self.s3_client.put_object(Bucket=bucket, Key=key, Body=body)
+        if self.sqs_client:
+            location = {'failureLocation': path} if failed else {'outputLocation': path}
+            message = {'invocationStatus': 'Failed' if failed else 'Completed',
+                       'responseParameters': location}
+            self.sqs_client.send_message(QueueUrl=self.queue_url,
+                                         MessageBody=json.dumps({'Type': 'Notification', 'Message': json.dumps(message)}))
+
+
+class FakeChatModel(Runnable):
+    """
+        stand-in for a Bedrock chat model: answers after `latency` seconds with respond(prompt_text),
+        raises ThrottlingException once more than requests_per_window calls land within `window` seconds.
+        astream spreads the latency over chunks of stream_chunk_chars characters. with prompt_cache,
+        text before a cachePoint block counts as cache_read once it has been seen, like Bedrock reports it
+    """
+
+    def __init__(self, latency:float = 0.05, requests_per_window:Optional[int] = None, window:float = 1.0,
+                 respond=None, model_id:str = 'fake.chat-model', stream_chunk_chars:int = 16,
+                 prompt_cache:bool = False):
+        self.latency = latency
+        self.stream_chunk_chars = stream_chunk_chars
+        self.prompt_cache = prompt_cache
+        self._cached_prefixes = set()
+        self.requests_per_window = requests_per_window
+        self.window = window
+        self.respond = respond or (lambda text: '```json\n{"content": "ok"}\n```')
+        self.model_id = model_id
+        self.calls = Counter()
+        self._recent = deque()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _text(prompt) -> str:
+        if hasattr(prompt, 'to_messages'):
+            prompt = prompt.to_messages()
+        if isinstance(prompt, list):
+            return '\n'.join(str(getattr(m, 'content', m)) for m in prompt)
+        return str(prompt)
+
+    def _admit(self):
+        with self._lock:
+            self.calls['requests'] += 1
+            if self.requests_per_window is None:
+                return
+            now = time.monotonic()
+            while self._recent and now - self._recent[0] > self.window:
+                self._recent.popleft()
+            if len(self._recent) >= self.requests_per_window:
+                self.calls['throttled'] += 1
+                raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Too many requests'}}, 'Converse')
+            self._recent.append(now)
+
+    def _cache_tokens(self, prompt) -> dict:
+        messages = prompt.to_messages() if hasattr(prompt, 'to_messages') else prompt
+        for m in messages if isinstance(messages, list) else []:
+            content = getattr(m, 'content', None)
+            if not isinstance(content, list) or not any('cachePoint' in block for block in content if isinstance(block, dict)):
+                continue
+            prefix = ''.join(block.get('text', '') for block in content if isinstance(block, dict))
+            tokens = len(prefix) // 4 + 1
+            with self._lock:
+                if prefix in self._cached_prefixes:
+                    return {'cache_read': tokens, 'cache_creation': 0}
+                self._cached_prefixes.add(prefix)
+            return {'cache_read': 0, 'cache_creation': tokens}
+        return {}
+
+    @staticmethod
+    def _stop(content:str, stop) -> str:
+        # like bedrock: the answer ends before the first stop sequence, which is not returned
+        for sequence in stop or ():
+            found = content.find(sequence)
+            if found != -1:
+                content = content[:found]
+        return content
+
+    def _message(self, prompt, stop=None) -> Tuple[AIMessage, float]:
+        # the answer and the share of latency it takes, less than 1 when a stop sequence cut it
+        text = self._text(prompt)
+        full = self.respond(text)
+        content = self._stop(full, stop)
+        input_tokens, output_tokens = len(text) // 4 + 1, len(content) // 4 + 1
+        usage = {'input_tokens': input_tokens, 'output_tokens': output_tokens, 'total_tokens': input_tokens + output_tokens}
+        details = self._cache_tokens(prompt) if self.prompt_cache else {}
+        if details:
+            usage['input_token_details'] = details
+        return AIMessage(content=content, usage_metadata=usage), len(content) / max(1, len(full))
+
+    def invoke(self, input, config=None, stop=None, **kwargs):
+        self._admit()
+        message, share = self._message(input, stop)
+        time.sleep(self.latency * share)
+        return message
+
+    async def ainvoke(self, input, config=None, stop=None, **kwargs):
+        self._admit()
+        message, share = self._message(input, stop)
+        await asyncio.sleep(self.latency * share)
+        return message
+
+    async def astream(self, input, config=None, stop=None, **kwargs):
+        self._admit()
+        full = self.respond(self._text(input))
+        content = self._stop(full, stop)
+        # latency is the time of the whole answer, an answer cut by a stop sequence takes its share of it
+        delay = self.latency / max(1, -(-len(full) // self.stream_chunk_chars))
+        pieces = [content[i:i+self.stream_chunk_chars] for i in range(0, len(content), self.stream_chunk_chars)] or ['']
+        for piece in pieces:
+            await asyncio.sleep(delay)
+            self.calls['streamed_chars'] += len(piece)
+            yield AIMessageChunk(content=piece)
+
+
+class FakeBedrockChatModel(BaseChatModel):
+    """
+        a real langchain chat model (so the global llm cache applies) that answers respond(prompt_text)
+        after `latency` seconds and counts its calls
+    """
+    model_id: str = 'fake.bedrock-chat'
+    temperature: float = 0.1
+    latency: float = 0.5
+    respond: Any = None
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return 'fake-bedrock-chat'
+
+    @property
+    def _identifying_params(self) -> dict:
+        return {'model_id': self.model_id, 'temperature': self.temperature}
+
+    def _result(self, messages) -> ChatResult:
+        self.calls += 1
+        text = '\n'.join(str(m.content) for m in messages)
+        content = self.respond(text) if self.respond else '```json\n{"content": "ok"}\n```'
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content))])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        time.sleep(self.latency)
+        return self._result(messages)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        await asyncio.sleep(self.latency)
+        return self._result(messages)
+
+
+def malform_answer(text:str, rand:random.Random) -> str:
+    """
+        one of the ways models break a json answer: raw newline in a string, trailing comma,
+        unescaped quotes, or a completion cut off before the closing brace
+    """
+    kind = rand.randrange(4)
+    if kind == 0 and '": "' in text:
+        return text.replace('": "', '": "\n', 1)
+    if kind == 1 and '}' in text:
+        head, _, tail = text.rpartition('}')
+        return f"{head},}}{tail}"
+    if kind == 2 and '": "' in text:
+        return text.replace('": "', '": "the "quoted" ', 1)
+    return text[:max(1, len(text) * 3 // 4)]
+
+
+class FakeBedrockRuntimeClient():
+    """
+        in-memory bedrock-runtime client: invoke_model answers with an image, converse with
+        respond(prompt_text). each call takes latency seconds (+/- jitter), fails with ThrottlingException
+        throttle_rate of the time, and converse answers are malformed (malform_answer) malformed_rate of the time
+    """
+
+    def __init__(self, latency:float = 0.05, jitter:float = 0.5, throttle_rate:float = 0.0, malformed_rate:float = 0.0,
+                 respond=None, image_base64:str = TINY_PNG_BASE64, seed:int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.malformed_rate = malformed_rate
+        self.respond = respond or (lambda text: '```json\n{"content": "ok"}\n```')
+        self.image_base64 = image_base64
+        self.calls = Counter()
+        self._rand = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _call(self, operation:str):
+        with self._lock:
+            self.calls[operation] += 1
+            throttled = self._rand.random() < self.throttle_rate
+            latency = self.latency * (1 + self.jitter * (2 * self._rand.random() - 1))
+            if throttled:
+                self.calls['throttled'] += 1
+        if throttled:
+            time.sleep(latency / 10)
+            raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Too many requests'}}, operation)
+        time.sleep(latency)
+
+    def invoke_model(self, body, modelId, accept=None, contentType=None, **kwargs):
+        self._call('InvokeModel')
+        if modelId.startswith('stability'):
+            payload = {"artifacts": [{"base64": self.image_base64, "finishReason": "SUCCESS"}]}
+        else:
+            payload = {"images": [self.image_base64], "error": None}
+        return {'body': _FakeBody(json.dumps(payload).encode('utf-8')), 'contentType': 'application/json'}
+
+    def converse(self, modelId, messages, system=None, inferenceConfig=None, **kwargs):
+        self._call('Converse')
+        parts = [block.get('text', '') for block in system or []]
+        parts += [block.get('text', '') for m in messages for block in m['content']]
+        prompt = '\n'.join(parts)
+        text = self.respond(prompt)
+        for sequence in (inferenceConfig or {}).get('stopSequences') or ():
+            if sequence in text:
+                text = text[:text.find(sequence)]
+        with self._lock:
+            malformed = self._rand.random() < self.malformed_rate
+            if malformed:
+                self.calls['malformed'] += 1
+                text = malform_answer(text, self._rand)
+        input_tokens, output_tokens = len(prompt) // 4 + 1, len(text) // 4 + 1
+        return {'output': {'message': {'role': 'assistant', 'content': [{'text': text}]}}, 'stopReason': 'end_turn',
+                'usage': {'inputTokens': input_tokens, 'outputTokens': output_tokens, 'totalTokens': input_tokens + output_tokens}}
+
+
+@lru_cache(maxsize=1)
+def _converse_executor():
+    # like a boto call from ChatBedrockConverse.ainvoke, but not capped by the default executor's few threads
+    from concurrent.futures import ThreadPoolExecutor
+    return ThreadPoolExecutor(max_workers=64, thread_name_prefix='fake-converse')
+
+
+class FakeConverseChatModel(BaseChatModel):
+    """
+        chat model calling `client.converse` the way ChatBedrockConverse does, so a FakeBedrockRuntimeClient's
+        latency, throttling and malformed answers reach the chains as they would from Bedrock
+    """
+    client: Any = None
+    model_id: str = 'fake.converse-chat'
+    max_tokens: int = 4096
+
+    @property
+    def _llm_type(self) -> str:
+        return 'fake-converse-chat'
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        system = [{'text': str(m.content)} for m in messages if m.type == 'system']
+        turns = [{'role': 'assistant' if m.type == 'ai' else 'user', 'content': [{'text': str(m.content)}]}
+                 for m in messages if m.type != 'system']
+        response = self.client.converse(modelId=self.model_id, messages=turns, system=system,
+                                        inferenceConfig={'maxTokens': self.max_tokens, 'stopSequences': stop or []})
+        usage = response['usage']
+        message = AIMessage(content=response['output']['message']['content'][0]['text'],
+                            usage_metadata={'input_tokens': usage['inputTokens'], 'output_tokens': usage['outputTokens'],
+                                            'total_tokens': usage['totalTokens']})
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_converse_executor(), lambda: self._generate(messages, stop))
+
+
+def fake_book_respond(chapters:int = 5, names=('Liam', 'Mia'), fail_chapters=()):
+    """
+        respond function for FakeChatModel / FakeBedrockChatModel that answers every prompt of
+        story_agents.pipeline with a valid answer: outline, characters, chapters, editor suggestions,
+        portrait and story prompts, translations (echoing the source). writing a chapter whose index
+        is in fail_chapters raises ValueError
+    """
+    def _fence(obj) -> str:
+        return '```json\n' + json.dumps(obj) + '\n```'
+
+    def _persona(name, figure):
+        return {"name": name, "role": "explorer", "background": f"{name} loves the sea",
+                "figure": figure, "appearance": "a yellow raincoat"}
+
+    def _between(text, start, end):
+        # the last occurrence, the instructions mention the tags before the filled in ones
+        tail = text[text.rfind(start) + len(start):]
+        return tail[:tail.find(end)].strip()
+
+    def respond(text:str) -> str:
+        if 'write stories for specific chapter' in text:
+            origin = text[text.rindex('Here is the origin content:'):]
+            chapter, _ = json.JSONDecoder().raw_decode(origin[origin.index('{'):])
+            index = int(chapter['chapter_title'].rsplit(' ', 1)[-1])
+            if index in fail_chapters:
+                raise ValueError(f"model failure writing chapter {index}")
+            return _fence({"chapter_title": chapter['chapter_title'],
+                           "content": f"{names[0]} and {names[-1]} sail to island {index}. " * 20})
+        if 'comics book editor' in text:
+            return "1. add more dialogue\n2. make the ending stronger"
+        if 'Your task is to write an outline' in text:
+            return _fence({"page_title": "The Lighthouse",
+                           "chapters": [{"chapter_title": f"Chapter {i}", "description": f"the island number {i}"}
+                                        for i in range(chapters)]})
+        if 'You are a Screenwriter' in text:
+            return _fence({"main_character": _persona(names[0], "a boy"),
+                           "supporting_character": [_persona(n, "a girl") for n in names[1:]]})
+        if 'You are an art designer' in text:
+            return _fence({"prompt": "a photorealistic portrait of a child in a yellow raincoat, 4k"})
+        if 'You are a story illustrator' in text:
+            return _fence({"prompt": [f"[{names[0]}] sails a small boat", f"[{names[-1]}] waves at [{names[0]}]",
+                                      "[NC] the sea is calm"]})
+        if '<EXPERT_SUGGESTIONS>' in text:
+            return '```json\n' + _between(text, '<TRANSLATION>', '</TRANSLATION>') + '\n```'
+        if 'Output only the suggestions' in text:
+            return "1. keep the tone playful"
+        if 'translation task' in text:
+            source = _between(text, 'English:', 'Output transalated chatper:')
+            return '```json\n' + (source if source.startswith('{') else json.dumps({"title": source})) + '\n```'
+        return _fence({"content": "ok"})
+
+    return respond
@@ -0,0 +1,247 @@
+"""
+    end to end benchmark suite against local stand-ins for Bedrock (fakes.FakeBedrockRuntimeClient, with
+    latency, throttling and malformed answers), the SageMaker async endpoint (fakes.FakeAsyncEndpoint) and
+    S3 (fakes.FakeS3Client), over books of 5, 20 and 100 chapters. run from demo_2:
+
+        python -m bench.suite --out bench.json
+        python -m bench.suite --baseline bench.json     # exit 1 when a result regressed
+
+    every (scenario, chapters) result has the throughput, p50/p99 latency of one call and the peak
+    python memory (tracemalloc, measured in a second run) of the run:
+
+        chapter_json    retry_call over prompt | chat model | CustJsonOuputParser, one chapter per call
+        portraits       ImageGenerator.agenerate_image through bedrock-runtime invoke_model
+        storyd          StoryDiffusionGenerator.agenerate_images, one request per chapter, results read from S3
+        storyd_prompts  prepare_storyd_prompts over the story lines, one chapter per step
+"""
+import io
+import sys
+import json
+import math
+import time
+import asyncio
+import argparse
+import platform
+import tracemalloc
+from contextlib import redirect_stdout
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+DEFAULT_SIZES = (5, 20, 100)
+# result keys compared against a baseline, and whether a larger value is better
+COMPARED = {'throughput_per_s': True, 'p99_ms': False, 'peak_mem_mb': False}
+
+
+def percentile(values:Sequence[float], q:float) -> float:
+    """
+        nearest-rank percentile, q in [0, 1]
+    """
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, math.ceil(q * len(values)) - 1))]
+
+
+async def _timed_fan_out(items, call, max_concurrency:int) -> Tuple[List[float], List[Any]]:
+    # latency of each call(item), at most max_concurrency in flight
+    semaphore = asyncio.Semaphore(max_concurrency)
+    latencies = []
+
+    async def _one(item):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                return await call(item)
+            except Exception as err:
+                return err
+            finally:
+                latencies.append(time.perf_counter() - start)
+
+    results = await asyncio.gather(*[_one(item) for item in items])
+    return latencies, results
+
+
+def scenario_chapter_json(chapters:int, config:dict):
+    from langchain_core.messages import HumanMessage
+    from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+    from langchain_core.runnables import RunnableLambda
+    from bench.fakes import FakeBedrockRuntimeClient, FakeConverseChatModel
+    from story_agents.graph_utils import retry_call
+    from story_agents.llm_utils import CustJsonOuputParser, dict_to_obj
+    from story_agents.retry import reset_retry_stats, retry_stats
+    from story_agents.structure_objects import DetailChapter
+
+    def respond(text):
+        title = text[text.rfind('Chapter '):].split('\n', 1)[0]
+        return '```json\n' + json.dumps({"chapter_title": title, "content": "Liam and Mia sail to the island. " * 60}) + '\n```'
+
+    client = FakeBedrockRuntimeClient(latency=config['llm_latency'], throttle_rate=config['throttle_rate'],
+                                      malformed_rate=config['malformed_rate'], respond=respond, seed=config['seed'])
+    llm = FakeConverseChatModel(client=client)
+    prompt = ChatPromptTemplate.from_messages([("system", "You are a cartoonist, write the chapter as json."),
+                                               MessagesPlaceholder(variable_name="messages")])
+    chain = prompt | llm | CustJsonOuputParser(verbose=False) | RunnableLambda(dict_to_obj).bind(target=DetailChapter)
+    reset_retry_stats()
+
+    async def _write(index):
+        return await retry_call(chain, {"messages": [HumanMessage(content=f"Chapter {index}")]})
+
+    latencies, results = asyncio.run(_timed_fan_out(range(chapters), _write, config['max_concurrency']))
+    stats = retry_stats()
+    return latencies, {'failed': sum(isinstance(r, Exception) for r in results), 'model_calls': client.calls['Converse'],
+                       'throttled': client.calls['throttled'], 'malformed': client.calls['malformed'],
+                       'repaired': stats.get('repaired', 0), 'followups': stats.get('followups', 0),
+                       'regenerations': stats.get('regenerations', 0)}
+
+
+def scenario_portraits(chapters:int, config:dict):
+    from bench.fakes import FakeBedrockRuntimeClient
+    from story_agents.image_utils import ImageGenerator
+    client = FakeBedrockRuntimeClient(latency=config['image_latency'], throttle_rate=config['throttle_rate'], seed=config['seed'])
+    generator = ImageGenerator(client=client)
+
+    async def _portrait(index):
+        return await generator.agenerate_image(f"a portrait of character {index}", seed=index)
+
+    latencies, results = asyncio.run(_timed_fan_out(range(chapters), _portrait, config['max_concurrency']))
+    # generate_image returns None on errors (a throttled call is not retried)
+    return latencies, {'failed': sum(r is None or isinstance(r, Exception) for r in results),
+                       'requests': client.calls['InvokeModel']}
+
+
+def scenario_storyd(chapters:int, config:dict):
+    from story_agents.async_waiter import BackoffWaiter
+    from bench.fakes import FakeAsyncEndpoint, FakeS3Client, fake_storyd_book_response
+    from story_agents.image_utils import StoryDiffusionGenerator
+    s3 = FakeS3Client()
+    endpoint = FakeAsyncEndpoint(s3, latency=config['endpoint_latency'], response_factory=fake_storyd_book_response)
+    generator = StoryDiffusionGenerator("fake-endpoint", waiter=BackoffWaiter(s3, initial_delay=0.02, max_delay=0.1),
+                                        predictor_async=endpoint, s3_client=s3)
+
+    async def _render(index):
+        return await generator.agenerate_images(general_prompt="[Liam] a boy img\n[Mia] a girl img",
+                                                prompt_array=f"[Liam] sails to island {index}\n[Mia] waves\n[NC] the sea",
+                                                id_length=2, ref_imgs=[])
+
+    latencies, results = asyncio.run(_timed_fan_out(range(chapters), _render, config['max_in_flight']))
+    return latencies, {'failed': sum(isinstance(r, Exception) for r in results), 'requests': len(endpoint.requests),
+                       's3_calls': dict(s3.calls)}
+
+
+def scenario_storyd_prompts(chapters:int, config:dict):
+    from bench.benchmarks import _synthetic_book
+    from story_agents.image_utils import prepare_storyd_prompts
+    story_lines, cast, img_dicts = _synthetic_book(chapters, characters=8, seed=config['seed'])
+    prompts = prepare_storyd_prompts(story_lines, cast, img_dicts)
+    latencies = []
+    for _ in range(chapters):
+        start = time.perf_counter()
+        next(prompts)
+        latencies.append(time.perf_counter() - start)
+    return latencies, {}
+
+
+SCENARIOS: Dict[str, Callable[[int, dict], Tuple[List[float], dict]]] = {
+    'chapter_json': scenario_chapter_json,
+    'portraits': scenario_portraits,
+    'storyd': scenario_storyd,
+    'storyd_prompts': scenario_storyd_prompts,
+}
+
+DEFAULT_CONFIG = {'llm_latency': 0.05, 'image_latency': 0.05, 'endpoint_latency': 0.2, 'throttle_rate': 0.05,
+                  'malformed_rate': 0.1, 'max_concurrency': 8, 'max_in_flight': 8, 'seed': 0}
+
+
+def _quiet(name:str, chapters:int, config:dict):
+    # the helpers print progress per call, keep it out of the report
+    with redirect_stdout(io.StringIO()):
+        return SCENARIOS[name](chapters, config)
+
+
+def run_scenario(name:str, chapters:int, config:dict, memory:bool = True) -> Dict[str, Any]:
+    """
+        latencies come from a plain run; the peak memory from a second run under tracemalloc,
+        which slows python code down too much to time it at the same time
+    """
+    start = time.perf_counter()
+    latencies, extra = _quiet(name, chapters, config)
+    wall = time.perf_counter() - start
+    result = {'scenario': name, 'chapters': chapters, 'wall_s': round(wall, 4),
+              'throughput_per_s': round(len(latencies) / wall, 2) if wall else 0.0,
+              'p50_ms': round(percentile(latencies, 0.5) * 1000, 3), 'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+              **extra}
+    if memory:
+        tracemalloc.start()
+        try:
+            _quiet(name, chapters, config)
+            result['peak_mem_mb'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 3)
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def run_suite(sizes:Sequence[int] = DEFAULT_SIZES, scenarios:Optional[Sequence[str]] = None,
+              config:Optional[dict] = None, memory:bool = True) -> Dict[str, Any]:
+    """
+        every scenario at every book size, as a json-able report
+    """
+    config = {**DEFAULT_CONFIG, **(config or {})}
+    environment = {'python': platform.python_version(), 'platform': platform.platform(), 'machine': platform.machine()}
+    results = []
+    for name in scenarios or list(SCENARIOS):
+        # imports, client setup and first-call caches are not part of any book size
+        _quiet(name, 1, config)
+        results.extend(run_scenario(name, size, config, memory) for size in sizes)
+    return {'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'environment': environment, 'config': config, 'results': results}
+
+
+def compare(report:Dict[str, Any], baseline:Dict[str, Any], tolerance:float = 0.25) -> List[str]:
+    """
+        the results of report worse than the same (scenario, chapters) in baseline by more than tolerance
+    """
+    previous = {(r['scenario'], r['chapters']): r for r in baseline['results']}
+    regressions = []
+    for result in report['results']:
+        base = previous.get((result['scenario'], result['chapters']))
+        if base is None:
+            continue
+        for key, higher_is_better in COMPARED.items():
+            old, new = base.get(key), result.get(key)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(f"{result['scenario']}[{result['chapters']}] {key}: {old} -> {new} ({change:+.0%})")
+    return regressions
+
+
+def main(argv:Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="story_agents benchmarks against fake Bedrock, SageMaker and S3")
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES), help="book sizes in chapters")
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS))
+    parser.add_argument('--out', help="write the json report here instead of stdout")
+    parser.add_argument('--baseline', help="earlier report to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="relative change counted as a regression")
+    parser.add_argument('--no-memory', action='store_true', help="skip the tracemalloc runs, halves the time")
+    for key, value in DEFAULT_CONFIG.items():
+        parser.add_argument(f"--{key.replace('_', '-')}", type=type(value), default=value)
+    args = parser.parse_args(argv)
+
+    config = {key: getattr(args, key) for key in DEFAULT_CONFIG}
+    report = run_suite(args.sizes, args.scenarios, config, memory=not args.no_memory)
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"regression: {line}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,252 @@
+import json
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import Optional
+from botocore.exceptions import ClientError
+
+SUCCESS = 'success'
+FAILURE = 'failure'
+
+
+def get_bucket_and_key(s3uri):
+    pos = s3uri.find("/", 5)
+    bucket = s3uri[5:pos]
+    key = s3uri[pos + 1 :]
+    return bucket, key
+
+
+class WaiterTimeoutError(Exception):
+    "Raised when an async inference result did not show up in time"
+    def __init__(self, message):
+        self.message = message
+        super().__init__(message)
+
+
+class SqsCompletionListener():
+    """
+        long-polls the SQS queue subscribed to the async endpoint's SNS success/error topics
+        and wakes up whoever is waiting on the matching output location.
+        a notification nobody waits for yet (it beat register(), or it belongs to another client of the
+        queue) is kept for unclaimed_ttl seconds, at most max_unclaimed of them
+    """
+
+    def __init__(self, sqs_client, queue_url:str, wait_time_seconds:int = 20, max_unclaimed:int = 10000,
+                 unclaimed_ttl:float = 900.0):
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+        self.wait_time_seconds = wait_time_seconds
+        self.max_unclaimed = max_unclaimed
+        self.unclaimed_ttl = unclaimed_ttl
+        self._lock = threading.Lock()
+        self._status = {}    # registered output/failure location -> SUCCESS | FAILURE
+        self._unclaimed = OrderedDict()  # location nobody registered -> (status, monotonic time), oldest first
+        self._waiters = {}   # output/failure location -> [threading.Event | (loop, future)]
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='sqs-completion-listener', daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def parse_notification(body:str):
+        """
+            returns (status, [locations]) from a raw or SNS-wrapped SageMaker async inference notification
+        """
+        message = json.loads(body)
+        if 'Message' in message and message.get('Type') == 'Notification':
+            message = json.loads(message['Message'])
+        response = message.get('responseParameters', {})
+        locations = [loc for loc in (response.get('outputLocation'), response.get('failureLocation')) if loc]
+        status = SUCCESS if message.get('invocationStatus') == 'Completed' else FAILURE
+        return status, locations
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                resp = self.sqs_client.receive_message(QueueUrl=self.queue_url,
+                                                       MaxNumberOfMessages=10,
+                                                       WaitTimeSeconds=self.wait_time_seconds)
+            except Exception as err:
+                print(f"SQS receive failed: {err}")
+                self._stopped.wait(1)
+                continue
+            for msg in resp.get('Messages', []):
+                try:
+                    status, locations = self.parse_notification(msg['Body'])
+                except (ValueError, KeyError) as err:
+                    print(f"Skip unreadable notification: {err}")
+                    locations = []
+                for location in locations:
+                    self._complete(location, status)
+                self.sqs_client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=msg['ReceiptHandle'])
+
+    def _prune_unclaimed(self, now:float):
+        # called with the lock held
+        while self._unclaimed:
+            location, (_, received) = next(iter(self._unclaimed.items()))
+            if len(self._unclaimed) <= self.max_unclaimed and now - received <= self.unclaimed_ttl:
+                break
+            del self._unclaimed[location]
+
+    def _claim(self, location:str) -> Optional[str]:
+        # status of location, moving an unclaimed notification over to the registered ones. lock held
+        if location in self._unclaimed:
+            self._status[location] = self._unclaimed.pop(location)[0]
+        return self._status.get(location)
+
+    def _complete(self, location:str, status:str):
+        with self._lock:
+            waiters = self._waiters.pop(location, [])
+            if waiters or location in self._status:
+                self._status[location] = status
+            else:
+                now = time.monotonic()
+                self._unclaimed[location] = (status, now)
+                self._unclaimed.move_to_end(location)
+                self._prune_unclaimed(now)
+        for waiter in waiters:
+            if isinstance(waiter, threading.Event):
+                waiter.set()
+            else:
+                loop, future = waiter
+                loop.call_soon_threadsafe(lambda f=future: f.done() or f.set_result(status))
+
+    def register(self, *locations) -> threading.Event:
+        """
+            event set once any of the locations is reported done, call before waiting so it is not missed
+        """
+        event = threading.Event()
+        with self._lock:
+            self._prune_unclaimed(time.monotonic())
+            for location in filter(None, locations):
+                if self._claim(location):
+                    event.set()
+                self._waiters.setdefault(location, []).append(event)
+        return event
+
+    def future(self, *locations) -> asyncio.Future:
+        """
+            asyncio flavour of register, the future resolves to SUCCESS or FAILURE
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            self._prune_unclaimed(time.monotonic())
+            for location in filter(None, locations):
+                status = self._claim(location)
+                if status and not future.done():
+                    future.set_result(status)
+                self._waiters.setdefault(location, []).append((loop, future))
+        return future
+
+    def status(self, *locations) -> Optional[str]:
+        with self._lock:
+            for location in filter(None, locations):
+                status = self._status.get(location) or self._unclaimed.get(location, (None,))[0]
+                if status:
+                    return status
+        return None
+
+    def forget(self, *locations):
+        with self._lock:
+            for location in filter(None, locations):
+                self._waiters.pop(location, None)
+                self._status.pop(location, None)
+                self._unclaimed.pop(location, None)
+
+    def stop(self):
+        self._stopped.set()
+
+
+class BackoffWaiter():
+    """
+        waits for a SageMaker async inference result by polling the output/failure objects in S3
+        with exponential backoff that starts sub-second, instead of a fixed 10s WaiterConfig delay.
+        with a SqsCompletionListener the SNS notification ends the wait right away and the polls
+        become a slow safety net
+    """
+
+    def __init__(self, s3_client, initial_delay:float = 0.25, max_delay:float = 10.0, factor:float = 1.6,
+                 timeout:float = 1000.0, listener:Optional[SqsCompletionListener] = None):
+        self.s3_client = s3_client
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.timeout = timeout
+        self.listener = listener
+
+    def _exists(self, s3uri:Optional[str]) -> bool:
+        if not s3uri:
+            return False
+        bucket, key = get_bucket_and_key(s3uri)
+        try:
+            self.s3_client.head_object(Bucket=bucket, Key=key)
+            return True
+        except ClientError as err:
+            if err.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def check(self, output_path:str, failure_path:Optional[str] = None) -> Optional[str]:
+        if self.listener:
+            status = self.listener.status(output_path, failure_path)
+            if status:
+                return status
+        if self._exists(output_path):
+            return SUCCESS
+        if self._exists(failure_path):
+            return FAILURE
+        return None
+
+    def _delays(self):
+        delay = self.initial_delay
+        while True:
+            yield delay
+            delay = min(delay * self.factor, self.max_delay)
+
+    def wait(self, output_path:str, failure_path:Optional[str] = None) -> str:
+        """
+            block until the result or the failure object exists, returns SUCCESS or FAILURE
+        """
+        event = self.listener.register(output_path, failure_path) if self.listener else None
+        deadline = time.monotonic() + self.timeout
+        try:
+            for delay in self._delays():
+                status = self.check(output_path, failure_path)
+                if status:
+                    return status
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise WaiterTimeoutError(f"no result at {output_path} after {self.timeout}s")
+                if event is not None:
+                    event.wait(min(delay, remaining))
+                else:
+                    time.sleep(min(delay, remaining))
+        finally:
+            if self.listener:
+                self.listener.forget(output_path, failure_path)
+
+    async def await_completion(self, output_path:str, failure_path:Optional[str] = None) -> str:
+        """
+            asyncio version of wait, S3 checks run in a worker thread and the coroutine sleeps in between
+        """
+        future = self.listener.future(output_path, failure_path) if self.listener else None
+        deadline = time.monotonic() + self.timeout
+        try:
+            for delay in self._delays():
+                status = await asyncio.to_thread(self.check, output_path, failure_path)
+                if status:
+                    return status
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise WaiterTimeoutError(f"no result at {output_path} after {self.timeout}s")
+                if future is not None:
+                    try:
+                        return await asyncio.wait_for(asyncio.shield(future), timeout=min(delay, remaining))
+                    except asyncio.TimeoutError:
+                        pass
+                else:
+                    await asyncio.sleep(min(delay, remaining))
+        finally:
+            if self.listener:
+                self.listener.forget(output_path, failure_path)
@@ -0,0 +1,185 @@
+"""
+    docx (and pdf) assembly of a book from files on disk, chapter by chapter:
+
+        assembler = BookAssembler('book.docx', story_title)
+        assembler.add_characters(characters, identity_image_paths)
+        assembler.add_chapter(2, chapter, page_paths)    # any order, kept in chapter order
+        assembler.save()
+        convert_to_pdf('book.docx')                      # LibreOffice headless, or docx2pdf
+
+    every image is read from its path, scaled down to the width it is printed at and recompressed once
+    (cached on disk), and only those small encoded bytes end up in the document. no PIL image outlives
+    the add_* call that reads it, so memory depends on the printed size of the book, not on its source images
+"""
+import os
+import shutil
+import hashlib
+import subprocess
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+from PIL import Image
+from docx import Document
+from docx.shared import Inches
+
+DEFAULT_DPI = 150
+PAGE_WIDTH_INCHES = 6
+PORTRAIT_WIDTH_INCHES = 4
+
+
+class PdfConversionError(Exception):
+    pass
+
+
+class PrintImageCache():
+    """
+        images scaled down to a print width and saved as JPEG under cache_dir, keyed on the source
+        path, its size and mtime and the target width/quality, so each panel is converted once
+    """
+
+    def __init__(self, cache_dir:str = './.image_cache/print', quality:int = 85):
+        self.cache_dir = cache_dir
+        self.quality = quality
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _key(self, path:str, width_px:int) -> str:
+        st = os.stat(path)
+        ident = f"{os.path.abspath(path)}\x00{st.st_size}\x00{st.st_mtime_ns}\x00{width_px}\x00{self.quality}"
+        return hashlib.sha256(ident.encode('utf-8')).hexdigest()
+
+    def get(self, path:str, width_px:int) -> str:
+        """
+            path of the print version of the image, the source itself when it is already narrow enough
+        """
+        cached = os.path.join(self.cache_dir, f"{self._key(path, width_px)}.jpg")
+        if os.path.exists(cached):
+            with self._lock:
+                self.hits += 1
+            return cached
+        with Image.open(path) as img:
+            if img.size[0] <= width_px:
+                return path
+            with self._lock:
+                self.misses += 1
+            img.draft('RGB', (width_px, img.size[1]))
+            height_px = max(1, round(img.size[1] * width_px / img.size[0]))
+            small = img.convert('RGBA') if img.mode in ('P', 'LA') else img
+            if small.mode == 'RGBA':
+                background = Image.new('RGB', small.size, 'white')
+                background.paste(small, mask=small.getchannel('A'))
+                small = background
+            small = small.convert('RGB').resize((width_px, height_px), Image.LANCZOS)
+        tmp = f"{cached}.{threading.get_ident()}.tmp"
+        small.save(tmp, format='JPEG', quality=self.quality, optimize=True)
+        os.replace(tmp, cached)
+        return cached
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+class BookAssembler():
+    """
+        builds the docx of a book incrementally. chapters can be added in any order as they are
+        finished, they are appended to the document in chapter order (a chapter that arrives early only
+        waits as text and paths). images are printed at page_width/portrait_width inches at dpi
+    """
+
+    def __init__(self, fname:str, title:str, dpi:int = DEFAULT_DPI, page_width:float = PAGE_WIDTH_INCHES,
+                 portrait_width:float = PORTRAIT_WIDTH_INCHES, image_cache:Optional[PrintImageCache] = None,
+                 placeholder:Optional[str] = None):
+        self.fname = fname
+        self.dpi = dpi
+        self.page_width = page_width
+        self.portrait_width = portrait_width
+        self.image_cache = image_cache or PrintImageCache()
+        self.placeholder = placeholder
+        self.document = Document()
+        self.document.add_heading(title, 0)
+        self._next_chapter = 0
+        self._waiting: Dict[int, Tuple[object, Sequence[str]]] = {}
+
+    def _add_picture(self, path:str, width_inches:float):
+        self.document.add_picture(self.image_cache.get(path, int(width_inches * self.dpi)), width=Inches(width_inches))
+
+    def add_characters(self, characters, identity_images:Sequence[Optional[str]]):
+        """
+            the characters introduction, identity_images holds the main character's picture then the supporting ones
+        """
+        self.document.add_heading('Characters introduction', level=1)
+        personas = [characters.main_character, *characters.supporting_character]
+        for i, character in enumerate(personas):
+            self.document.add_heading(f"{character.name}", level=2)
+            self.document.add_paragraph(f"Role: {character.role}\nBackground: {character.background}")
+            if i < len(identity_images) and identity_images[i]:
+                self._add_picture(identity_images[i], self.portrait_width)
+
+    def _append(self, chapter, images:Sequence[str]):
+        self.document.add_heading(chapter.chapter_title, level=1)
+        self.document.add_paragraph(chapter.content)
+        if images:
+            for image in images:
+                self._add_picture(image, self.page_width)
+        elif self.placeholder and os.path.exists(self.placeholder):
+            self._add_picture(self.placeholder, self.page_width)
+
+    def add_chapter(self, index:int, chapter, images:Optional[Sequence[str]] = None):
+        """
+            chapter index (from 0) with the paths of its pages, appended once all chapters before it are in
+        """
+        self._waiting[index] = (chapter, list(images or []))
+        while self._next_chapter in self._waiting:
+            self._append(*self._waiting.pop(self._next_chapter))
+            self._next_chapter += 1
+
+    @property
+    def pending(self) -> List[int]:
+        return sorted(self._waiting)
+
+    def save(self) -> str:
+        if self._waiting:
+            raise ValueError(f"chapters {self.pending} wait for chapter {self._next_chapter}")
+        self.document.save(self.fname)
+        print(f'docx file saved as: {self.fname}')
+        return self.fname
+
+
+def _libreoffice() -> Optional[str]:
+    return shutil.which('soffice') or shutil.which('libreoffice')
+
+
+def convert_to_pdf(docx_path:str, pdf_path:Optional[str] = None, backend:str = 'auto', timeout:float = 300) -> str:
+    """
+        docx -> pdf. backend 'libreoffice' runs soffice --headless (works on Linux servers),
+        'docx2pdf' drives Microsoft Word (Windows/macOS only), 'auto' takes LibreOffice when installed
+    """
+    pdf_path = pdf_path or os.path.splitext(docx_path)[0] + '.pdf'
+    if backend == 'auto':
+        backend = 'libreoffice' if _libreoffice() else 'docx2pdf'
+    if backend == 'libreoffice':
+        soffice = _libreoffice()
+        if soffice is None:
+            raise PdfConversionError("LibreOffice (soffice) is not installed")
+        out_dir = os.path.dirname(os.path.abspath(pdf_path))
+        # a private profile dir, so conversions can run next to a desktop LibreOffice or each other
+        profile = f"file://{os.path.join(out_dir, '.lo_profile')}"
+        proc = subprocess.run([soffice, f"-env:UserInstallation={profile}", '--headless', '--convert-to', 'pdf',
+                               '--outdir', out_dir, docx_path], capture_output=True, text=True, timeout=timeout)
+        produced = os.path.join(out_dir, os.path.splitext(os.path.basename(docx_path))[0] + '.pdf')
+        if proc.returncode != 0 or not os.path.exists(produced):
+            raise PdfConversionError(f"soffice failed ({proc.returncode}): {proc.stderr.strip()}")
+        if os.path.abspath(produced) != os.path.abspath(pdf_path):
+            os.replace(produced, pdf_path)
+    elif backend == 'docx2pdf':
+        from docx2pdf import convert
+        try:
+            convert(docx_path, pdf_path)
+        except Exception as err:
+            raise PdfConversionError(f"docx2pdf failed: {err}") from err
+    else:
+        raise ValueError(f"unknown pdf backend {backend!r}, expected 'auto', 'libreoffice' or 'docx2pdf'")
+    print(f'pdf file saved as: {pdf_path}')
+    return pdf_path
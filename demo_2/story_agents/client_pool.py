@@ -0,0 +1,67 @@
+import threading
+import boto3
+from botocore.config import Config
+
+DEFAULT_MAX_POOL_CONNECTIONS = 50
+DEFAULT_MAX_ATTEMPTS = 5
+
+_lock = threading.Lock()
+_session = None
+_clients = {}
+
+
+def build_client_config(max_pool_connections:int = DEFAULT_MAX_POOL_CONNECTIONS,
+                        max_attempts:int = DEFAULT_MAX_ATTEMPTS,
+                        retry_mode:str = 'adaptive',
+                        tcp_keepalive:bool = True,
+                        connect_timeout:int = 10,
+                        read_timeout:int = 120) -> Config:
+    """
+        botocore config shared by all pooled clients:
+        bigger connection pool for concurrent callers, keep-alive sockets and adaptive (client side rate limited) retries
+    """
+    return Config(max_pool_connections=max_pool_connections,
+                  retries={'max_attempts': max_attempts, 'mode': retry_mode},
+                  tcp_keepalive=tcp_keepalive,
+                  connect_timeout=connect_timeout,
+                  read_timeout=read_timeout)
+
+
+def _get_session():
+    global _session
+    if _session is None:
+        _session = boto3.Session()
+    return _session
+
+
+def get_client(service_name:str, region_name:str = None, endpoint_url:str = None, **config_kwargs):
+    """
+        return a process-wide boto3 client, created once per (service, region, endpoint, config).
+        botocore clients are thread safe, boto3 sessions are not, so creation happens under a lock
+    """
+    key = (service_name, region_name, endpoint_url, tuple(sorted(config_kwargs.items())))
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _get_session().client(service_name=service_name,
+                                               region_name=region_name,
+                                               endpoint_url=endpoint_url,
+                                               config=build_client_config(**config_kwargs))
+                _clients[key] = client
+    return client
+
+
+def get_bedrock_runtime_client(region_name:str = None, endpoint_url:str = None, **config_kwargs):
+    return get_client('bedrock-runtime', region_name=region_name, endpoint_url=endpoint_url, **config_kwargs)
+
+
+def clear_client_pool():
+    """
+        drop all pooled clients and the shared session, e.g. after credentials were rotated
+    """
+    global _session
+    with _lock:
+        _clients.clear()
+        _session = None
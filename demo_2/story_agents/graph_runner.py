@@ -0,0 +1,346 @@
+"""
+    run many AgentState graphs (e.g. one write/refine workflow per chapter) concurrently while all
+    LLM calls share one rate limit per Bedrock model id:
+
+        llm = rate_limited(ChatBedrockConverse(model=model_id, ...), requests_per_minute=50, tokens_per_minute=200000)
+        # build the chains / nodes with llm as usual, then
+        chapters = await run_graphs(write_workflow, init_states, node_name='write_chapter', max_concurrency=20)
+"""
+import time
+import random
+import asyncio
+import threading
+from typing import Any, Dict, List, Optional
+from botocore.exceptions import ClientError
+from langchain_core.runnables import Runnable
+from story_agents import telemetry
+
+DEFAULT_REQUESTS_PER_MINUTE = 60
+DEFAULT_TOKENS_PER_MINUTE = 100000
+THROTTLING_CODES = ('ThrottlingException', 'TooManyRequestsException', 'ServiceUnavailableException', 'ModelNotReadyException')
+
+
+class TokenBucket():
+    """
+        token bucket refilled continuously at rate_per_minute, holding at most capacity tokens.
+        thread safe, usable from sync and async code. debit() can push it below zero when a call
+        used more than was reserved, later callers then wait for the refill
+    """
+
+    def __init__(self, rate_per_minute:float, capacity:Optional[float] = None):
+        self.rate_per_minute = rate_per_minute
+        self.capacity = capacity or rate_per_minute
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate_per_minute / 60)
+        self._updated = now
+
+    def _try_take(self, amount:float) -> float:
+        """
+            take amount if available and return 0, otherwise the seconds to wait before trying again
+        """
+        amount = min(amount, self.capacity)
+        with self._lock:
+            self._refill()
+            if self._tokens >= amount:
+                self._tokens -= amount
+                return 0.0
+            return (amount - self._tokens) * 60 / self.rate_per_minute
+
+    def acquire(self, amount:float = 1):
+        while True:
+            wait = self._try_take(amount)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def aacquire(self, amount:float = 1):
+        while True:
+            wait = self._try_take(amount)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def debit(self, amount:float):
+        with self._lock:
+            self._refill()
+            self._tokens -= amount
+
+    def set_rate(self, rate_per_minute:float):
+        with self._lock:
+            self._refill()
+            self.rate_per_minute = rate_per_minute
+
+
+class ModelRateLimiter():
+    """
+        requests/min and tokens/min budget of one model id, shared by every chain that calls it.
+        the effective rate is halved on each throttling error and creeps back up on success (AIMD)
+    """
+
+    def __init__(self, model_id:str, requests_per_minute:float = DEFAULT_REQUESTS_PER_MINUTE,
+                 tokens_per_minute:float = DEFAULT_TOKENS_PER_MINUTE, min_scale:float = 0.1,
+                 burst_seconds:float = 60):
+        self.model_id = model_id
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.min_scale = min_scale
+        self.scale = 1.0
+        # quotas are per minute, burst_seconds < 60 spreads the budget out instead of spending it at once
+        self.requests = TokenBucket(requests_per_minute, capacity=max(1, requests_per_minute * burst_seconds / 60))
+        self.tokens = TokenBucket(tokens_per_minute, capacity=max(1, tokens_per_minute * burst_seconds / 60))
+        self.stats = {'calls': 0, 'throttled': 0, 'input_tokens': 0, 'output_tokens': 0}
+        self._lock = threading.Lock()
+
+    def _apply_scale(self, scale:float):
+        with self._lock:
+            self.scale = scale
+        self.requests.set_rate(self.requests_per_minute * scale)
+        self.tokens.set_rate(self.tokens_per_minute * scale)
+
+    def acquire(self, estimated_tokens:int):
+        self.requests.acquire(1)
+        self.tokens.acquire(estimated_tokens)
+
+    async def aacquire(self, estimated_tokens:int):
+        await self.requests.aacquire(1)
+        await self.tokens.aacquire(estimated_tokens)
+
+    def record(self, estimated_tokens:int, input_tokens:int = 0, output_tokens:int = 0):
+        """
+            settle the reservation with the real usage once the response is in
+        """
+        with self._lock:
+            self.stats['calls'] += 1
+            self.stats['input_tokens'] += input_tokens
+            self.stats['output_tokens'] += output_tokens
+        used = input_tokens + output_tokens
+        if used:
+            self.tokens.debit(used - estimated_tokens)
+        if self.scale < 1.0:
+            self._apply_scale(min(1.0, self.scale + 0.05))
+
+    def on_throttle(self):
+        with self._lock:
+            self.stats['throttled'] += 1
+        self._apply_scale(max(self.min_scale, self.scale * 0.5))
+
+
+_limiters: Dict[str, ModelRateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(model_id:str, requests_per_minute:Optional[float] = None,
+                     tokens_per_minute:Optional[float] = None) -> ModelRateLimiter:
+    """
+        process-wide limiter for model_id. limits left as None take the existing limiter's (or the defaults
+        when it is created), limits that differ from the existing limiter's raise ValueError: one model
+        has one quota, whichever chain asks first
+    """
+    with _limiters_lock:
+        limiter = _limiters.get(model_id)
+        if limiter is None:
+            limiter = _limiters[model_id] = ModelRateLimiter(
+                model_id,
+                DEFAULT_REQUESTS_PER_MINUTE if requests_per_minute is None else requests_per_minute,
+                DEFAULT_TOKENS_PER_MINUTE if tokens_per_minute is None else tokens_per_minute)
+            return limiter
+    for name, asked in (('requests_per_minute', requests_per_minute), ('tokens_per_minute', tokens_per_minute)):
+        if asked is not None and asked != getattr(limiter, name):
+            raise ValueError(f"rate limiter for {model_id} already exists with {name}={getattr(limiter, name)}, "
+                             f"not {asked}")
+    return limiter
+
+
+def is_throttling_error(err:Exception) -> bool:
+    if isinstance(err, ClientError):
+        return err.response.get('Error', {}).get('Code') in THROTTLING_CODES
+    # some integrations re-raise the bedrock error as a plain exception with the code in the text
+    return any(code in str(err) for code in THROTTLING_CODES)
+
+
+def estimate_tokens(text:str) -> int:
+    # ~4 characters per token for English prose, good enough to reserve budget
+    return len(text) // 4 + 1
+
+
+def _prompt_text(prompt) -> str:
+    if hasattr(prompt, 'to_messages'):
+        prompt = prompt.to_messages()
+    if isinstance(prompt, list):
+        parts = []
+        for m in prompt:
+            content = getattr(m, 'content', m)
+            parts.append(content if isinstance(content, str) else str(content))
+        return '\n'.join(parts)
+    return str(prompt)
+
+
+def _usage(message) -> tuple:
+    usage = getattr(message, 'usage_metadata', None) or {}
+    return usage.get('input_tokens', 0), usage.get('output_tokens', 0)
+
+
+class RateLimitedLLM(Runnable):
+    """
+        a chat model behind a ModelRateLimiter, see rate_limited. keyword arguments (stop=...) go through to
+        the model and stream/astream stream through: a throttling error is retried while no chunk has been
+        yielded yet, and the usage of the aggregated chunks settles the reservation
+    """
+
+    def __init__(self, llm, limiter:ModelRateLimiter, name:str, expected_output_tokens:int = 1000,
+                 max_retries:int = 6, base_delay:float = 1.0, max_delay:float = 30.0):
+        self.llm = llm
+        self.limiter = limiter
+        self.name = name
+        self.expected_output_tokens = expected_output_tokens
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def _delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _estimate(self, prompt) -> int:
+        return estimate_tokens(_prompt_text(prompt)) + self.expected_output_tokens
+
+    def _acquire(self, estimated:int):
+        start = time.perf_counter()
+        self.limiter.acquire(estimated)
+        telemetry.add('queue_wait_s', time.perf_counter() - start)
+
+    async def _aacquire(self, estimated:int):
+        start = time.perf_counter()
+        await self.limiter.aacquire(estimated)
+        telemetry.add('queue_wait_s', time.perf_counter() - start)
+
+    def _should_retry(self, err:Exception, attempt:int) -> bool:
+        if attempt < self.max_retries and is_throttling_error(err):
+            self.limiter.on_throttle()
+            telemetry.add('throttled')
+            return True
+        return False
+
+    def invoke(self, input, config=None, **kwargs):
+        estimated = self._estimate(input)
+        for attempt in range(self.max_retries + 1):
+            self._acquire(estimated)
+            try:
+                response = self.llm.invoke(input, config, **kwargs)
+            except Exception as err:
+                if self._should_retry(err, attempt):
+                    time.sleep(self._delay(attempt))
+                    continue
+                raise
+            self.limiter.record(estimated, *_usage(response))
+            return response
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        estimated = self._estimate(input)
+        for attempt in range(self.max_retries + 1):
+            await self._aacquire(estimated)
+            try:
+                response = await self.llm.ainvoke(input, config, **kwargs)
+            except Exception as err:
+                if self._should_retry(err, attempt):
+                    await asyncio.sleep(self._delay(attempt))
+                    continue
+                raise
+            self.limiter.record(estimated, *_usage(response))
+            return response
+
+    def stream(self, input, config=None, **kwargs):
+        estimated = self._estimate(input)
+        for attempt in range(self.max_retries + 1):
+            self._acquire(estimated)
+            message = None
+            try:
+                for chunk in self.llm.stream(input, config, **kwargs):
+                    message = chunk if message is None else message + chunk
+                    yield chunk
+            except Exception as err:
+                if message is None and self._should_retry(err, attempt):
+                    time.sleep(self._delay(attempt))
+                    continue
+                raise
+            finally:
+                # also when the consumer closes the stream early
+                if message is not None:
+                    self.limiter.record(estimated, *_usage(message))
+            return
+
+    async def astream(self, input, config=None, **kwargs):
+        estimated = self._estimate(input)
+        for attempt in range(self.max_retries + 1):
+            await self._aacquire(estimated)
+            message = None
+            try:
+                async for chunk in self.llm.astream(input, config, **kwargs):
+                    message = chunk if message is None else message + chunk
+                    yield chunk
+            except Exception as err:
+                if message is None and self._should_retry(err, attempt):
+                    await asyncio.sleep(self._delay(attempt))
+                    continue
+                raise
+            finally:
+                if message is not None:
+                    self.limiter.record(estimated, *_usage(message))
+            return
+
+
+def rate_limited(llm, model_id:Optional[str] = None, limiter:Optional[ModelRateLimiter] = None,
+                 requests_per_minute:Optional[float] = None,
+                 tokens_per_minute:Optional[float] = None,
+                 expected_output_tokens:int = 1000, max_retries:int = 6,
+                 base_delay:float = 1.0, max_delay:float = 30.0) -> RateLimitedLLM:
+    """
+        wrap a chat model so every call first takes its share of the model's shared rate limit,
+        and throttling errors are retried with jittered exponential backoff while the limiter slows down.
+        drop-in for llm in `prompt | llm | parser`, streaming included.
+        the limits default to the model's existing limiter, see get_rate_limiter
+    """
+    model_id = model_id or getattr(llm, 'model_id', None) or getattr(llm, 'model', None) or 'default'
+    limiter = limiter or get_rate_limiter(model_id, requests_per_minute, tokens_per_minute)
+    return RateLimitedLLM(llm, limiter, f"rate_limited_{model_id}", expected_output_tokens, max_retries,
+                          base_delay, max_delay)
+
+
+async def run_graphs(workflow, init_states:List[Dict[str, Any]], node_name:str, max_concurrency:int = 10,
+                     verbose:bool = False, spill_path:Optional[str] = None) -> List[Optional[Dict[str, Any]]]:
+    """
+        run the compiled workflow once per initial state, at most max_concurrency at a time,
+        and return the last env_var written by node_name for each run in input order.
+        a run that raises returns None. with spill_path every event of every run (tagged with its
+        index) is appended to that JSONL file
+    """
+    # graph_utils imports retry, which imports this module
+    from story_agents.graph_utils import FinalStateReducer, SpillWriter
+    semaphore = asyncio.Semaphore(max_concurrency)
+    spill = SpillWriter(spill_path) if spill_path else None
+
+    async def _run(i, init_state):
+        async with semaphore:
+            reducer = FinalStateReducer(spill, run_id=str(i))
+            try:
+                async for event in workflow.astream(input=init_state):
+                    if verbose:
+                        for key in event:
+                            print(f"[{i}] Output from node '{key}'")
+                    reducer.update(event)
+            except Exception as err:
+                print(f"[{i}] workflow failed: {err}")
+                return None
+            finally:
+                reducer.close()
+            return reducer.env_var(node_name)
+
+    try:
+        return await asyncio.gather(*[_run(i, s) for i, s in enumerate(init_states)])
+    finally:
+        if spill is not None:
+            spill.close()
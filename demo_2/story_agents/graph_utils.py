@@ -1,8 +1,10 @@
+import json
+import time
 import operator
+import threading
 from typing import Annotated, Sequence,Dict,Optional,Any,TypedDict,List
-from langchain_core.pydantic_v1 import ValidationError
 from langchain_core.messages import AIMessage, BaseMessage
-from json import JSONDecodeError
+from story_agents.retry import aretry_invoke, RetryPolicy
 
 class AgentState(TypedDict):
     messages: Annotated[Sequence[BaseMessage], operator.add]
@@ -17,23 +19,121 @@ def get_final_state_env_var(steps:List[Any],node_name:str):
                 answer = s[node_name]['env_var']
     return answer
 
+def _jsonable(obj):
+    # pydantic objects and messages as their fields, classes (output_obj) by name
+    if isinstance(obj, type):
+        return obj.__name__
+    if hasattr(obj, 'dict'):
+        return obj.dict()
+    return str(obj)
+
+
+class SpillWriter():
+    """
+        JSONL file shared by the reducers of concurrent runs: each record is written as one complete
+        line and flushed while the lock is held, so lines of different runs never interleave
+    """
+
+    def __init__(self, path:str):
+        self.path = path
+        self._file = open(path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def write(self, record:Dict[str, Any]):
+        line = json.dumps(record, default=_jsonable, ensure_ascii=False) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FinalStateReducer():
+    """
+        folds the events of workflow.astream / stream ({node: update}) into the latest update of every
+        node as they arrive, instead of collecting them into steps for get_final_state_env_var, so a run
+        keeps one update per node alive rather than all of its intermediate drafts.
+        with spill (a JSONL path, or a SpillWriter shared by concurrent runs) every event is also appended
+        as {"run", "step", "node", "time", "update"} for auditing, and not kept in memory
+    """
+
+    def __init__(self, spill=None, run_id:Optional[str] = None):
+        self.latest: Dict[str, Any] = {}
+        self.env_vars: Dict[str, Dict[str, Any]] = {}
+        self.steps = 0
+        self.run_id = run_id
+        # a writer passed in belongs to the caller, one opened from a path is closed with the reducer
+        self._owns_spill = isinstance(spill, str)
+        self._spill = SpillWriter(spill) if self._owns_spill else spill
+
+    def update(self, event:Dict[str, Any]):
+        self.steps += 1
+        for node, value in event.items():
+            self.latest[node] = value
+            if value and value.get('env_var') is not None:
+                self.env_vars[node] = value['env_var']
+            if self._spill is not None:
+                self._spill.write({"run": self.run_id, "step": self.steps, "node": node, "time": time.time(),
+                                   "update": value})
+
+    def env_var(self, node_name:str) -> Optional[Dict[str, Any]]:
+        """
+            the last env_var node_name wrote, what get_final_state_env_var returns for the collected steps
+        """
+        return self.env_vars.get(node_name)
+
+    def close(self):
+        if self._spill is not None and self._owns_spill:
+            self._spill.close()
+        self._spill = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+async def astream_final_state(workflow, init_state:Dict[str, Any], spill_path:Optional[str] = None,
+                              run_id:Optional[str] = None, config=None) -> FinalStateReducer:
+    """
+        run workflow.astream to the end through a FinalStateReducer and return it
+    """
+    with FinalStateReducer(spill_path, run_id) as reducer:
+        async for event in workflow.astream(input=init_state, config=config):
+            reducer.update(event)
+    return reducer
+
+
+def stream_final_state(workflow, init_state:Dict[str, Any], spill_path:Optional[str] = None,
+                       run_id:Optional[str] = None, config=None) -> FinalStateReducer:
+    with FinalStateReducer(spill_path, run_id) as reducer:
+        for event in workflow.stream(input=init_state, config=config):
+            reducer.update(event)
+    return reducer
+
+
+async def aget_final_env_var(workflow, init_state:Dict[str, Any], node_name:str, spill_path:Optional[str] = None,
+                             run_id:Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """
+        the last env_var of node_name in a run of workflow, without keeping the steps:
+            env_var = await aget_final_env_var(workflow, {"messages": [...], "env_var": {...}}, 'write_chapter')
+    """
+    return (await astream_final_state(workflow, init_state, spill_path, run_id)).env_var(node_name)
+
+
 async def retry_call(chain,args: Dict[str,Any],times:int=5):
     """
-      Retry mechanism to ensure the success rate of final json output 
-    """
-    try:
-        content = await chain.ainvoke(args)
-        return content
-    except JSONDecodeError as e:
-        if times:
-            print(f'JSONDecodeError, retry again [{times}]')
-            return await retry_call(chain,args,times=times-1)
-        else:
-            raise(JSONDecodeError(e))
-    except ValidationError as e:
-        print(e)
-        if times:
-            print(f'ValidationError, retry again [{times}]')
-            return await retry_call(chain,args,times=times-1)
-        else:
-            raise(ValidationError(e))
\ No newline at end of file
+      Retry mechanism to ensure the success rate of final json output.
+      malformed output is repaired locally before the model is called again, throttling and
+      transient errors are retried with backoff, see story_agents.retry
+    """
+    return await aretry_invoke(chain, args, RetryPolicy(max_attempts=times+1))
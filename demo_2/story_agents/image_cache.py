@@ -0,0 +1,169 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+import uuid
+from collections import OrderedDict
+from typing import List, Optional
+
+
+class ImageCache():
+    """
+        content-addressed on-disk cache for generated images.
+        each entry is a list of encoded image bytes stored under a hash of the request,
+        entries are evicted least recently used first once the cache grows past max_bytes.
+        an entry is a directory of 0.png .. n-1.png, written under a temporary name and renamed into place.
+        on start, damaged entries (e.g. left by another tool or a full disk) are moved to .quarantine
+        and files that are not entries are ignored
+    """
+
+    def __init__(self, cache_dir:str = './.image_cache', max_bytes:int = 2*1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.quarantined = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> size in bytes, least recently used first
+        self._total_bytes = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load()
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        """
+            stable hash of the request parts (model id, body, preset, ...), they must be json serializable
+        """
+        payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _entry_dir(self, key:str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    @staticmethod
+    def _entry_size(entry_dir:str) -> Optional[int]:
+        """
+            total bytes of a well-formed entry (0.png .. n-1.png and nothing else), None otherwise
+        """
+        try:
+            files = {e.name: e.stat().st_size for e in os.scandir(entry_dir) if e.is_file(follow_symlinks=False)}
+            count = len(os.listdir(entry_dir))
+        except OSError:
+            return None
+        if not files or count != len(files) or set(files) != {f'{i}.png' for i in range(len(files))}:
+            return None
+        return sum(files.values())
+
+    def _quarantine(self, path:str):
+        quarantine_dir = os.path.join(self.cache_dir, '.quarantine')
+        os.makedirs(quarantine_dir, exist_ok=True)
+        try:
+            os.replace(path, os.path.join(quarantine_dir, f'{os.path.basename(path)}-{uuid.uuid4().hex[:8]}'))
+        except OSError:
+            return
+        self.quarantined += 1
+
+    def _load(self):
+        # rebuild the LRU order from the entry directories' mtime, which get() refreshes on every hit
+        found = []
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if len(prefix) != 2 or prefix.startswith('.') or not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                entry_dir = os.path.join(prefix_dir, key)
+                if key.startswith('.tmp'):
+                    shutil.rmtree(entry_dir, ignore_errors=True)
+                    continue
+                size = self._entry_size(entry_dir) if key[:2] == prefix else None
+                if size is None:
+                    self._quarantine(entry_dir)
+                    continue
+                found.append((os.stat(entry_dir).st_mtime, key, size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._total_bytes += size
+
+    def get(self, key:str) -> Optional[List[bytes]]:
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+        entry_dir = self._entry_dir(key)
+        try:
+            names = sorted(os.listdir(entry_dir), key=lambda n: int(n.split('.')[0]))
+            images = []
+            for name in names:
+                with open(os.path.join(entry_dir, name), 'rb') as f:
+                    images.append(f.read())
+            os.utime(entry_dir)
+        except (OSError, ValueError):
+            # entry was removed or damaged behind our back
+            with self._lock:
+                self._total_bytes -= self._entries.pop(key, 0)
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return images
+
+    def put(self, key:str, images:List[bytes]):
+        tmp_dir = self._tmp_dir(key)
+        for i, data in enumerate(images):
+            with open(os.path.join(tmp_dir, f'{i}.png'), 'wb') as f:
+                f.write(data)
+        self._commit(key, tmp_dir, sum(len(data) for data in images))
+
+    def put_files(self, key:str, paths:List[str]):
+        """
+            like put, but copies images that are already on disk instead of holding them in memory
+        """
+        tmp_dir = self._tmp_dir(key)
+        for i, path in enumerate(paths):
+            shutil.copyfile(path, os.path.join(tmp_dir, f'{i}.png'))
+        self._commit(key, tmp_dir, sum(os.path.getsize(path) for path in paths))
+
+    def _tmp_dir(self, key:str) -> str:
+        tmp_dir = os.path.join(os.path.dirname(self._entry_dir(key)), f'.tmp{uuid.uuid4().hex}')
+        os.makedirs(tmp_dir)
+        return tmp_dir
+
+    def _commit(self, key:str, tmp_dir:str, size:int):
+        # os.replace of a directory only succeeds when the target is missing (or an empty directory),
+        # a complete entry is never overwritten or seen half written
+        try:
+            os.replace(tmp_dir, self._entry_dir(key))
+        except OSError:
+            # another thread stored the same request first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        with self._lock:
+            self._entries[key] = size
+            self._total_bytes += size
+            evicted = []
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                old_key, old_size = self._entries.popitem(last=False)
+                self._total_bytes -= old_size
+                evicted.append(old_key)
+        for old_key in evicted:
+            shutil.rmtree(self._entry_dir(old_key), ignore_errors=True)
+
+    def clear(self):
+        with self._lock:
+            keys = list(self._entries)
+            self._entries.clear()
+            self._total_bytes = 0
+        for key in keys:
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'entries': len(self._entries),
+                    'bytes': self._total_bytes,
+                    'quarantined': self.quarantined}
@@ -8,11 +8,15 @@ from botocore.exceptions import ClientError
 from enum import Enum
 from io import BytesIO
 import sagemaker
-from typing import Any, List
+from typing import Any, List, Optional, Tuple
 from langchain_core.pydantic_v1 import BaseModel, Field
 import os
-from sagemaker.async_inference.waiter_config import WaiterConfig
 import time
+import uuid
+import hashlib
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from sagemaker.predictor_async import AsyncPredictor
 from sagemaker.serializers import JSONSerializer
 from sagemaker.deserializers import JSONDeserializer
@@ -20,6 +24,14 @@ from sagemaker.predictor import Predictor
 from docx import Document
 from docx.shared import Inches
 from docx2pdf import convert
+from story_agents.client_pool import get_client, get_bedrock_runtime_client, DEFAULT_MAX_POOL_CONNECTIONS
+from story_agents.async_waiter import BackoffWaiter, SqsCompletionListener, FAILURE, get_bucket_and_key
+from story_agents.image_cache import ImageCache
+from story_agents.result_stream import iter_base64_images, write_base64_images
+from story_agents.reference_images import ReferenceImageStore, default_reference_store
+from story_agents.book_assembler import BookAssembler, PrintImageCache
+from story_agents.image_writer import BatchImageWriter, encode_image, content_name
+from story_agents import telemetry
 
 class StyleEnum(Enum):
     Photographic = "photographic"
@@ -39,6 +51,16 @@ class ImageError(Exception):
         self.message = message
 
 
+_image_executor = None
+
+def _get_image_executor():
+    # the default asyncio executor only has cpu_count+4 workers, size ours like the client connection pool
+    global _image_executor
+    if _image_executor is None:
+        _image_executor = ThreadPoolExecutor(max_workers=DEFAULT_MAX_POOL_CONNECTIONS, thread_name_prefix='image-gen')
+    return _image_executor
+
+
 class ImageGenerator(BaseModel):
     """
         invoke SDXL model in a Amaozn Bedrock to generate identity images
@@ -48,30 +70,45 @@ class ImageGenerator(BaseModel):
     cfg_scale: int = Field( default=7)
     steps:int = Field( default=50)
     samples:int = Field( default=1)
+    region_name: Optional[str] = Field(default=None)
+    endpoint_url: Optional[str] = Field(default=None)
+    max_pool_connections: int = Field(default=DEFAULT_MAX_POOL_CONNECTIONS)
+    cache: Optional[Any] = Field(default=None, description="optional ImageCache, seeds are deterministic so identical requests are served from disk")
+    client: Optional[Any] = Field(default=None, description="bedrock-runtime client to use instead of the pooled one, e.g. bench.fakes.FakeBedrockRuntimeClient")
+
+    def _get_client(self, timeout:Optional[float] = None):
+        if self.client is not None:
+            return self.client
+        # reuse the pooled bedrock-runtime client instead of building a session per image
+        config_kwargs = {'read_timeout': timeout} if timeout else {}
+        return get_bedrock_runtime_client(region_name=self.region_name,
+                                          endpoint_url=self.endpoint_url,
+                                          max_pool_connections=self.max_pool_connections,
+                                          **config_kwargs)
     
-    def _generate(self,model_id, body):
+    def _generate(self,model_id, body, timeout=None):
         """
         Generate an image using SDXL 1.0 on demand.
         Args:
             model_id (str): The model ID to use.
             body (str) : The request body to use.
+            timeout (float) : read timeout in seconds for this request, None for the client default.
         Returns:
             image_bytes (bytes): The image generated by the model.
         """
 
         # logger.info("Generating image with SDXL model %s", model_id)
 
-        session = boto3.Session()
-        #get bedrock service 
-        bedrock = session.client(service_name='bedrock-runtime')
+        bedrock = self._get_client(timeout)
     
         accept = "application/json"
         content_type = "application/json"
 
-        response = bedrock.invoke_model(
-            body=body, modelId=model_id, accept=accept, contentType=content_type
-        )
-        response_body = json.loads(response.get("body").read())
+        with telemetry.span('bedrock.image', model=model_id) as span:
+            response = bedrock.invoke_model(
+                body=body, modelId=model_id, accept=accept, contentType=content_type
+            )
+            response_body = json.loads(response.get("body").read())
         
         if model_id.startswith("stability"):
             base64_image = response_body.get("artifacts")[0].get("base64")
@@ -91,12 +128,13 @@ class ImageGenerator(BaseModel):
 
             if finish_reason is not None:
                 raise ImageError(f"Image generation error. Error is {finish_reason}")
+        span.add('bytes', len(image_bytes))
 
         print(f"Successfully generated image with model {model_id}")
 
         return image_bytes
 
-    def generate_image( self,prompt,seed=0,style_preset=StyleEnum.Photographic.value):
+    def generate_image( self,prompt,seed=0,style_preset=StyleEnum.Photographic.value,timeout=None):
         if self.model_id.startswith('stability'):
             body=json.dumps({
                 "text_prompts": [
@@ -127,11 +165,21 @@ class ImageGenerator(BaseModel):
             }
             })
         print(body)
+        cache_key = None
+        if self.cache is not None:
+            # body carries prompt, seed and dimensions
+            cache_key = ImageCache.make_key(self.model_id, body, style_preset)
+            cached = self.cache.get(cache_key)
+            if cached:
+                return Image.open(io.BytesIO(cached[0]))
         image= None
         try:
             image_bytes=self._generate(model_id = self.model_id,
-                                    body = body)
+                                    body = body,
+                                    timeout = timeout)
             image = Image.open(io.BytesIO(image_bytes))
+            if cache_key:
+                self.cache.put(cache_key, [image_bytes])
 
         except ClientError as err:
             message=err.response["Error"]["Message"]
@@ -143,7 +191,66 @@ class ImageGenerator(BaseModel):
             print(err)
         finally:
             return image
-        
+
+    def generate_images_batch(self, prompts:List[str], seeds:Optional[List[int]] = None,
+                              style_preset=StyleEnum.Photographic.value,
+                              max_concurrency:int = 4, timeout:Optional[float] = None) -> list:
+        """
+            render many prompts concurrently on a thread pool.
+            results keep the order of prompts, failed items and items not done timeout seconds after
+            they started are None
+        """
+        seeds = [0]*len(prompts) if seeds is None else seeds
+        if len(seeds) != len(prompts):
+            raise ValueError(f"got {len(prompts)} prompts but {len(seeds)} seeds")
+        with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(prompts)))) as executor:
+            futures = [executor.submit(self._generate_image_within, prompt, seed, style_preset, timeout)
+                       for prompt, seed in zip(prompts, seeds)]
+            return [f.result() for f in futures]
+
+    def _generate_image_within(self, prompt, seed, style_preset, timeout):
+        # the read timeout does not bound retries or a slow trickle of bytes, so hold a wall-clock
+        # deadline too. a call past it is abandoned to the shared pool, its result is dropped
+        if timeout is None:
+            return self.generate_image(prompt, seed, style_preset, timeout)
+        future = _get_image_executor().submit(self.generate_image, prompt, seed, style_preset, timeout)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            print(f"Image generation timed out after {timeout}s, seed {seed}")
+            return None
+
+    async def agenerate_image(self, prompt, seed=0, style_preset=StyleEnum.Photographic.value, timeout=None):
+        """
+            async version of generate_image, the blocking bedrock call runs in a shared thread pool.
+            timeout is both the read timeout of the request and a wall-clock deadline, a call
+            that misses it returns None
+        """
+        loop = asyncio.get_running_loop()
+        call = functools.partial(self.generate_image, prompt, seed, style_preset, timeout)
+        try:
+            return await asyncio.wait_for(loop.run_in_executor(_get_image_executor(), call), timeout)
+        except asyncio.TimeoutError:
+            print(f"Image generation timed out after {timeout}s, seed {seed}")
+            return None
+
+    async def agenerate_images_batch(self, prompts:List[str], seeds:Optional[List[int]] = None,
+                                     style_preset=StyleEnum.Photographic.value,
+                                     max_concurrency:int = 4, timeout:Optional[float] = None) -> list:
+        """
+            async fan-out of agenerate_image with at most max_concurrency calls in flight, ordered results
+        """
+        seeds = [0]*len(prompts) if seeds is None else seeds
+        if len(seeds) != len(prompts):
+            raise ValueError(f"got {len(prompts)} prompts but {len(seeds)} seeds")
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def _run(prompt, seed):
+            async with semaphore:
+                return await self.agenerate_image(prompt, seed, style_preset, timeout)
+
+        return await asyncio.gather(*[_run(prompt, seed) for prompt, seed in zip(prompts, seeds)])
+
 
 
 
@@ -154,27 +261,18 @@ def save_image_file(image, filename, folder):
     print(f"image saved in {os.path.join(folder, filename)}")
 
 
-def save_all_images(images,folder='./images'):
-    img_fnames = []
-    for i,img in enumerate(images):
-        fname = str(i)+'.png'
-        if img:
-            save_image_file(img,fname,folder)
-            img_fnames.append(os.path.join(folder, fname))
-        else:
-            img_fnames.append(None)
-    return img_fnames
-
-def save_all_images_names(images:list,file_names:list,folder:str ='./images'):
-    img_fnames = []
-    for img,fname in zip(images,file_names):
-        fname =fname +'.png'
-        if img:
-            save_image_file(img,fname,folder)
-            img_fnames.append(os.path.join(folder, fname))
-        else:
-            img_fnames.append(None)
-    return img_fnames
+def save_all_images(images,folder='./images', preset:str = 'png'):
+    """
+        saved as 0.png, 1.png, ... (None stays None), encoded in parallel, see story_agents.image_writer
+    """
+    return save_all_images_names(images, [str(i) for i in range(len(images))], folder, preset)
+
+def save_all_images_names(images:list,file_names:list,folder:str ='./images', preset:str = 'png', executor='process'):
+    """
+        encode and write the images in parallel, see BatchImageWriter for the executor choices
+    """
+    with BatchImageWriter(folder, preset=preset, executor=executor, verbose=True) as writer:
+        return writer.write(images, file_names)
 
 
 def base64_to_image(base64_string):
@@ -192,42 +290,49 @@ def Image2base64(img_path):
     base64_encoded_string = base64.b64encode(image_data).decode('utf-8')
     return base64_encoded_string
 
-def get_bucket_and_key(s3uri):
-    pos = s3uri.find("/", 5)
-    bucket = s3uri[5:pos]
-    key = s3uri[pos + 1 :]
-    return bucket, key
-
 class StoryDiffusionGenerator():
     """
         invoke storydiffusion model hosted in a SageMaker endpoint to generate consistant images
     """
     
-    def __init__(self,endpoint_name):
-        endpoint_name = endpoint_name
-        # boto_session= boto3.Session(profile_name=profile)
-        boto_session= boto3.Session()
-        self.s3_resource = boto_session.resource("s3")
-        sagemaker_session = sagemaker.Session(boto_session = boto_session)
-        bucket  = sagemaker_session.default_bucket()
-        output_path  = "s3://{0}/{1}/asyncinvoke/out/".format(bucket, "story-diffusion")
-        input_path :str = "s3://{0}/{1}/asyncinvoke/in/".format(bucket, "story-diffusion")
-        
-        predictor_ = Predictor(
-            endpoint_name=endpoint_name,
-            sagemaker_session=sagemaker_session,
-            model_data_input_path=input_path,
-            model_data_output_path=output_path,
-        )
-        predictor_.serializer = JSONSerializer()
-        predictor_.deserializer = JSONDeserializer()
-        self.config = WaiterConfig(
-            max_attempts=100, delay=10  #  number of attempts  #  time in seconds to wait between attempts
-        )
-        self.predictor_async = AsyncPredictor(
-                predictor_,
-                name='story-diffusion'
-        )
+    def __init__(self,endpoint_name, cache:Optional[ImageCache] = None, waiter:Optional[BackoffWaiter] = None,
+                 sqs_queue_url:Optional[str] = None, predictor_async=None, s3_client=None,
+                 reference_store:Optional[ReferenceImageStore] = None):
+        """
+            waiter: how to wait for async results, defaults to a BackoffWaiter polling S3.
+            sqs_queue_url: queue subscribed to the endpoint's SNS success/error topics, ends waits on notification.
+            predictor_async / s3_client: injected stand-ins (see bench.fakes), skips the SageMaker setup
+            reference_store: the store the ref_imgs come from, its digests key the cache
+        """
+        self.endpoint_name = endpoint_name
+        self.cache = cache
+        self.reference_store = reference_store or default_reference_store
+        self.s3_client = s3_client or get_client("s3")
+        if predictor_async is None:
+            # boto_session= boto3.Session(profile_name=profile)
+            boto_session= boto3.Session()
+            sagemaker_session = sagemaker.Session(boto_session = boto_session)
+            bucket  = sagemaker_session.default_bucket()
+            output_path  = "s3://{0}/{1}/asyncinvoke/out/".format(bucket, "story-diffusion")
+            input_path :str = "s3://{0}/{1}/asyncinvoke/in/".format(bucket, "story-diffusion")
+            
+            predictor_ = Predictor(
+                endpoint_name=endpoint_name,
+                sagemaker_session=sagemaker_session,
+                model_data_input_path=input_path,
+                model_data_output_path=output_path,
+            )
+            predictor_.serializer = JSONSerializer()
+            predictor_.deserializer = JSONDeserializer()
+            predictor_async = AsyncPredictor(
+                    predictor_,
+                    name='story-diffusion'
+            )
+        self.predictor_async = predictor_async
+        if waiter is None:
+            listener = SqsCompletionListener(get_client("sqs"), sqs_queue_url) if sqs_queue_url else None
+            waiter = BackoffWaiter(self.s3_client, listener=listener)
+        self.waiter = waiter
     
     def generate_real_identity_images(self,prompt:str, general_prompt:str = '', height:int = 768, width :int = 768):
         images = self.generate_images(general_prompt = general_prompt,
@@ -241,8 +346,25 @@ class StoryDiffusionGenerator():
             if img.size[0] < 1024:
                 return img
         return None
-        
-    def generate_images(self,general_prompt:str,prompt_array:str,id_length:int=2, ref_imgs: List[Any]= [],comic_type:str='Classic Comic Style', style:str = 'Japanese Anime',sd_type:str="Unstable", height:int = 768, width :int = 768) -> list:
+
+    async def agenerate_real_identity_images(self,prompt:str, general_prompt:str = '', height:int = 768, width :int = 768,
+                                             output_dir:Optional[str] = None):
+        """
+            async version of generate_real_identity_images
+        """
+        images = await self.agenerate_images(general_prompt = general_prompt,
+                                             style="Photographic",
+                                             comic_type = "Classic Comic Style",
+                                             prompt_array=prompt,
+                                             id_length= 0,
+                                             sd_type = "Unstable",
+                                             ref_imgs=[],height=height,width=width,output_dir=output_dir)
+        for img in images:
+            if img.size[0] < 1024:
+                return img
+        return None
+
+    def _build_request(self,general_prompt:str,prompt_array:str,id_length:int=2, ref_imgs: List[Any]= [],comic_type:str='Classic Comic Style', style:str = 'Japanese Anime',sd_type:str="Unstable", height:int = 768, width :int = 768):
         data = { "general_prompt": general_prompt,
                         "prompt_array" : prompt_array,
                         "style" : style,
@@ -255,30 +377,129 @@ class StoryDiffusionGenerator():
                 }
         if not ref_imgs:
             del data['files']
-        # print(data)
-        prediction = self.predictor_async.predict_async(data)
-        print(f"Response output path: {prediction.output_path}")
-        start = time.time()
-        prediction.get_result(self.config)
-        print(f"Time taken: {time.time() - start}s")
-        
+        cache_key = None
+        if self.cache is not None:
+            # reference images are large base64 strings, key on the store's digest of them instead
+            digests = [self.reference_store.get_digest(img) or hashlib.sha256(img.encode('utf-8')).hexdigest()
+                       for img in ref_imgs]
+            key_data = {**data, "files": digests}
+            cache_key = ImageCache.make_key(self.endpoint_name, key_data)
+        return data, cache_key
+
+    def _read_result(self, status:str, prediction, cache_key:Optional[str], output_dir:Optional[str] = None) -> list:
+        if status == FAILURE:
+            failure_bucket, failure_key = get_bucket_and_key(prediction.failure_path)
+            with telemetry.span('s3.get') as span:
+                message = self.s3_client.get_object(Bucket=failure_bucket, Key=failure_key)["Body"].read().decode("utf-8")
+                span.add('bytes', len(message))
+            raise ImageError(f"StoryDiffusion inference failed: {message}")
         output_bucket, output_key = get_bucket_and_key(prediction.output_path)
-        output_obj = self.s3_resource.Object(output_bucket, output_key)
-        body = output_obj.get()["Body"].read().decode("utf-8")
-        
-        respobj = json.loads(body)
+        with telemetry.span('s3.get') as span:
+            response = self.s3_client.get_object(Bucket=output_bucket, Key=output_key)
+            span.add('bytes', response.get('ContentLength') or 0)
+            return self._decode_result(response["Body"], output_key, cache_key, output_dir)
+
+    @staticmethod
+    def _cached_images(cached:List[bytes], cache_key:str, output_dir:Optional[str]) -> list:
+        if not output_dir:
+            return [Image.open(BytesIO(img_bytes)) for img_bytes in cached]
+        # the cached PNG bytes as they are, named after the request like a fresh result is after its output key.
+        # replaced atomically, an image opened from an earlier hit on the same request keeps its file
+        os.makedirs(output_dir, exist_ok=True)
+        fnames = []
+        for i, img_bytes in enumerate(cached):
+            fname = os.path.join(output_dir, f"cached_{cache_key[:16]}_{i}.png")
+            tmp = f"{fname}.{uuid.uuid4().hex}.tmp"
+            with open(tmp, 'wb') as f:
+                f.write(img_bytes)
+            os.replace(tmp, fname)
+            fnames.append(fname)
+        return [Image.open(fname) for fname in fnames]
+
+    def _decode_result(self, body, output_key:str, cache_key:Optional[str], output_dir:Optional[str]) -> list:
+        # images_base64 is parsed incrementally from the body stream, one decoded image at a time
+        if output_dir:
+            prefix = os.path.splitext(os.path.basename(output_key))[0]
+            fnames = list(write_base64_images(body, output_dir, prefix=prefix))
+            if cache_key:
+                self.cache.put_files(cache_key, fnames)
+            # Image.open only reads the header, pixels are loaded when first used
+            return [Image.open(fname) for fname in fnames]
+
+        images_bytes = list(iter_base64_images(body))
+        if cache_key:
+            self.cache.put(cache_key, images_bytes)
         images = []
-        for img in respobj['images_base64']:
-            images.append(base64_to_image(img))
+        for img_bytes in images_bytes:
+            images.append(Image.open(BytesIO(img_bytes)))
             
         return images
+        
+    def generate_images(self,general_prompt:str,prompt_array:str,id_length:int=2, ref_imgs: List[Any]= [],comic_type:str='Classic Comic Style', style:str = 'Japanese Anime',sd_type:str="Unstable", height:int = 768, width :int = 768, output_dir:Optional[str] = None) -> list:
+        """
+            output_dir: write the PNG bytes straight to this folder and return lazily opened images
+        """
+        data, cache_key = self._build_request(general_prompt, prompt_array, id_length, ref_imgs, comic_type, style, sd_type, height, width)
+        if cache_key:
+            cached = self.cache.get(cache_key)
+            if cached:
+                return self._cached_images(cached, cache_key, output_dir)
+        # print(data)
+        with telemetry.span('storyd', endpoint=self.endpoint_name) as span:
+            prediction = self.predictor_async.predict_async(data)
+            print(f"Response output path: {prediction.output_path}")
+            start = time.time()
+            status = self.waiter.wait(prediction.output_path, prediction.failure_path)
+            print(f"Time taken: {time.time() - start}s")
+            span.add('endpoint_wait_s', time.time() - start)
+            return self._read_result(status, prediction, cache_key, output_dir)
+
+    async def agenerate_images(self,general_prompt:str,prompt_array:str,id_length:int=2, ref_imgs: List[Any]= [],comic_type:str='Classic Comic Style', style:str = 'Japanese Anime',sd_type:str="Unstable", height:int = 768, width :int = 768, output_dir:Optional[str] = None) -> list:
+        """
+            async version of generate_images, no thread is held while the endpoint works,
+            so many chapters can be in flight at once
+        """
+        data, cache_key = self._build_request(general_prompt, prompt_array, id_length, ref_imgs, comic_type, style, sd_type, height, width)
+        if cache_key:
+            cached = await asyncio.to_thread(self.cache.get, cache_key)
+            if cached:
+                return await asyncio.to_thread(self._cached_images, cached, cache_key, output_dir)
+        with telemetry.span('storyd', endpoint=self.endpoint_name) as span:
+            prediction = await asyncio.to_thread(self.predictor_async.predict_async, data)
+            print(f"Response output path: {prediction.output_path}")
+            start = time.time()
+            status = await self.waiter.await_completion(prediction.output_path, prediction.failure_path)
+            print(f"Time taken: {time.time() - start}s")
+            span.add('endpoint_wait_s', time.time() - start)
+            return await asyncio.to_thread(self._read_result, status, prediction, cache_key, output_dir)
     
 
+TAG_PATTERN = re.compile(r"\[(.*?)\]")
+
+def tokenize_tags(text:str) -> List[Tuple[str,int,int]]:
+    """
+        (tag, start, end) for every [tag] in text, the span includes the brackets
+    """
+    return [(m.group(1), m.start(), m.end()) for m in TAG_PATTERN.finditer(text)]
+
+
+class TagIndex():
+    """
+        the [tag] records of every line of a chapter's story lines, tokenized once.
+        counting, identity substitution and id length calculation all read from here
+    """
+    def __init__(self, text:str):
+        self.lines = text.split("\n")
+        self.records = [tokenize_tags(line) for line in self.lines]
+        self.tags = {tag for records in self.records for tag,_,_ in records}
+
+
 # each story line will send to storydiffusion model to create a comic, count the characters in each line and add crespondant ref images
-def count_character_names(character_names,line):
+def count_character_names(character_names,line,tags=None):
+    tags = TagIndex(line).tags if tags is None else tags
     name_counter = {}
     for name in character_names:
-        if f"[{name}]" in line:
+        if name in tags:
             if name in name_counter:
                 name_counter[name] += 1
             else:
@@ -286,70 +507,80 @@ def count_character_names(character_names,line):
     return name_counter if name_counter else {'[NC]':1}
 
 
-#https://github.com/HVision-NKU/StoryDiffusion/blob/main/utils/gradio_utils.py
-# convert character list to dict
-def character_to_dict(general_prompt):
-    character_dict = {}    
-    generate_prompt_arr = general_prompt.splitlines()
-    character_index_dict = {}
-    invert_character_index_dict = {}
-    character_list = []
-    for ind,string in enumerate(generate_prompt_arr):
-        # 分割字符串寻找key和value
-        start = string.find('[')
-        end = string.find(']')
-        if start != -1 and end != -1:
-            key = string[start:end+1]
-            value = string[end+1:]
+@functools.lru_cache(maxsize=1024)
+def _parse_general_prompt(general_prompt:str) -> Tuple[Tuple[str,str],...]:
+    character_items = []
+    seen = set()
+    for string in general_prompt.splitlines():
+        records = tokenize_tags(string)
+        if records:
+            _, start, end = records[0]
+            key = string[start:end]
+            value = string[end:]
             if "#" in value:
                 value =  value.rpartition('#')[0] 
-            if key in character_dict:
+            if key in seen:
                 raise Exception("duplicate character descirption: " + key)
-            character_dict[key] = value
-            character_list.append(key)
+            seen.add(key)
+            character_items.append((key, value))
+    return tuple(character_items)
 
-        
-    return character_dict 
 
-def calc_id_length_prompt(general_prompt,prompts):
-    character_dict = character_to_dict(general_prompt)
-    replace_prompts = []
-    character_index_dict = {}
-    invert_character_index_dict = {}
-    for ind,prompt in enumerate(prompts):
-        for key in character_dict.keys():
-            if key in prompt:
-                if key not in character_index_dict:
-                    character_index_dict[key] = []
-                character_index_dict[key].append(ind)
-                if ind not in invert_character_index_dict:
-                    invert_character_index_dict[ind] = []
-                invert_character_index_dict[ind].append(key)
-        cur_prompt = prompt
-        if ind in invert_character_index_dict:
-            for key in invert_character_index_dict[ind]:
-                cur_prompt = cur_prompt.replace(key,character_dict[key])
-        replace_prompts.append(cur_prompt)
-    # print(replace_prompts)
-    ref_index_dict = {}
-    ref_totals = []
-    # print(character_index_dict)
+#https://github.com/HVision-NKU/StoryDiffusion/blob/main/utils/gradio_utils.py
+# convert character list to dict
+def character_to_dict(general_prompt):
+    # the parsed general prompt is memoized, the same figures come back for many chapters
+    return dict(_parse_general_prompt(general_prompt))
+
+
+def _calc_id_length(character_keys:List[str], prompt_keys:List[set]) -> int:
+    """
+        the smallest number of prompts in which a character appears alone, over the characters
+        that appear at all. prompt_keys holds the "[tag]" keys present in each prompt
+    """
+    character_set = set(character_keys)
+    present = [keys & character_set for keys in prompt_keys]
     id_length = 999
-    for character_key in character_index_dict.keys():
-        if character_key not in character_index_dict:
-            raise Exception("{} not have prompt description, please remove it".format(character_key))
-        index_list = character_index_dict[character_key]
-        # print(invert_character_index_dict)
-        index_list = [index for index in index_list if len(invert_character_index_dict[index]) == 1]
-        # print(f'{character_key}:',index_list)
-        id_length = len(index_list) if len(index_list) < id_length else id_length
-        # if len(index_list) < id_length:
-        #     raise Exception(f"{character_key} not have enough prompt description, need no less than {id_length}, but you give {len(index_list)}")
-        ref_index_dict[character_key] = index_list[:id_length]
-        ref_totals = ref_totals + index_list[:id_length]
+    for character_key in character_keys:
+        appears = False
+        solo = 0
+        for keys in present:
+            if character_key in keys:
+                appears = True
+                solo += len(keys) == 1
+        if appears:
+            id_length = solo if solo < id_length else id_length
     return id_length
+
+
+def calc_id_length_prompt(general_prompt,prompts):
+    prompt_keys = [{f"[{tag}]" for tag,_,_ in tokenize_tags(prompt)} for prompt in prompts]
+    return _calc_id_length(list(character_to_dict(general_prompt).keys()), prompt_keys)
+
+
+def _substitute_tags(text:str, records, replace:dict) -> str:
+    """
+        rebuild text in one pass, record i is replaced by replace[i]
+    """
+    if not replace:
+        return text
+    parts = []
+    pos = 0
+    for i, (_, start, end) in enumerate(records):
+        if i in replace:
+            parts.append(text[pos:start])
+            parts.append(replace[i])
+            pos = end
+    parts.append(text[pos:])
+    return ''.join(parts)
+
     
-def generate_img_dicts(characters):
+def generate_img_dicts(characters, store:Optional[ReferenceImageStore] = None, folder:str = './images'):
+    """
+        reference image per character name, taken from the portraits in folder.
+        the store memoizes the encoding so repeated calls don't re-read unchanged files
+    """
+    store = store or default_reference_store
     character_names = [characters.main_character.name]
     name_figure_map = {characters.main_character.name:characters.main_character.figure}
     
@@ -363,7 +594,7 @@ def generate_img_dicts(characters):
     imgs = {}
     for key in list(name_figure_map.keys()):
         if key not in imgs :
-            imgs[key] = Image2base64(f'./images/{key}.png')
+            imgs[key] = store.get_reference(os.path.join(folder, f'{key}.png'))
     return imgs
 
     
@@ -380,114 +611,89 @@ def prepare_storyd_prompts(story_lines,characters,img_dicts):
         character_names += [ch.name]
         name_figure_map[ch.name] = ch.figure
         
-    # count character names in each line
-    name_counters = []
-    for line in story_lines:
-        name_counters.append(count_character_names(character_names,line))
-    # print('name_counters:',name_counters)
     # generate prompt for each line
-    args = []
-    for name_counter,line in zip(name_counters,story_lines):
-        # id_length = len(list(name_counter.keys()))
+    for line in story_lines:
+        # tokenize once, count character names in the line from the index
+        index = TagIndex(line)
+        name_counter = count_character_names(character_names,line,tags=index.tags)
+        counted = list(name_counter.keys())
+        counted_set = set(counted)
+        # the model cannot generate one image with more than 2 character identities
+        primary = set(counted[:2])
+
         ref_imgs = []
         figures = []
-        for key in list(name_counter.keys()):
+        for key in counted:
             if key != '[NC]':
                 ref_imgs.append(img_dicts[key])
                 figures.append(f"[{key}] {name_figure_map[key]} img")
             else:
                 figures.append(f"[NC]")
-                
-        prompt_array = line.split("\n")
 
-        # the model cannot generate one image with more than 2 character identities
         prompt_array_new = []
-        pattern = r"\[(.*?)\]"
-        for text in prompt_array:
-            new_prompt = text
-            match = re.findall(pattern, text)
-            # check if the identity is in the first two of character dict
-            if match and match[0] != 'NC' and match[0] not in list(name_counter.keys())[:2]:
-                new_prompt = new_prompt.replace(f"[{match[0]}]",name_figure_map[key],1) 
-                print(match[0], name_figure_map.keys(), name_counter.keys(),text,new_prompt)
-
-            match = re.findall(pattern, new_prompt)
-            if match and len(match) > 1:
-                for k in match[1:]:
-                    if k != 'NC' and k in list(name_counter.keys()): 
-                        new_prompt = new_prompt.replace(f"[{k}]",name_figure_map[k]) 
-
-            new_prompt = new_prompt if new_prompt.startswith('[NC]') else new_prompt
-
-            match = re.findall(pattern, new_prompt)
-            if not match:# if there is no bracket in the prompt line, it has to be add [NC]
-                new_prompt = '[NC]' + new_prompt 
+        prompt_keys = []
+        for text, records in zip(index.lines, index.records):
+            replace = {}
+            # check if the identity is in the first two of character dict, otherwise use its figure instead
+            if records and records[0][0] != 'NC' and records[0][0] not in primary:
+                tag = records[0][0]
+                replace[0] = name_figure_map.get(tag, tag)
+            remaining = [i for i in range(len(records)) if i not in replace]
+            # more identities in the line, the extra known characters are described by their figure
+            if len(remaining) > 1:
+                extra = {records[i][0] for i in remaining[1:] if records[i][0] != 'NC' and records[i][0] in counted_set}
+                for i in remaining:
+                    if records[i][0] in extra:
+                        replace[i] = name_figure_map[records[i][0]]
+
+            new_prompt = _substitute_tags(text, records, replace)
+            kept = [records[i][0] for i in remaining if i not in replace]
+            if not kept:# if there is no bracket in the prompt line, it has to be add [NC]
+                new_prompt = '[NC]' + new_prompt
+                kept = ['NC']
             
             prompt_array_new.append(new_prompt +'#' + text )# the text after # becomes caption 
+            prompt_keys.append({f"[{tag}]" for tag in kept} | {f"[{tag}]" for tag,_,_ in records})
 
         # calc id length
         general_prompt = '\n'.join(figures[:2]) #can only accept the first 2 figures currently, need to update in future              
 
         id_length = 2
         # add extral prompt for identity in case have enough prompt description for identity
-        prompt_array_new = [f.replace(' img','') for f in figures[:id_length]] + prompt_array_new
+        identity_prompts = [f.replace(' img','') for f in figures[:id_length]]
+        prompt_array_new = identity_prompts + prompt_array_new
+        prompt_keys = [{f"[{tag}]" for tag,_,_ in tokenize_tags(p)} for p in identity_prompts] + prompt_keys
 
         #re calc again after the prompt changed
-        id_length = calc_id_length_prompt(general_prompt, prompt_array_new)
+        id_length = _calc_id_length(list(character_to_dict(general_prompt).keys()), prompt_keys)
         id_length = 2 if id_length > 2 else id_length
-        # print(prompt_array_new)    
         
         # now the model can only support max 2 ref images in general prompt
-        # args.append({'prompt_array':prompt_array_new,'id_length':id_length,'ref_imgs':ref_imgs[:2],'general_prompt':general_prompt})
         yield({'prompt_array':prompt_array_new,'id_length':id_length,'ref_imgs':ref_imgs[:2],'general_prompt':general_prompt})
-    # return args
     
     
 
 
 def save_image( image, folder='./images') -> str:
-    """Save the image to a temporary file and return the file path."""
-    image_path = f"temp_{hash(image.tobytes())}.png"
-    filename = os.path.join(folder,image_path)
-    image.save(filename)
+    """Save the image to a temporary file and return the file path, named by a hash of the png bytes."""
+    data = encode_image(image, 'png')
+    filename = os.path.join(folder, f"temp_{content_name(data)}.png")
+    with open(filename, 'wb') as f:
+        f.write(data)
     return filename
 
-def save_as_docx(characters,story, fname, suffix='_refined'):
-    document = Document()
-    document.add_heading(story.story_title, 0)
-    document.add_heading('Characters introduction', level=1)
-    character = characters.main_character
-    document.add_heading(f"{character.name}", level=2)
-    document.add_paragraph(f"Role: {character.role}\nBackground: {character.background}")
-    document.add_picture(story.identity_images[0], width=Inches(4))
-    for character,id_img in zip(characters.supporting_character,story.identity_images):
-        document.add_heading(f"{character.name}", level=2)
-        document.add_paragraph(f"Role: {character.role}\nBackground: {character.background}")
-        document.add_picture(id_img, width=Inches(4))
-
-    img_idx = 0
-    for chapter in story.chapters:
-        document.add_heading(chapter.chapter_title, level=1)
-        para = chapter
-        print(para)
-        images = story.images[img_idx]
-        img_idx += 1
-        document.add_paragraph(para.content)
-
-        # Add the image
-        if images:
-            [document.add_picture(image, width=Inches(6)) for image in images] 
-        else:
-            document.add_picture('placeholder.png', width=Inches(6))
-
-    # Save the document
-    document.save(fname)
-    print(f'docx file saved as: {fname}')
+def save_as_docx(characters,story, fname, suffix='_refined', image_cache:Optional[PrintImageCache] = None):
+    """
+        story.identity_images and story.images hold image paths (the pages of each chapter),
+        they are scaled down to their print width once, see story_agents.book_assembler
+    """
+    assembler = BookAssembler(fname, story.story_title, image_cache=image_cache, placeholder='placeholder.png')
+    assembler.add_characters(characters, story.identity_images)
+    for i, chapter in enumerate(story.chapters):
+        assembler.add_chapter(i, chapter, story.images[i] if i < len(story.images) else None)
+    assembler.save()
     
-    #Convert the Word document to PDF
-    # pdf_path = f"{fname}.pdf"
-    # convert(fname, pdf_path)
-    # print(f'pdf file saved as: {pdf_path}')
+    #Convert the Word document to PDF, see book_assembler.convert_to_pdf
 
 
 
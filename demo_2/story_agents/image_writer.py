@@ -0,0 +1,132 @@
+"""
+    batch image saving: encoding runs in a process (or thread) pool, files are named by a short hash of
+    the encoded bytes unless names are given, and the format comes from a preset:
+
+        with BatchImageWriter('./images', preset='webp', thumbnail=(256, 256)) as writer:
+            paths = writer.write(images)            # ['./images/3f9c1a2b7d4e5f60.webp', ...]
+            writer.thumbnails                       # same order, './images/thumbs/3f9c....webp'
+
+    images can be PIL images or paths of images on disk (read by the worker, nothing is copied to it)
+"""
+import os
+import io
+import hashlib
+import tempfile
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from PIL import Image
+
+# format, file extension and encoder settings per preset
+PRESETS: Dict[str, Dict[str, Any]] = {
+    'png': {'format': 'PNG', 'ext': 'png', 'params': {'compress_level': 6}},
+    'png_fast': {'format': 'PNG', 'ext': 'png', 'params': {'compress_level': 1}},
+    'webp': {'format': 'WEBP', 'ext': 'webp', 'params': {'quality': 80, 'method': 4}},
+    'webp_small': {'format': 'WEBP', 'ext': 'webp', 'params': {'quality': 60, 'method': 4}},
+    'webp_lossless': {'format': 'WEBP', 'ext': 'webp', 'params': {'lossless': True, 'quality': 80, 'method': 4}},
+    'jpeg': {'format': 'JPEG', 'ext': 'jpg', 'params': {'quality': 90, 'optimize': True, 'progressive': True}},
+    'jpeg_small': {'format': 'JPEG', 'ext': 'jpg', 'params': {'quality': 75, 'optimize': True, 'progressive': True}},
+}
+THUMBNAIL_DIR = 'thumbs'
+
+
+def content_name(data:bytes) -> str:
+    """
+        16 hex chars of blake2b over the encoded file, much less data than the raw bitmap
+    """
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+
+def encode_image(image:Image.Image, preset:str = 'png') -> bytes:
+    spec = PRESETS[preset]
+    if spec['format'] == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, format=spec['format'], **spec['params'])
+    return buffer.getvalue()
+
+
+def _write(path:str, data:bytes):
+    # a unique temporary name per call, two threads or processes writing the same path never share it
+    f = tempfile.NamedTemporaryFile(dir=os.path.dirname(path) or '.', prefix=f".{os.path.basename(path)}.",
+                                    suffix='.tmp', delete=False)
+    try:
+        with f:
+            f.write(data)
+        os.replace(f.name, path)
+    except BaseException:
+        if os.path.exists(f.name):
+            os.unlink(f.name)
+        raise
+
+
+def _encode_and_write(image, folder:str, name:Optional[str], preset:str,
+                      thumbnail:Optional[Tuple[int, int]]) -> Tuple[str, Optional[str]]:
+    # runs in the worker, image is a PIL image or a path
+    if isinstance(image, str):
+        with Image.open(image) as img:
+            img.load()
+            image = img
+    data = encode_image(image, preset)
+    ext = PRESETS[preset]['ext']
+    path = os.path.join(folder, f"{name or content_name(data)}.{ext}")
+    _write(path, data)
+    thumb_path = None
+    if thumbnail:
+        thumb = image.copy()
+        thumb.thumbnail(thumbnail)
+        thumb_path = os.path.join(folder, THUMBNAIL_DIR, os.path.basename(path))
+        _write(thumb_path, encode_image(thumb, preset))
+    return path, thumb_path
+
+
+class BatchImageWriter():
+    """
+        writes lists of images to folder with the given preset (see PRESETS), encoding in parallel.
+        executor is 'process' (default, encoding does not hold the caller's GIL), 'thread', or an
+        Executor to share. use as a context manager or call close()
+    """
+
+    def __init__(self, folder:str = './images', preset:str = 'png', thumbnail:Optional[Tuple[int, int]] = None,
+                 executor='process', max_workers:Optional[int] = None, verbose:bool = False):
+        if preset not in PRESETS:
+            raise ValueError(f"unknown preset {preset!r}, expected one of {sorted(PRESETS)}")
+        self.folder = folder
+        self.preset = preset
+        self.thumbnail = thumbnail
+        self.verbose = verbose
+        self.thumbnails: List[Optional[str]] = []
+        os.makedirs(folder, exist_ok=True)
+        if thumbnail:
+            os.makedirs(os.path.join(folder, THUMBNAIL_DIR), exist_ok=True)
+        self._owns_executor = not isinstance(executor, Executor)
+        if executor == 'process':
+            executor = ProcessPoolExecutor(max_workers=max_workers)
+        elif executor == 'thread':
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.executor = executor
+
+    def write(self, images:Sequence[Any], names:Optional[Sequence[Optional[str]]] = None) -> List[Optional[str]]:
+        """
+            paths in input order, None for a None image. names (without extension) replace the content hash
+        """
+        names = list(names) if names is not None else [None] * len(images)
+        futures = [self.executor.submit(_encode_and_write, img, self.folder, name, self.preset, self.thumbnail)
+                   if img is not None else None for img, name in zip(images, names)]
+        paths, self.thumbnails = [], []
+        for future in futures:
+            path, thumb = future.result() if future is not None else (None, None)
+            if self.verbose and path:
+                print(f"image saved in {path}")
+            paths.append(path)
+            self.thumbnails.append(thumb)
+        return paths
+
+    def close(self):
+        if self._owns_executor:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,26 +1,170 @@
 import os
 import json
 import re
+import time
+import asyncio
+import itertools
+import threading
+from collections import Counter, OrderedDict
+from typing import ClassVar, Dict, List, Optional, Sequence, Tuple
 from langchain_core.output_parsers.base import BaseOutputParser
 from langchain_core.runnables import RunnableLambda
 from langchain_core.pydantic_v1 import BaseModel, Field
 from json import JSONDecodeError
 from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, ToolMessage
+from story_agents import telemetry
+
+_SPECIAL = re.compile(r'["\\\r]')
+_VALID_ESCAPES = '"\\/bfnrtu'
+# json syntax that may follow a real closing quote: ':', a closing bracket, the end, or a ',' followed
+# by the next key / element / a trailing comma's bracket. a quote followed by prose is part of the text
+_CLOSES_STRING = re.compile(r'\s*(?:[:}\]]|$|,\s*(?:["{\[\]}\-0-9]|true\b|false\b|null\b|$))')
+
+
+def _quote_closes_string(text:str, pos:int) -> bool:
+    """
+        whether the quote just before pos ends the json string (He said "hello", and left -> False)
+    """
+    return _CLOSES_STRING.match(text, pos) is not None
+
 
 def preprocess_answer_json(raw_text):
-    content = raw_text.replace('\n', ' ')  # 移除换行符
-    content = content.replace('\r', '')   # 移除回车符
-    content = content.replace('\t', ' ')  # 替换制表符为空格
-    
-    # 处理转义字符
-    content = content.replace('\\"', '"')  # 替换 \" 为 "
-    content = content.replace('\\', '\\\\')  # 替换单个 \ 为 \\
-    
-    # 确保引号正确配对
-    content = re.sub(r'(?<!\\)"', '\\"', content)  # 转义未转义的引号
-    content = content.replace('\\"', '"')  # 恢复正确的引号
-    return content
-    
+    """
+        make the json text of a model answer loadable in one pass over its quotes and backslashes:
+        quotes inside strings that do not end the string are escaped, over-escaped newlines (\\\\n)
+        become \\n, invalid escapes are fixed and carriage returns dropped. valid escapes are kept and
+        text outside strings is not touched. raw newlines/tabs inside strings are left for
+        json.loads(..., strict=False), which keeps them as they are
+    """
+    out = []
+    last = 0
+    skip_to = 0
+    in_string = False
+    for m in _SPECIAL.finditer(raw_text):
+        i = m.start()
+        if i < skip_to:
+            continue
+        c = raw_text[i]
+        if not in_string:
+            if c == '"':
+                in_string = True
+            continue
+        if c == '"':
+            if _quote_closes_string(raw_text, i + 1):
+                in_string = False
+            else:
+                out.append(raw_text[last:i])
+                out.append('\\"')
+                last = i + 1
+        elif c == '\\':
+            j = i
+            while j < len(raw_text) and raw_text[j] == '\\':
+                j += 1
+            nxt = raw_text[j] if j < len(raw_text) else ''
+            run = j - i
+            if nxt == 'n' and run > 1:
+                out.append(raw_text[last:i])
+                out.append('\\n')
+                last = skip_to = j + 1
+            elif run % 2 == 0:
+                skip_to = j
+            elif nxt in _VALID_ESCAPES and nxt:
+                skip_to = j + 1
+            else:
+                out.append(raw_text[last:j-1])
+                # \' is not a json escape, anything else keeps its backslash as a literal one
+                out.append('' if nxt == "'" else '\\\\')
+                last = skip_to = j
+        else:
+            # \r\n -> \n
+            out.append(raw_text[last:i])
+            last = i + 1
+    if not out:
+        return raw_text
+    out.append(raw_text[last:])
+    return ''.join(out)
+
+
+def load_answer_json(text:str):
+    """
+        json.loads for the content of a ```json block: well-formed answers go straight to the C decoder,
+        everything else (or anything with over-escaped backslashes) through preprocess_answer_json first
+    """
+    if '\\\\' not in text:
+        try:
+            return json.loads(text)
+        except JSONDecodeError:
+            pass
+    return json.loads(preprocess_answer_json(text), strict=False)
+
+
+def repair_json(raw_text:str):
+    """
+        lenient json loader for model output that json.loads rejects: takes the ```json block (or the
+        first {...}), escapes raw newlines and stray quotes inside strings, drops trailing commas and
+        closes a truncated tail. raises JSONDecodeError when nothing usable is left
+    """
+    match = re.search(r"```json(.*?)(?:```|$)", raw_text, re.DOTALL)
+    text = match.group(1) if match else raw_text
+    start = min([i for i in (text.find('{'), text.find('[')) if i != -1], default=-1)
+    if start == -1:
+        raise JSONDecodeError("no json object found", raw_text, 0)
+    text = text[start:]
+    try:
+        return json.loads(text, strict=False)
+    except JSONDecodeError:
+        pass
+
+    out = []
+    stack = []
+    in_string = False
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if in_string:
+            if c == '\\' and i + 1 < len(text):
+                out.append(text[i:i+2])
+                i += 2
+                continue
+            if c == '"':
+                # a quote only closes the string when json syntax follows it, otherwise it is part of the text
+                if _quote_closes_string(text, i + 1):
+                    in_string = False
+                    out.append(c)
+                else:
+                    out.append('\\"')
+            elif c == '\n':
+                out.append('\\n')
+            elif c == '\r':
+                pass
+            elif c == '\t':
+                out.append('\\t')
+            else:
+                out.append(c)
+        else:
+            if c == '"':
+                in_string = True
+                out.append(c)
+            elif c in '{[':
+                stack.append('}' if c == '{' else ']')
+                out.append(c)
+            elif c in '}]':
+                while out and out[-1] in (',', ' ', '\n', '\t', '\r'):
+                    out.pop()
+                if stack:
+                    out.append(stack.pop())
+                if not stack:
+                    break
+            else:
+                out.append(c)
+        i += 1
+    if in_string:
+        out.append('"')
+    while out and out[-1] in (',', ':', ' ', '\n', '\t', '\r'):
+        out.pop()
+    out.extend(reversed(stack))
+    return json.loads(''.join(out), strict=False)
+
 
 
 def dict_to_obj(json_str:dict, target:object):
@@ -29,6 +173,9 @@ def dict_to_obj(json_str:dict, target:object):
 
 class CustJsonOuputParser(BaseOutputParser[str]): 
     verbose :bool = Field( default=True)
+    # the answer is complete once the fence closes (see early_stop_llm). no stop sequence, ``` also opens the fence
+    delimiters: ClassVar[Tuple[str, str]] = ('```json', '```')
+    stop_sequences: ClassVar[Tuple[str, ...]] = ()
 
     def parse(self, text: str) -> str:
         if self.verbose:
@@ -37,12 +184,10 @@ class CustJsonOuputParser(BaseOutputParser[str]):
         match = re.search(pattern, text, re.DOTALL)
         if match:
             text = match.group(1)
-            text = re.sub(r'(?:\\+)n', '\n', text)
         else:
             return {}    
-        text = preprocess_answer_json(text)
-        new_dict = json.loads(text)
-        
+        new_dict = load_answer_json(text)
+
         return new_dict
 
     @property
@@ -50,7 +195,15 @@ class CustJsonOuputParser(BaseOutputParser[str]):
         return "cust_output_parser"
 
 class TextOuputParser(BaseOutputParser[str]): 
+    """
+        the text between <answer> and </answer>, JSONDecodeError without one. with allow_unclosed an answer
+        without </answer> runs to the end of the text, for models called with stop=['</answer>'] directly
+        (early_stop_llm puts the stop sequence back itself)
+    """
     verbose :bool = Field( default=True)
+    allow_unclosed :bool = Field( default=False)
+    delimiters: ClassVar[Tuple[str, str]] = ('<answer>', '</answer>')
+    stop_sequences: ClassVar[Tuple[str, ...]] = ('</answer>',)
 
     def parse(self, text: str) -> str:
         if self.verbose:
@@ -60,13 +213,211 @@ class TextOuputParser(BaseOutputParser[str]):
         if match:
             text = match.group(1)
             return text.strip()
+        start = text.find('<answer>')
+        if self.allow_unclosed and start != -1:
+            return text[start + len('<answer>'):].strip()
         else:
-            raise JSONDecodeError
+            raise JSONDecodeError("no <answer> block found", text, 0)
 
     @property
     def _type(self) -> str:
         return "TextOuputParser"
     
+_early_stop_stats = Counter()
+_early_stop_lock = threading.Lock()
+
+
+def early_stop_stats() -> Dict[str, float]:
+    """
+        counters of early_stop_llm: calls, early_stops (the stream was closed at the delimiter),
+        discarded_chars (streamed after the delimiter), stop_sequences (the model stopped at the closing
+        delimiter, which was put back) and seconds.
+        measured_calls, measured_tail_chars and measured_tail_seconds: the commentary after the answer of the
+        early stops that were read to the end (see measure_every). from those, saved_chars_per_call,
+        saved_tokens_per_call and saved_seconds_per_call estimate what one early stop skips, and saved_tokens
+        and saved_seconds what all of them skipped (the measured calls paid for their tokens)
+    """
+    with _early_stop_lock:
+        stats = dict(_early_stop_stats)
+    measured = stats.get('measured_calls', 0)
+    if measured:
+        chars = stats['measured_tail_chars'] / measured
+        stats['saved_chars_per_call'] = chars
+        stats['saved_tokens_per_call'] = chars / 4
+        stats['saved_seconds_per_call'] = stats['measured_tail_seconds'] / measured
+        stats['saved_tokens'] = stats['saved_tokens_per_call'] * (stats.get('early_stops', 0) - measured)
+        stats['saved_seconds'] = stats['saved_seconds_per_call'] * stats.get('early_stops', 0)
+    return stats
+
+
+def reset_early_stop_stats():
+    with _early_stop_lock:
+        _early_stop_stats.clear()
+
+
+def _content_text(content) -> str:
+    if isinstance(content, list):
+        return ''.join(block.get('text', '') if isinstance(block, dict) else str(block) for block in content)
+    return content if isinstance(content, str) else str(content)
+
+
+class AnswerEnd():
+    """
+        feed() streamed text, returns the offset just past the closing delimiter once it follows the
+        opening one, else -1. only the new text is searched
+    """
+
+    def __init__(self, delimiters:Tuple[str, str]):
+        self.open, self.close = delimiters
+        self.text = ''
+        self._opened = False
+        self._pos = 0
+
+    def feed(self, piece:str) -> int:
+        self.text += piece
+        if not self._opened:
+            found = self.text.find(self.open, self._pos)
+            if found == -1:
+                self._pos = max(0, len(self.text) - len(self.open) + 1)
+                return -1
+            self._opened = True
+            self._pos = found + len(self.open)
+        found = self.text.find(self.close, self._pos)
+        if found == -1:
+            self._pos = max(self._pos, len(self.text) - len(self.close) + 1)
+            return -1
+        return found + len(self.close)
+
+
+def _stop_reason(chunk, reason:Optional[str]) -> Optional[str]:
+    metadata = getattr(chunk, 'response_metadata', None) or {}
+    return metadata.get('stopReason') or metadata.get('stop_reason') or metadata.get('finish_reason') or reason
+
+
+def _early_stop_message(scanner:AnswerEnd, end:int, usage, start:float, stop:Sequence[str],
+                        reason:Optional[str]) -> AIMessage:
+    restored = False
+    if end == -1 and scanner.close in stop and scanner._opened and reason in (None, 'stop_sequence'):
+        # the model stopped at the closing delimiter, which it does not return: put it back for the parser.
+        # not when it ran out of tokens or ended on its own
+        end = scanner.feed(scanner.close)
+        restored = True
+    text = scanner.text
+    stopped = end != -1 and not restored
+    with _early_stop_lock:
+        _early_stop_stats['calls'] += 1
+        _early_stop_stats['seconds'] += time.perf_counter() - start
+        if restored:
+            _early_stop_stats['stop_sequences'] += 1
+        if stopped:
+            _early_stop_stats['early_stops'] += 1
+            _early_stop_stats['discarded_chars'] += len(text) - end
+    if stopped:
+        telemetry.add('early_stops')
+        text = text[:end]
+    return AIMessage(content=text, usage_metadata=usage,
+                     response_metadata={'early_stop': stopped, 'stop_sequence': restored, 'stop_reason': reason})
+
+
+def _record_tail(chars:int, seconds:float):
+    with _early_stop_lock:
+        _early_stop_stats['measured_calls'] += 1
+        _early_stop_stats['measured_tail_chars'] += chars
+        _early_stop_stats['measured_tail_seconds'] += seconds
+
+
+def _drain(stream, read:int, since:float):
+    # the rest of a closed early stop's stream, in the background once the answer has been returned
+    try:
+        for chunk in stream:
+            read += len(_content_text(getattr(chunk, 'content', chunk)))
+    except Exception:
+        return
+    finally:
+        stream.close()
+    _record_tail(read, time.perf_counter() - since)
+
+
+async def _adrain(stream, read:int, since:float):
+    try:
+        async for chunk in stream:
+            read += len(_content_text(getattr(chunk, 'content', chunk)))
+    except Exception:
+        return
+    finally:
+        await stream.aclose()
+    _record_tail(read, time.perf_counter() - since)
+
+
+_drain_tasks = set()
+
+
+def early_stop_llm(llm, parser:BaseOutputParser, stop_sequences:bool = True, measure_every:int = 20):
+    """
+        streaming drop-in for llm in `prompt | llm | parser`: passes the parser's stop sequences to the model
+        (</answer> for TextOuputParser, put back at the end of the answer so the parser sees a closed block)
+        and closes the stream as soon as the parser's closing delimiter arrives (the ``` after ```json for
+        CustJsonOuputParser), so the commentary models write after their answer is neither waited for nor
+        paid for:
+
+            chain = prompt | early_stop_llm(llm, CustJsonOuputParser()) | CustJsonOuputParser()
+
+        returns an AIMessage with the text up to the delimiter. a model that stops streaming early reports
+        no usage, traced_llm then estimates the tokens from the text.
+        every measure_every-th early stop (0: none) still reads the rest of its stream in the background,
+        after its answer was returned, to measure what the others save (see early_stop_stats)
+    """
+    stop = list(parser.stop_sequences) if stop_sequences else []
+    kwargs = {'stop': stop} if stop else {}
+    early_stops = itertools.count(1)
+
+    def _measure(end:int) -> bool:
+        return end != -1 and measure_every > 0 and next(early_stops) % measure_every == 0
+
+    def _invoke(prompt, config):
+        scanner, end, usage, reason, start = AnswerEnd(parser.delimiters), -1, None, None, time.perf_counter()
+        stream = llm.stream(prompt, config, **kwargs)
+        measure = False
+        try:
+            for chunk in stream:
+                usage = getattr(chunk, 'usage_metadata', None) or usage
+                reason = _stop_reason(chunk, reason)
+                end = scanner.feed(_content_text(getattr(chunk, 'content', chunk)))
+                if end != -1:
+                    break
+            measure = _measure(end)
+        finally:
+            if measure:
+                threading.Thread(target=_drain, args=(stream, len(scanner.text) - end, time.perf_counter()),
+                                 daemon=True).start()
+            else:
+                stream.close()
+        return _early_stop_message(scanner, end, usage, start, stop, reason)
+
+    async def _ainvoke(prompt, config):
+        scanner, end, usage, reason, start = AnswerEnd(parser.delimiters), -1, None, None, time.perf_counter()
+        stream = llm.astream(prompt, config, **kwargs)
+        measure = False
+        try:
+            async for chunk in stream:
+                usage = getattr(chunk, 'usage_metadata', None) or usage
+                reason = _stop_reason(chunk, reason)
+                end = scanner.feed(_content_text(getattr(chunk, 'content', chunk)))
+                if end != -1:
+                    break
+            measure = _measure(end)
+        finally:
+            if measure:
+                task = asyncio.ensure_future(_adrain(stream, len(scanner.text) - end, time.perf_counter()))
+                _drain_tasks.add(task)
+                task.add_done_callback(_drain_tasks.discard)
+            else:
+                await stream.aclose()
+        return _early_stop_message(scanner, end, usage, start, stop, reason)
+
+    return RunnableLambda(_invoke, afunc=_ainvoke, name='early_stop_llm')
+
+
 def convert_message_name(message:BaseMessage):
     if isinstance(message, AIMessage) and message.name:
         return AIMessage(content=f"{message.name} : {message.content}")
@@ -75,34 +426,118 @@ def convert_message_name(message:BaseMessage):
     else:
         return message
 
-##merge the continouse roles, and change sequences 
-def reconstruct_to_claude_messages(messages):
-    rec_messages = []
-    for message in messages:
+def _role(message:BaseMessage) -> str:
+    return 'assistant' if isinstance(message, AIMessage) else 'user'
+
+
+def _last_text(content) -> str:
+    return content[-1]['text'] if isinstance(content, list) else content
+
+
+class RoleView():
+    """
+        one agent's perspective on a growing message log: AIMessages of other agents become HumanMessages
+        (swap_roles, skipped when name is None) and, with merge, consecutive messages of the same role are
+        joined with the speaker names inlined (reconstruct_to_claude_messages). each call only processes
+        the messages appended since the previous one. the log must only grow by appending, like
+        AgentState.messages does: a log that does not continue the last one seen rebuilds the view.
+        the returned list belongs to the view, it changes on the next call and must not be modified
+    """
+    __slots__ = ('name', 'merge', 'messages', '_first', '_last', '_seen')
+
+    def __init__(self, name:Optional[str], merge:bool = False):
+        self.name = name
+        self.merge = merge
+        self.reset()
+
+    def reset(self):
+        self.messages: List[BaseMessage] = []
+        self._first = self._last = None
+        self._seen = 0
+
+    def _append(self, message:BaseMessage):
+        if self.name is not None and isinstance(message, AIMessage) and message.name != self.name:
+            message = HumanMessage(**message.dict(exclude={"type"}))
+        if not self.merge:
+            self.messages.append(message)
+            return
+        rec = self.messages
         message = convert_message_name(message)
-        if rec_messages:
-            if isinstance(rec_messages[0], AIMessage):
-                rec_messages[0] = HumanMessage(content=rec_messages[0].content)
-            last_msg = rec_messages[-1]
-            last_role = 'assistant' if isinstance(last_msg,AIMessage) else 'user'
-            current_role = 'assistant' if isinstance(message,AIMessage) else 'user'
-            if last_role == current_role:
-                last_msg_content = last_msg.content[-1]['text'] if isinstance(last_msg.content,list) else last_msg.content
-                current_msg_content = message.content[-1]['text'] if isinstance(message.content, list) else message.content
-                new_content = last_msg_content +"\n\n" + current_msg_content
-                rec_messages[-1] = HumanMessage(content=new_content) if last_role == 'user' else AIMessage(content=new_content)
-            else:
-                rec_messages.append(message)
+        if not rec:
+            rec.append(message)
+            return
+        if len(rec) == 1 and isinstance(rec[0], AIMessage):
+            # the conversation has to start with the user
+            rec[0] = HumanMessage(content=rec[0].content)
+        role = _role(rec[-1])
+        if role == _role(message):
+            content = _last_text(rec[-1].content) + "\n\n" + _last_text(message.content)
+            rec[-1] = HumanMessage(content=content) if role == 'user' else AIMessage(content=content)
         else:
-            rec_messages.append(message)
-    return rec_messages
+            rec.append(message)
 
-def swap_roles(messages, name: str):
-    converted = []
-    for message in messages:
-        if isinstance(message, AIMessage) and message.name != name:
-            message = HumanMessage(**message.dict(exclude={"type"}))
-        converted.append(message)
-    return  converted
+    def extends(self, messages:Sequence[BaseMessage]) -> bool:
+        """
+            whether messages continues the log of the previous call
+        """
+        seen = self._seen
+        return bool(seen and len(messages) >= seen and messages[0] is self._first and messages[seen - 1] is self._last)
 
+    def __call__(self, messages:Sequence[BaseMessage]) -> List[BaseMessage]:
+        seen = self._seen
+        if not self.extends(messages):
+            self.reset()
+            seen = 0
+        for i in range(seen, len(messages)):
+            self._append(messages[i])
+        if messages:
+            self._first, self._last = messages[0], messages[-1]
+        self._seen = len(messages)
+        return self.messages
 
+
+MAX_ROLE_VIEWS = 512
+_role_views: "OrderedDict[tuple, RoleView]" = OrderedDict()
+# keys seen once, only ids: a view is kept from the second call on the same conversation
+_role_view_candidates: "OrderedDict[tuple, None]" = OrderedDict()
+_role_views_lock = threading.Lock()
+
+
+def role_view(messages:Sequence[BaseMessage], name:Optional[str], merge:bool = False) -> List[BaseMessage]:
+    """
+        swap_roles(messages, name) (then reconstruct_to_claude_messages with merge) from a RoleView kept
+        per conversation (its first message), agent and merge flag, so calling it on every turn of a
+        growing log (AgentState.messages) costs O(new messages). lists built anew on every call (e.g. a
+        ConversationMemory view) are converted once and not kept. a kept view's list is shared with
+        the view, copy it to modify it
+    """
+    if not messages:
+        return []
+    key = (id(messages[0]), name, merge)
+    with _role_views_lock:
+        view = _role_views.get(key)
+        if view is not None and view.extends(messages):
+            _role_views.move_to_end(key)
+            return view(messages)
+        if view is None and key in _role_view_candidates:
+            del _role_view_candidates[key]
+            view = _role_views[key] = RoleView(name, merge)
+            if len(_role_views) > MAX_ROLE_VIEWS:
+                _role_views.popitem(last=False)
+            return view(messages)
+        # a new conversation, or a list that does not continue the kept one
+        _role_views.pop(key, None)
+        _role_view_candidates[key] = None
+        _role_view_candidates.move_to_end(key)
+        if len(_role_view_candidates) > MAX_ROLE_VIEWS:
+            _role_view_candidates.popitem(last=False)
+    return RoleView(name, merge)(messages)
+
+
+##merge the continouse roles, and change sequences
+def reconstruct_to_claude_messages(messages):
+    return list(RoleView(None, merge=True)(messages))
+
+
+def swap_roles(messages, name: str):
+    return list(role_view(messages, name))
@@ -0,0 +1,209 @@
+"""
+    bounded history for the AgentState loops (outline <-> characters, write <-> refine), which append
+    every draft and every review to state["messages"] and used to send all of them back on each turn:
+
+        memory = ConversationMemory(token_budget=6000)
+        memory = ConversationMemory(token_budget={'write_chapter': 8000, 'refine_chapter': 3000})   # per node
+        async def write_chapter(state):
+            messages = role_view(await memory.aview(state["messages"], 'write_chapter'), 'cartoonist')
+
+    a view keeps the first message (the task) and the latest message of every speaker (the latest draft
+    and the latest suggestions) verbatim. the turns before those are folded into a rolling summary that is
+    appended to the task message. summaries are cached per prefix of the conversation, so each turn only
+    summarises the messages folded since the previous one. state["messages"] itself is never changed,
+    the edges keep counting its AIMessages for max_turns
+"""
+import hashlib
+import threading
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+from langchain_core.messages import BaseMessage
+from story_agents import telemetry
+from story_agents.graph_runner import estimate_tokens
+
+SUMMARY_HEADER = "Summary of the earlier turns of this conversation:"
+SUMMARY_PROMPT = """Here is the summary of a conversation so far:
+<summary>
+{summary}
+</summary>
+Extend it with these newer turns, in at most {max_words} words. Keep every decision, request and open \
+issue, drop wording and repeated content. Output only the summary.
+<turns>
+{turns}
+</turns>"""
+
+
+def _text(message:BaseMessage) -> str:
+    content = message.content
+    if isinstance(content, str):
+        return content
+    return '\n'.join(block.get('text', '') if isinstance(block, dict) else str(block) for block in content)
+
+
+def _speaker(message:BaseMessage) -> str:
+    return message.name or message.type
+
+
+def extractive_summary(summary:str, messages:Sequence[BaseMessage], max_chars:int = 300) -> str:
+    """
+        the default summariser, no model call: one line per folded message with its speaker and its opening
+    """
+    lines = [summary] if summary else []
+    for m in messages:
+        text = ' '.join(_text(m).split())
+        lines.append(f"- {_speaker(m)}: {text[:max_chars]}{'...' if len(text) > max_chars else ''}")
+    return '\n'.join(lines)
+
+
+def llm_summarizer(llm, max_words:int = 200):
+    """
+        summariser for ConversationMemory that asks llm to extend the rolling summary with the new turns
+    """
+    from langchain_core.output_parsers import StrOutputParser
+    from langchain_core.prompts import ChatPromptTemplate
+    chain = ChatPromptTemplate.from_messages([("user", SUMMARY_PROMPT)]) | llm | StrOutputParser()
+
+    def _args(summary, messages):
+        turns = '\n\n'.join(f"{_speaker(m)}: {_text(m)}" for m in messages)
+        return {"summary": summary or "(empty)", "turns": turns, "max_words": max_words}
+
+    async def _asummarize(summary, messages):
+        return (await chain.ainvoke(_args(summary, messages))).strip()
+
+    def _summarize(summary, messages):
+        return chain.invoke(_args(summary, messages)).strip()
+
+    _summarize.asummarize = _asummarize
+    return _summarize
+
+
+class ConversationMemory():
+    """
+        builds the bounded views. summarizer(summary, new_messages) -> summary extends the rolling summary
+        (extractive_summary by default, llm_summarizer(llm) for a model written one; an async version is
+        used from aview when it has an `asummarize` attribute). with token_budget the summary is cut to what
+        is left after the task and the latest turns, which are never cut. token_budget is one budget for
+        every node or a {node: budget} mapping (nodes left out are not bounded), the budget argument of
+        view/aview overrides both. stats counts per node the calls, the tokens of the full history and of the view
+    """
+
+    def __init__(self, summarizer=None, token_budget:Union[int, Dict[str, int], None] = None, max_cached:int = 1024):
+        self.summarizer = summarizer or extractive_summary
+        self.token_budget = token_budget
+        self.max_cached = max_cached
+        self.stats: Dict[str, Counter] = {}
+        self._summaries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def split(messages:Sequence[BaseMessage]) -> Tuple[BaseMessage, List[BaseMessage], List[BaseMessage]]:
+        """
+            (task, folded, recent): recent starts at the oldest of the speakers' latest messages
+        """
+        task, rest = messages[0], list(messages[1:])
+        latest = {}
+        for i, m in enumerate(rest):
+            latest[_speaker(m)] = i
+        start = min(latest.values()) if latest else 0
+        return task, rest[:start], rest[start:]
+
+    @staticmethod
+    def _keys(folded:Sequence[BaseMessage]) -> List[str]:
+        # chained hash per prefix of the folded messages
+        keys, h = [], hashlib.blake2b(digest_size=16)
+        for m in folded:
+            h.update(_speaker(m).encode('utf-8') + b'\x00' + _text(m).encode('utf-8') + b'\x01')
+            keys.append(h.copy().hexdigest())
+        return keys
+
+    def _cached(self, keys:List[str]) -> Tuple[int, str]:
+        with self._lock:
+            for n in range(len(keys), 0, -1):
+                summary = self._summaries.get(keys[n - 1])
+                if summary is not None:
+                    self._summaries.move_to_end(keys[n - 1])
+                    return n, summary
+        return 0, ''
+
+    def _store(self, key:str, summary:str):
+        with self._lock:
+            self._summaries[key] = summary
+            while len(self._summaries) > self.max_cached:
+                self._summaries.popitem(last=False)
+
+    def budget(self, node:str, budget:Optional[int] = None) -> Optional[int]:
+        """
+            the token budget of node's view: budget when given, else token_budget (its entry for node if a mapping)
+        """
+        if budget is not None:
+            return budget
+        if isinstance(self.token_budget, dict):
+            return self.token_budget.get(node)
+        return self.token_budget
+
+    def _assemble(self, node:str, messages:Sequence[BaseMessage], task:BaseMessage, summary:str,
+                  recent:List[BaseMessage], budget:Optional[int]) -> List[BaseMessage]:
+        if summary and budget is not None:
+            # chars the task message can grow by before the view passes the budget
+            prefix = f"{_text(task)}\n\n{SUMMARY_HEADER}\n"
+            room = (budget - sum(estimate_tokens(_text(m)) for m in recent) - 1) * 4 - len(prefix)
+            if room <= 3:
+                summary = ''
+            elif len(summary) > room:
+                # the end of a rolling summary holds the most recent turns
+                summary = '...' + summary[-(room - 3):]
+        if summary and isinstance(task.content, str):
+            task = task.copy(update={'content': f"{task.content}\n\n{SUMMARY_HEADER}\n{summary}"})
+        view = [task, *recent]
+
+        full = sum(estimate_tokens(_text(m)) for m in messages)
+        sent = sum(estimate_tokens(_text(m)) for m in view)
+        with self._lock:
+            stats = self.stats.setdefault(node, Counter())
+            stats['calls'] += 1
+            stats['history_tokens'] += full
+            stats['sent_tokens'] += sent
+            if budget is not None and sent > budget:
+                stats['over_budget'] += 1
+        telemetry.add('history_tokens_saved', full - sent)
+        return view
+
+    def view(self, messages:Sequence[BaseMessage], node:str = 'default', budget:Optional[int] = None) -> List[BaseMessage]:
+        """
+            the bounded history to build node's prompt from, in place of messages. budget overrides the
+            node's token budget for this view
+        """
+        if not messages:
+            return []
+        task, folded, recent = self.split(messages)
+        summary = ''
+        if folded:
+            keys = self._keys(folded)
+            n, summary = self._cached(keys)
+            if n < len(folded):
+                summary = self.summarizer(summary, folded[n:])
+                self._store(keys[-1], summary)
+        return self._assemble(node, messages, task, summary, recent, self.budget(node, budget))
+
+    async def aview(self, messages:Sequence[BaseMessage], node:str = 'default', budget:Optional[int] = None) -> List[BaseMessage]:
+        if not messages:
+            return []
+        task, folded, recent = self.split(messages)
+        summary = ''
+        if folded:
+            keys = self._keys(folded)
+            n, summary = self._cached(keys)
+            if n < len(folded):
+                asummarize = getattr(self.summarizer, 'asummarize', None)
+                summary = await asummarize(summary, folded[n:]) if asummarize else self.summarizer(summary, folded[n:])
+                self._store(keys[-1], summary)
+        return self._assemble(node, messages, task, summary, recent, self.budget(node, budget))
+
+    def report(self) -> Dict[str, Dict[str, int]]:
+        """
+            per node: calls, history_tokens (what the full history would have cost), sent_tokens,
+            saved_tokens and over_budget (views the task and latest turns alone made exceed the budget)
+        """
+        with self._lock:
+            return {node: {**stats, 'saved_tokens': stats['history_tokens'] - stats['sent_tokens']}
+                    for node, stats in self.stats.items()}
@@ -0,0 +1,674 @@
+"""
+    the four book_writing notebooks as one headless run:
+
+        outline + characters -> chapters -> image prompts -> panels -> docx
+                             -> portraits -----------------/
+                                chapters -> translations -> translated docx
+
+        python -m story_agents.pipeline --topic "a lighthouse keeper's cat" --work-dir ./book \\
+            --endpoint <storydiffusion endpoint> --target-lang Chinese --country China
+
+    every unit of work (outline, characters, each chapter, each chapter's image prompts and panels,
+    each portrait, each translated chapter) is checkpointed in work_dir as soon as it is done. running
+    the same command again after a crash only redoes the units without a checkpoint. with --overlap each
+    chapter moves on to its image prompts, panels and translation as soon as it is written, instead of
+    every stage waiting for the previous one to finish the whole book. each run leaves the time, queue
+    wait, retries, tokens and bytes of every stage in work_dir/telemetry.json (see telemetry.py)
+"""
+import os
+import re
+import json
+import asyncio
+import argparse
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple, Type, Union
+from langchain_core.pydantic_v1 import BaseModel
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnableLambda
+from langgraph.graph import StateGraph, END
+from story_agents.graph_utils import AgentState, retry_call, aget_final_env_var
+from story_agents.llm_utils import CustJsonOuputParser, dict_to_obj, early_stop_llm, role_view
+from story_agents.prompt_cache import cached_prefix_prompt
+from story_agents.schema_registry import SCHEMA_STYLES, get_schema
+from story_agents.prompts import (fc_desc, role_config, story_illustrator_example, write_chapter_requirements,
+                                  translation_task, review_task, refine_task)
+from story_agents.structure_objects import (Outline, Character, Persona, DetailChapter, Story, Title,
+                                            ImagePrompt, StoryPrompt)
+from story_agents.storyd_pipeline import chapter_dir, load_chapter_images, save_chapter_images
+from story_agents.reference_images import default_reference_store
+from story_agents.stage_queue import Stage, StagePipeline
+from story_agents.book_assembler import PrintImageCache, convert_to_pdf
+from story_agents.memory import ConversationMemory
+from story_agents.telemetry import Tracer, set_tracer, span, timed_acquire, traced, traced_llm
+
+DEFAULT_MODEL_ID = "mistral.mistral-large-2407-v1:0"
+# the schema in every fc_desc prompt, minified drops the whitespace and the auto-generated titles of schema_json()
+DEFAULT_SCHEMA_STYLE = 'minified'
+# StoryDiffusion returns the single panels and the assembled comic pages, only the pages (wider than this) go in the book
+PAGE_MIN_WIDTH = 1024
+
+
+class PipelineError(Exception):
+    """
+        raised at the end of a run in which some units failed, the others are checkpointed
+    """
+    pass
+
+
+class CheckpointStore():
+    """
+        one json file per unit of work under work_dir, e.g. chapters/003.json.
+        files are written to a temporary name and renamed, a unit is either complete on disk or missing
+    """
+
+    def __init__(self, work_dir:str):
+        self.work_dir = work_dir
+        os.makedirs(work_dir, exist_ok=True)
+
+    def path(self, unit:str) -> str:
+        return os.path.join(self.work_dir, f"{unit}.json")
+
+    def done(self, unit:str) -> bool:
+        return os.path.exists(self.path(unit))
+
+    def load(self, unit:str, model:Optional[Type[BaseModel]] = None):
+        if not self.done(unit):
+            return None
+        with open(self.path(unit), encoding='utf-8') as f:
+            data = json.load(f)
+        return model.parse_obj(data) if model else data
+
+    def save(self, unit:str, obj):
+        path = self.path(unit)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        text = obj.json(ensure_ascii=False) if isinstance(obj, BaseModel) else json.dumps(obj, ensure_ascii=False)
+        tmp = f"{path}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+
+def _structured(system_template:str, llm, target:Type[BaseModel], model_id:Optional[str] = None):
+    return (cached_prefix_prompt(system_template + fc_desc, model_id) | llm | CustJsonOuputParser(verbose=False)
+            | RunnableLambda(dict_to_obj).bind(target=target))
+
+
+async def _history(memory:Optional[ConversationMemory], messages, node:str):
+    return await memory.aview(messages, node) if memory is not None else messages
+
+
+def build_outline_workflow(llm, model_id:Optional[str] = None, max_turns:int = 2,
+                           memory:Optional[ConversationMemory] = None, json_llm=None,
+                           schema_style:str = DEFAULT_SCHEMA_STYLE):
+    """
+        book_writing_01: the cartoonist drafts the outline, the screenwriter creates the characters,
+        the cartoonist rewrites the outline with them, until more than max_turns answers.
+        with memory each node sees its bounded view of the conversation instead of all of it.
+        json_llm, when given, answers the prompts parsed as json in place of llm.
+        schema_style: how the output schema is written in the prompts, see schema_registry
+    """
+    outline_chain = _structured(role_config["cartoonist"], json_llm or llm, Outline, model_id)
+    characters_chain = _structured(role_config["screenwriter"], json_llm or llm, Character, model_id)
+
+    @traced()
+    async def generate_outline(state:AgentState):
+        env_var = state["env_var"]
+        name = "cartoonist"
+        messages = role_view(await _history(memory, state['messages'], 'generate_outline'), name)
+        outline = await retry_call(outline_chain, {"messages": messages, "schema": get_schema(Outline, schema_style)})
+        response = AIMessage(content=f"Here is the outline: \n{outline.json()}", name=name)
+        return {"messages": [response], "env_var": {**env_var, "outline": outline}}
+
+    @traced()
+    async def generate_characters(state:AgentState):
+        env_var = state["env_var"]
+        name = 'screenwriter'
+        messages = role_view(await _history(memory, state['messages'], 'generate_characters'), name)
+        characters = await retry_call(characters_chain, {"messages": messages, "schema": get_schema(Character, schema_style)})
+        response = AIMessage(content=f"Here is the characters description:\n{characters.json()}.\n Your task is to rewrite the outline draft for a story based on the outline draft. Please incorporate all the characters in the story, and keep the outline be comprehensive and specific ", name=name)
+        return {"messages": [response], "env_var": {**env_var, "characters": characters}}
+
+    def should_repeat_outline(state:AgentState):
+        num_responses = len([m for m in state['messages'] if isinstance(m, AIMessage)])
+        return 'end' if num_responses > max_turns else 'generate_characters'
+
+    graph = StateGraph(AgentState)
+    graph.add_node("generate_outline", generate_outline)
+    graph.add_node("generate_characters", generate_characters)
+    graph.set_entry_point("generate_outline")
+    graph.add_edge("generate_characters", "generate_outline")
+    graph.add_conditional_edges("generate_outline", should_repeat_outline,
+                                {'end': END, 'generate_characters': 'generate_characters'})
+    return graph.compile()
+
+
+def build_write_workflow(llm, model_id:Optional[str] = None, max_turns:int = 2,
+                         memory:Optional[ConversationMemory] = None, json_llm=None,
+                         schema_style:str = DEFAULT_SCHEMA_STYLE):
+    """
+        book_writing_02: the cartoonist writes a chapter and the editor reviews it, until more than max_turns answers.
+        with memory each node sees its bounded view of the conversation instead of all of it.
+        json_llm, when given, writes the chapter in place of llm. schema_style as in build_outline_workflow
+    """
+    chapter_chain = _structured(role_config["cartoonist"] + write_chapter_requirements, json_llm or llm, DetailChapter, model_id)
+    review_chain = cached_prefix_prompt(role_config["editor"], model_id) | llm | StrOutputParser()
+
+    @traced()
+    async def write_chapter(state:AgentState):
+        env_var = state['env_var']
+        name = 'cartoonist'
+        messages = role_view(await _history(memory, state["messages"], 'write_chapter'), name)
+        chapter_obj = await retry_call(chapter_chain, {"outline": env_var['outline'].json(), "messages": messages,
+                                                       "characters": env_var['characters'].as_str,
+                                                       "schema": get_schema(DetailChapter, schema_style)})
+        # sometimes the agent ends the conversation instead of answering with the structured output
+        if isinstance(chapter_obj, DetailChapter):
+            return {"messages": [AIMessage(name=name, content=chapter_obj.json())], "env_var": {**env_var, "chapter": chapter_obj}}
+        return {"messages": [AIMessage(name=name, content="Let's end the coversation")], "env_var": {**env_var}}
+
+    @traced()
+    async def refine_chapter(state:AgentState):
+        env_var = state['env_var']
+        name = "editor"
+        messages = role_view(await _history(memory, state["messages"], 'refine_chapter'), name)
+        suggestion = await retry_call(review_chain, {"outline": env_var['outline'].json(), "messages": messages})
+        return {"messages": [AIMessage(name=name, content=suggestion)], "env_var": {**env_var}}
+
+    def should_repeat_write(state:AgentState):
+        messages = state['messages']
+        num_responses = len([m for m in messages if isinstance(m, AIMessage)])
+        if num_responses > max_turns or messages[-1].content.startswith("Let's end the coversation"):
+            return 'end'
+        return 'refine_chapter'
+
+    graph = StateGraph(AgentState)
+    graph.add_node("write_chapter", write_chapter)
+    graph.add_node("refine_chapter", refine_chapter)
+    graph.set_entry_point("write_chapter")
+    graph.add_edge("refine_chapter", "write_chapter")
+    graph.add_conditional_edges("write_chapter", should_repeat_write, {"end": END, "refine_chapter": "refine_chapter"})
+    return graph.compile()
+
+
+def build_translate_workflow(llm, json_llm=None, schema_style:str = DEFAULT_SCHEMA_STYLE):
+    """
+        book_writing_04: translate, review the translation, refine it with the review.
+        json_llm, when given, answers the translate and refine prompts in place of llm.
+        schema_style as in build_outline_workflow
+    """
+    translation_prompt = ChatPromptTemplate.from_messages([("system", role_config['linguist'] + fc_desc), ("user", translation_task)])
+    review_prompt = ChatPromptTemplate.from_messages([("system", role_config['linguist']), ("user", review_task)])
+    refine_prompt = ChatPromptTemplate.from_messages([("system", role_config['linguist'] + fc_desc), ("user", refine_task)])
+
+    def _chain(prompt, output_obj):
+        return prompt | (json_llm or llm) | CustJsonOuputParser(verbose=False) | RunnableLambda(dict_to_obj).bind(target=output_obj)
+
+    @traced()
+    async def translate_chapter(state:AgentState):
+        env_var = state['env_var']
+        output_obj = env_var['output_obj']
+        chapter_obj = await retry_call(_chain(translation_prompt, output_obj),
+                                       {"source_lang": "English", "target_lang": env_var['target_lang'],
+                                        "schema": get_schema(output_obj, schema_style), "source_text": env_var['source_text']})
+        return {"env_var": {**env_var, "translation_text": chapter_obj.json(ensure_ascii=False)}}
+
+    @traced()
+    async def reflect_review(state:AgentState):
+        env_var = state['env_var']
+        expert_suggestions = await retry_call(review_prompt | llm | StrOutputParser(),
+                                              {"source_lang": "English", "target_lang": env_var['target_lang'],
+                                               "translation_text": env_var['translation_text'],
+                                               "country": env_var['country'], "source_text": env_var['source_text']})
+        return {"env_var": {**env_var, "expert_suggestions": expert_suggestions}}
+
+    @traced()
+    async def refine(state:AgentState):
+        env_var = state['env_var']
+        output_obj = env_var['output_obj']
+        chapter_obj = await retry_call(_chain(refine_prompt, output_obj),
+                                       {"source_lang": "English", "target_lang": env_var['target_lang'],
+                                        "schema": get_schema(output_obj, schema_style),
+                                        "translation_text": env_var['translation_text'],
+                                        "expert_suggestions": env_var['expert_suggestions'],
+                                        "source_text": env_var['source_text']})
+        return {"env_var": {**env_var, "final_translation": chapter_obj}}
+
+    graph = StateGraph(AgentState)
+    graph.add_node("translate_chapter", translate_chapter)
+    graph.add_node("reflect_review", reflect_review)
+    graph.add_node("refine", refine)
+    graph.set_entry_point("translate_chapter")
+    graph.add_edge("translate_chapter", "reflect_review")
+    graph.add_edge("reflect_review", "refine")
+    graph.add_edge("refine", END)
+    return graph.compile()
+
+
+def _personas(characters:Character) -> List[Persona]:
+    return [characters.main_character, *characters.supporting_character]
+
+
+async def _none():
+    return None
+
+
+def _safe_name(text:str) -> str:
+    return re.sub(r'[\\/:*?"<>|\s]+', '_', text).strip('_') or 'book'
+
+
+class BookPipeline():
+    """
+        runs the book end to end with a checkpoint per unit of work in work_dir.
+        image_generator is a StoryDiffusionGenerator, without one the portraits, panels and docx are skipped.
+        with pdf_backend ('auto', 'libreoffice' or 'docx2pdf') every docx is also converted to pdf.
+        without target_lang there is no translation. max_concurrency bounds the chapter workflows running
+        at once, max_in_flight the StoryDiffusion requests. memory bounds the history the outline and chapter
+        loops send back (a default ConversationMemory, pass one with a token budget or an llm_summarizer).
+        with audit every event of the outline, chapter and translation workflows goes to work_dir/audit/*.jsonl.
+        json_llm answers the prompts parsed as json when given, e.g. rate_limited(early_stop_llm(chat,
+        CustJsonOuputParser())) to stop reading each answer at its closing fence.
+        with otel the run's spans also go to OpenTelemetry. schema_style is how the output schemas are
+        written in the prompts, minified by default (see schema_registry)
+    """
+
+    def __init__(self, llm, work_dir:str = './book', image_generator=None, model_id:Optional[str] = None,
+                 target_lang:Optional[str] = None, country:str = '', max_concurrency:int = 4, max_in_flight:int = 4,
+                 overlap:bool = False, max_turns:int = 2, style:str = 'Comic book',
+                 comic_type:str = 'Classic Comic Style', height:int = 768, width:int = 768, pdf_backend:Optional[str] = None,
+                 memory:Optional[ConversationMemory] = None, audit:bool = False, json_llm=None, otel:bool = False,
+                 schema_style:str = DEFAULT_SCHEMA_STYLE, verbose:bool = True):
+        self.llm = llm = traced_llm(llm, model_id=model_id)
+        self.json_llm = json_llm = traced_llm(json_llm, model_id=model_id) if json_llm is not None else None
+        self.work_dir = work_dir
+        self.store = CheckpointStore(work_dir)
+        self.image_generator = image_generator
+        self.model_id = model_id
+        self.target_lang = target_lang
+        self.country = country
+        self.max_concurrency = max_concurrency
+        self.max_in_flight = max_in_flight
+        self.overlap = overlap
+        self.max_turns = max_turns
+        self.style = style
+        self.comic_type = comic_type
+        self.height = height
+        self.width = width
+        self.pdf_backend = pdf_backend
+        self.memory = memory or ConversationMemory()
+        self.audit = audit
+        self.otel = otel
+        self.schema_style = schema_style
+        self.verbose = verbose
+        self.tracer = None
+        self.images_dir = os.path.join(work_dir, 'images')
+        self.panels_dir = os.path.join(work_dir, 'panels')
+        self.stats = Counter()
+        self.failed = {}
+        self._outline_workflow = build_outline_workflow(llm, model_id, max_turns, self.memory, json_llm, schema_style)
+        self._write_workflow = build_write_workflow(llm, model_id, max_turns, self.memory, json_llm, schema_style)
+        self._translate_workflow = build_translate_workflow(llm, json_llm, schema_style)
+
+    def _audit(self, unit:str) -> Tuple[Optional[str], str]:
+        # (spill_path, run_id) for the unit's workflow events, appended to work_dir/audit/<unit>.jsonl with audit
+        if not self.audit:
+            return None, unit
+        audit_dir = os.path.join(self.work_dir, 'audit')
+        os.makedirs(audit_dir, exist_ok=True)
+        return os.path.join(audit_dir, unit.replace('/', '_') + '.jsonl'), unit
+
+    def _log(self, message:str):
+        if self.verbose:
+            print(message)
+
+    async def _unit(self, unit:str, produce, model:Optional[Type[BaseModel]] = None):
+        """
+            the checkpoint of unit if there is one, otherwise await produce() and checkpoint its result.
+            a failure is recorded in self.failed and returns None so the other units carry on
+        """
+        done = self.store.load(unit, model)
+        if done is not None:
+            self.stats['resumed'] += 1
+            return done
+        try:
+            with span(unit.split('/')[0], unit=unit):
+                result = await produce()
+        except Exception as err:
+            print(f"{unit} failed: {err!r}")
+            self.failed[unit] = repr(err)
+            return None
+        self.store.save(unit, result)
+        self.stats['completed'] += 1
+        self._log(f"{unit} done")
+        return result
+
+    async def aoutline(self, topic:str) -> Tuple[Outline, Character]:
+        outline, characters = self.store.load('outline', Outline), self.store.load('characters', Character)
+        if outline is not None and characters is not None:
+            self.stats['resumed'] += 2
+            return outline, characters
+        init_state = {"env_var": {"topic": topic}, "messages": [HumanMessage(content=f"Here is the topic:{topic}")]}
+        with span('outline'):
+            env_var = await aget_final_env_var(self._outline_workflow, init_state, "generate_outline", *self._audit('outline'))
+        outline, characters = env_var["outline"], env_var.get("characters")
+        if characters is None:
+            raise PipelineError("the outline workflow ended without characters, max_turns must be at least 2")
+        self.store.save('outline', outline)
+        self.store.save('characters', characters)
+        self.stats['completed'] += 2
+        return outline, characters
+
+    async def achapter(self, index:int, outline:Outline, characters:Character) -> Optional[DetailChapter]:
+        async def _write():
+            async with timed_acquire(self._llm_slots):
+                init_state = {"env_var": {"outline": outline, "characters": characters, "chapter": None},
+                              "messages": [HumanMessage(content=f"Here is the origin content:\n {outline.chapters[index].json()}", name='editor')]}
+                env_var = await aget_final_env_var(self._write_workflow, init_state, 'write_chapter',
+                                                   *self._audit(f"chapters/{index:03d}"))
+            if env_var.get('chapter') is None:
+                raise PipelineError(f"chapter {index} ended without a chapter")
+            return env_var['chapter']
+        return await self._unit(f"chapters/{index:03d}", _write, DetailChapter)
+
+    async def aimage_prompt(self, index:int, chapter:DetailChapter, characters:Character) -> Optional[StoryPrompt]:
+        chain = _structured(role_config['story illustrator'], self.llm, StoryPrompt, self.model_id)
+        character_names = '\n'.join(p.name for p in _personas(characters))
+
+        async def _prompt():
+            async with timed_acquire(self._llm_slots):
+                return await retry_call(chain, {"character_names": character_names, "example": story_illustrator_example,
+                                                "schema": get_schema(StoryPrompt, self.schema_style),
+                                                "messages": [HumanMessage(content=f"Here is the description:\n{chapter.content}")]})
+        return await self._unit(f"image_prompts/{index:03d}", _prompt, StoryPrompt)
+
+    async def aidentity(self, persona:Persona) -> Optional[dict]:
+        """
+            book_writing_03's portrait of one character, then the refined four panel version
+            used as its picture in the book
+        """
+        chain = _structured(role_config['art designer'], self.llm, ImagePrompt, self.model_id)
+
+        async def _portrait():
+            async with timed_acquire(self._llm_slots):
+                sd_prompt = await retry_call(chain, {"schema": get_schema(ImagePrompt, self.schema_style),
+                                                     "messages": [HumanMessage(content=persona.figure + '\n' + persona.appearance)]})
+            async with timed_acquire(self._image_slots):
+                portrait = await self.image_generator.agenerate_real_identity_images(prompt=sd_prompt.prompt, general_prompt=persona.figure,
+                                                                                     height=self.height, width=self.width)
+            if portrait is None:
+                raise PipelineError(f"no portrait returned for {persona.name}")
+            os.makedirs(self.images_dir, exist_ok=True)
+            portrait_path = os.path.join(self.images_dir, f"{persona.name}.png")
+            await asyncio.to_thread(portrait.save, portrait_path)
+            async with timed_acquire(self._image_slots):
+                images = await self.image_generator.agenerate_images(general_prompt=f"[{persona.name}] {persona.figure} img",
+                                                                     style=self.style, comic_type="Four Pannel",
+                                                                     prompt_array=f"[{persona.name}] {sd_prompt.prompt}",
+                                                                     id_length=1, sd_type="Unstable",
+                                                                     ref_imgs=[await asyncio.to_thread(default_reference_store.get_reference, portrait_path)],
+                                                                     height=self.height, width=self.width)
+            refined_path = os.path.join(self.images_dir, f"{persona.name}_refined.png")
+            await asyncio.to_thread(images[-1].save, refined_path)
+            return {"prompt": sd_prompt.prompt, "portrait": portrait_path, "refined": refined_path}
+        return await self._unit(f"identities/{_safe_name(persona.name)}", _portrait)
+
+    async def aidentities(self, characters:Character) -> Optional[Dict[str, dict]]:
+        personas = _personas(characters)
+        results = await asyncio.gather(*[self.aidentity(p) for p in personas])
+        if any(r is None for r in results):
+            return None
+        return {p.name: r for p, r in zip(personas, results)}
+
+    async def aillustrate(self, index:int, story_prompt:StoryPrompt, characters:Character) -> Optional[List[str]]:
+        """
+            one chapter's comic pages, checkpointed by the storyd_pipeline manifest in panels/chapter_XXX
+        """
+        from story_agents.image_utils import generate_img_dicts, prepare_storyd_prompts
+        unit = f"panels/chapter_{index:03d}"
+        images = await asyncio.to_thread(load_chapter_images, self.panels_dir, index)
+        if images is not None:
+            self.stats['resumed'] += 1
+            return [img.filename for img in images if img.size[0] > PAGE_MIN_WIDTH]
+        try:
+            with span('panels', unit=unit):
+                img_dicts = await asyncio.to_thread(generate_img_dicts, characters, None, self.images_dir)
+                p = next(prepare_storyd_prompts([story_prompt.as_str], characters, img_dicts))
+                async with timed_acquire(self._image_slots):
+                    images = await self.image_generator.agenerate_images(general_prompt=p['general_prompt'], style=self.style,
+                                                                         comic_type=self.comic_type,
+                                                                         prompt_array='\n'.join(p['prompt_array']),
+                                                                         id_length=p['id_length'], sd_type="Unstable",
+                                                                         ref_imgs=p['ref_imgs'], height=self.height, width=self.width,
+                                                                         output_dir=chapter_dir(self.panels_dir, index))
+                fnames = await asyncio.to_thread(save_chapter_images, images, self.panels_dir, index)
+        except Exception as err:
+            print(f"{unit} failed: {err!r}")
+            self.failed[unit] = repr(err)
+            return None
+        self.stats['completed'] += 1
+        self._log(f"{unit} done")
+        return [fname for img, fname in zip(images, fnames) if img.size[0] > PAGE_MIN_WIDTH]
+
+    async def atranslate(self, unit:str, source_text:str, output_obj:Type[BaseModel]):
+        async def _translate():
+            async with timed_acquire(self._llm_slots):
+                init_state = {"env_var": {"target_lang": self.target_lang, "country": self.country,
+                                          "output_obj": output_obj, "source_text": source_text}}
+                env_var = await aget_final_env_var(self._translate_workflow, init_state, 'refine',
+                                                   *self._audit(f"translations/{_safe_name(self.target_lang)}/{unit}"))
+            return env_var['final_translation']
+        return await self._unit(f"translations/{_safe_name(self.target_lang)}/{unit}", _translate, output_obj)
+
+    async def _aoverlapped(self, outline:Outline, characters:Character, identities) -> Tuple[list, list, list]:
+        """
+            chapters through a StagePipeline: each written chapter is queued for its image prompts and then
+            its pages right away, and its translation is started next to them
+        """
+        n = len(outline.chapters)
+        chapters, translations = {}, {}
+
+        async def write(index, _):
+            chapters[index] = chapter = await self.achapter(index, outline, characters)
+            if chapter is not None and self.target_lang:
+                translations[index] = asyncio.ensure_future(self.atranslate(f"chapter_{index:03d}", chapter.json(), DetailChapter))
+            return chapter
+
+        async def image_prompt(index, chapter):
+            return await self.aimage_prompt(index, chapter, characters)
+
+        async def render(index, story_prompt):
+            if await identities is None:
+                return None
+            return await self.aillustrate(index, story_prompt, characters)
+
+        stages = [Stage('write', write, workers=self.max_concurrency)]
+        if self.image_generator is not None:
+            stages += [Stage('image_prompt', image_prompt, workers=self.max_concurrency),
+                       Stage('render', render, workers=self.max_in_flight)]
+        results = await StagePipeline(stages).arun(enumerate(outline.chapters))
+        panels = [results.get(i) for i in range(n)] if self.image_generator is not None else [None] * n
+        translations = [await translations[i] if i in translations else None for i in range(n)]
+        return [chapters.get(i) for i in range(n)], panels, translations
+
+    async def arun(self, topic:Optional[str] = None) -> Dict[str, Any]:
+        """
+            run every stage whose units are not checkpointed yet, raises PipelineError listing the
+            failed units (after checkpointing all the others) so the next run can resume them.
+            the run is traced, its per-stage latency/token/byte summary is written to work_dir/telemetry.json
+            (also when it fails) and kept in self.tracer
+        """
+        self.tracer = Tracer(otel=self.otel)
+        previous = set_tracer(self.tracer)
+        try:
+            with span('book', work_dir=self.work_dir):
+                result = await self._arun(topic)
+        finally:
+            set_tracer(previous)
+            os.makedirs(self.work_dir, exist_ok=True)
+            telemetry_path = self.tracer.write_summary(os.path.join(self.work_dir, 'telemetry.json'))
+        result['telemetry'] = telemetry_path
+        return result
+
+    async def _arun(self, topic:Optional[str]) -> Dict[str, Any]:
+        self._llm_slots = asyncio.Semaphore(self.max_concurrency)
+        self._image_slots = asyncio.Semaphore(self.max_in_flight)
+        self.stats.clear()
+        self.failed = {}
+
+        book = self.store.load('book') or {}
+        if topic is None:
+            topic = book.get('topic')
+            if topic is None:
+                raise PipelineError(f"no topic given and no book started in {self.work_dir}")
+        elif book.get('topic', topic) != topic:
+            raise PipelineError(f"{self.work_dir} holds the book about {book['topic']!r}, use another work dir")
+        self.store.save('book', {'topic': topic})
+
+        outline, characters = await self.aoutline(topic)
+        n = len(outline.chapters)
+
+        # portraits only need the characters, they are drawn while the chapters are written
+        identities = asyncio.ensure_future(self.aidentities(characters) if self.image_generator is not None else _none())
+
+        if self.overlap:
+            chapters, panels, translations = await self._aoverlapped(outline, characters, identities)
+        else:
+            chapters = await asyncio.gather(*[self.achapter(i, outline, characters) for i in range(n)])
+            panels = [None] * n
+            translations = [None] * n
+            if self.image_generator is not None:
+                prompts = await asyncio.gather(*[self.aimage_prompt(i, c, characters) for i, c in enumerate(chapters) if c is not None])
+                prompts = iter(prompts)
+                prompts = [next(prompts) if c is not None else None for c in chapters]
+                if await identities is not None:
+                    panels = await asyncio.gather(*[self.aillustrate(i, p, characters) if p is not None else _none()
+                                                    for i, p in enumerate(prompts)])
+            if self.target_lang:
+                translations = await asyncio.gather(*[self.atranslate(f"chapter_{i:03d}", c.json(), DetailChapter)
+                                                      if c is not None else _none() for i, c in enumerate(chapters)])
+        identities = await identities
+
+        result = {'work_dir': self.work_dir, 'docx': []}
+        if all(c is not None for c in chapters):
+            story = Story(story_title=outline.page_title, chapters=chapters)
+            if identities is not None and all(p is not None for p in panels):
+                story.images = panels
+                story.identity_images = [identities[p.name]['refined'] for p in _personas(characters)]
+            self.store.save('story', story)
+            result['story'] = story
+
+        if self.target_lang and 'story' in result:
+            title, characters_translated = await asyncio.gather(self.atranslate('title', outline.page_title, Title),
+                                                                self.atranslate('characters', characters.json(), Character))
+            if title is not None and characters_translated is not None and all(t is not None for t in translations):
+                story_translated = story.copy()
+                story_translated.chapters = translations
+                story_translated.story_title = title.title
+                self.store.save('story_translated', story_translated)
+                result['story_translated'] = story_translated
+
+        if self.failed:
+            raise PipelineError(f"{len(self.failed)} units failed ({', '.join(sorted(self.failed))}), "
+                                f"run again with the same work dir to resume them")
+
+        if self.image_generator is not None:
+            from story_agents.image_utils import save_as_docx
+            image_cache = PrintImageCache(os.path.join(self.work_dir, 'print'))
+            books = [(characters, result['story'], 'original')]
+            if 'story_translated' in result:
+                books.append((characters_translated, result['story_translated'], _safe_name(self.target_lang)))
+            for book_characters, book_story, suffix in books:
+                fname = os.path.join(self.work_dir, f"{_safe_name(outline.page_title)}_{suffix}.docx")
+                with span('docx'):
+                    await asyncio.to_thread(save_as_docx, book_characters, book_story, fname, image_cache=image_cache)
+                result['docx'].append(fname)
+                if self.pdf_backend:
+                    result.setdefault('pdf', []).append(await asyncio.to_thread(convert_to_pdf, fname, backend=self.pdf_backend))
+        result['stats'] = dict(self.stats)
+        result['memory'] = self.memory.report()
+        return result
+
+    def run(self, topic:Optional[str] = None) -> Dict[str, Any]:
+        return asyncio.run(self.arun(topic))
+
+
+def _history_budget(text:str) -> Union[int, Dict[str, int]]:
+    # "6000" for every node, or "write_chapter=8000,refine_chapter=3000"
+    if '=' not in text:
+        return int(text)
+    budgets = {}
+    for item in text.split(','):
+        node, _, budget = item.partition('=')
+        budgets[node.strip()] = int(budget)
+    return budgets
+
+
+def main(argv:Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="write, illustrate and translate a comics book, resumable from --work-dir")
+    parser.add_argument('--topic', help="topic of the book, can be left out when resuming")
+    parser.add_argument('--work-dir', default='./book', help="checkpoints and outputs")
+    parser.add_argument('--model-id', default=DEFAULT_MODEL_ID)
+    parser.add_argument('--endpoint', help="StoryDiffusion SageMaker endpoint, without it there are no images and no docx")
+    parser.add_argument('--sqs-queue-url', help="queue subscribed to the endpoint's SNS notifications")
+    parser.add_argument('--target-lang', help="language to translate the book into")
+    parser.add_argument('--country', default='', help="country whose colloquial style the translation follows")
+    parser.add_argument('--style', default='Comic book', choices=['Comic book', 'Japanese Anime', 'Disney Character'])
+    parser.add_argument('--comic-type', default='Classic Comic Style', choices=['Four Pannel', 'Classic Comic Style'])
+    parser.add_argument('--max-concurrency', type=int, default=4, help="chapter workflows running at once")
+    parser.add_argument('--max-in-flight', type=int, default=4, help="StoryDiffusion requests at once")
+    parser.add_argument('--max-turns', type=int, default=2)
+    parser.add_argument('--history-budget', type=_history_budget,
+                        help="tokens of conversation history a node sends at most, e.g. 6000 or write_chapter=8000,refine_chapter=3000")
+    parser.add_argument('--overlap', action='store_true', help="illustrate and translate each chapter as soon as it is written")
+    parser.add_argument('--response-cache', help="sqlite file to cache model responses in")
+    parser.add_argument('--pdf', nargs='?', const='auto', choices=['auto', 'libreoffice', 'docx2pdf'],
+                        help="also write pdf files, LibreOffice headless when installed")
+    parser.add_argument('--early-stop', action='store_true',
+                        help="stream the json answers and stop at their closing fence (streamed answers skip --response-cache)")
+    parser.add_argument('--schema-style', default=DEFAULT_SCHEMA_STYLE, choices=SCHEMA_STYLES,
+                        help="how the output schema is written in the prompts")
+    parser.add_argument('--audit', action='store_true', help="keep every intermediate workflow state in work-dir/audit")
+    parser.add_argument('--otel', action='store_true',
+                        help="also export the run's spans over OTLP (OTEL_EXPORTER_OTLP_* variables), needs opentelemetry-sdk")
+    parser.add_argument('--quiet', action='store_true')
+    args = parser.parse_args(argv)
+
+    from langchain_aws import ChatBedrockConverse
+    from story_agents.graph_runner import rate_limited
+    if args.otel:
+        from story_agents.telemetry import configure_opentelemetry
+        configure_opentelemetry()
+    chat = ChatBedrockConverse(model=args.model_id, temperature=0.1, max_tokens=4096,
+                               cache=False if args.response_cache else None)
+    llm = rate_limited(chat, args.model_id)
+    if args.response_cache:
+        # looked up before the rate limiter, a cache hit doesn't wait for quota
+        from story_agents.response_cache import SQLiteResponseCache, cached_llm
+        llm = cached_llm(llm, chat, SQLiteResponseCache(args.response_cache))
+    json_llm = rate_limited(early_stop_llm(chat, CustJsonOuputParser(verbose=False)), args.model_id) if args.early_stop else None
+    image_generator = None
+    if args.endpoint:
+        from story_agents.image_utils import StoryDiffusionGenerator
+        image_generator = StoryDiffusionGenerator(endpoint_name=args.endpoint, sqs_queue_url=args.sqs_queue_url)
+
+    pipeline = BookPipeline(llm, work_dir=args.work_dir, image_generator=image_generator, model_id=args.model_id,
+                            target_lang=args.target_lang, country=args.country, max_concurrency=args.max_concurrency,
+                            max_in_flight=args.max_in_flight, overlap=args.overlap, max_turns=args.max_turns,
+                            style=args.style, comic_type=args.comic_type, pdf_backend=args.pdf,
+                            memory=ConversationMemory(token_budget=args.history_budget), audit=args.audit, json_llm=json_llm,
+                            otel=args.otel, schema_style=args.schema_style, verbose=not args.quiet)
+    try:
+        result = pipeline.run(args.topic)
+    except PipelineError as err:
+        print(err)
+        return 1
+    for fname in result['docx'] + result.get('pdf', []):
+        print(f"book saved as: {fname}")
+    print(json.dumps(result['stats']))
+    print(f"telemetry saved as: {result['telemetry']}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
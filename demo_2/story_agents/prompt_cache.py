@@ -0,0 +1,117 @@
+"""
+    prompt assembly for chains whose system prompt is large and identical across calls
+    (role + outline + characters + fc_desc with the schema) while only the messages change:
+
+        write_chapter_prompt = cached_prefix_prompt(role_config["cartoonist"] + chapter_requirements + fc_desc, model_id)
+        chain = write_chapter_prompt | llm | track_cache_usage() | CustJsonOuputParser() | ...
+        await chain.ainvoke({"outline": outline.json(), "characters": characters.as_str,
+                             "schema": schema_json(DetailChapter), "messages": messages})
+
+    the system prompt is rendered once per distinct set of values and, for models where Bedrock supports
+    prompt caching, closed with a cachePoint block so the provider reuses the prefix across chapters
+"""
+import threading
+from collections import Counter
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+from langchain_core.messages import SystemMessage
+from langchain_core.prompt_values import ChatPromptValue
+from langchain_core.runnables import RunnableLambda
+from story_agents.schema_registry import get_schema
+
+# Bedrock model ids (with or without a cross-region prefix such as us.) that accept cachePoint blocks
+PROMPT_CACHE_MODELS = ('anthropic.claude-3-7-sonnet', 'anthropic.claude-3-5-haiku', 'anthropic.claude-sonnet-4',
+                       'anthropic.claude-opus-4', 'amazon.nova-')
+CACHE_POINT = {'cachePoint': {'type': 'default'}}
+
+
+def supports_prompt_cache(model_id:Optional[str]) -> bool:
+    return bool(model_id) and any(m in model_id for m in PROMPT_CACHE_MODELS)
+
+
+def schema_json(model) -> str:
+    """
+        model.schema_json(), computed once per class
+    """
+    return get_schema(model, 'json')
+
+
+@lru_cache(maxsize=64)
+def _render(template:str, items:Tuple[Tuple[str, str], ...]) -> str:
+    return template.format(**dict(items))
+
+
+def render_prefix(template:str, **values) -> str:
+    """
+        template.format(**values), memoized on the template and values
+    """
+    return _render(template, tuple(sorted((k, str(v)) for k, v in values.items())))
+
+
+def cached_prefix_prompt(system_template:str, model_id:Optional[str] = None, variable_name:str = 'messages',
+                         cache_point:Optional[bool] = None):
+    """
+        drop-in for ChatPromptTemplate.from_messages([("system", system_template), MessagesPlaceholder(variable_name)]).
+        every other input key fills the system template, the rendered text is reused for as long as those
+        values do not change. cache_point defaults to whether model_id supports Bedrock prompt caching
+    """
+    use_cache_point = supports_prompt_cache(model_id) if cache_point is None else cache_point
+
+    def _format(args:Dict) -> ChatPromptValue:
+        values = {k: v for k, v in args.items() if k != variable_name}
+        prefix = render_prefix(system_template, **values)
+        system = SystemMessage(content=[{'type': 'text', 'text': prefix}, CACHE_POINT] if use_cache_point else prefix)
+        return ChatPromptValue(messages=[system, *(args.get(variable_name) or [])])
+
+    return RunnableLambda(_format, name='cached_prefix_prompt')
+
+
+def cache_usage(message) -> Dict[str, int]:
+    """
+        input tokens of one response split into cache_read, cache_write and uncached
+    """
+    usage = getattr(message, 'usage_metadata', None) or {}
+    details = usage.get('input_token_details') or {}
+    if details:
+        # langchain usage: input_tokens already includes the cached part
+        read, write = details.get('cache_read', 0) or 0, details.get('cache_creation', 0) or 0
+        uncached = usage.get('input_tokens', 0) - read - write
+    else:
+        # raw Converse usage: inputTokens excludes the cached part
+        raw = (getattr(message, 'response_metadata', None) or {}).get('usage') or {}
+        read, write = raw.get('cacheReadInputTokens', 0), raw.get('cacheWriteInputTokens', 0)
+        uncached = raw.get('inputTokens', usage.get('input_tokens', 0))
+    return {'cache_read': read, 'cache_write': write, 'uncached': max(0, uncached)}
+
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def prompt_cache_stats() -> Dict[str, float]:
+    with _stats_lock:
+        stats = dict(_stats)
+    total = stats.get('cache_read', 0) + stats.get('cache_write', 0) + stats.get('uncached', 0)
+    stats['cached_ratio'] = stats.get('cache_read', 0) / total if total else 0.0
+    return stats
+
+
+def reset_prompt_cache_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def track_cache_usage(verbose:bool = False):
+    """
+        pass-through step for after the llm that adds each response's cache_usage to prompt_cache_stats()
+    """
+    def _track(message):
+        usage = cache_usage(message)
+        with _stats_lock:
+            _stats['calls'] += 1
+            _stats.update(usage)
+        if verbose:
+            print(f"input tokens: cached {usage['cache_read']}, written {usage['cache_write']}, uncached {usage['uncached']}")
+        return message
+
+    return RunnableLambda(_track, name='track_cache_usage')
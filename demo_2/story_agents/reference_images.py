@@ -0,0 +1,96 @@
+import os
+import base64
+import hashlib
+import threading
+from typing import Optional
+from story_agents.client_pool import get_client
+from story_agents import telemetry
+
+
+class ReferenceImageStore():
+    """
+        character portraits used as StoryDiffusion reference images.
+        files are base64 encoded from their raw bytes (no PIL decode/re-encode) once and memoized by
+        (path, mtime, size), together with the content hash that request cache keys use.
+
+        s3 mode is off by default and only works with a modified endpoint: with an s3_prefix each
+        portrait is uploaded once under its content hash and requests carry the short s3:// uri
+        instead of megabytes of base64, but the stock StoryDiffusion inference handler base64-decodes
+        every entry of `files`. set s3_prefix only once the handler downloads s3:// entries itself
+    """
+
+    def __init__(self, s3_prefix:Optional[str] = None, s3_client=None):
+        self.s3_prefix = s3_prefix.rstrip('/') if s3_prefix else None
+        self.s3_client = s3_client
+        self._lock = threading.Lock()
+        self._entries = {}  # path -> {mtime, size, sha256, base64, s3_uri}
+        self._digests = {}  # base64 or s3 uri handed out -> sha256 of the file
+        self._upload_locks = {}  # sha256 -> lock held while that portrait is uploaded
+
+    def _entry(self, path:str):
+        stat = os.stat(path)
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry and entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+            return entry
+        with open(path, 'rb') as f:
+            data = f.read()
+        entry = {'mtime': stat.st_mtime_ns,
+                 'size': stat.st_size,
+                 'sha256': hashlib.sha256(data).hexdigest(),
+                 'base64': base64.b64encode(data).decode('utf-8'),
+                 's3_uri': None}
+        with self._lock:
+            old = self._entries.get(path)
+            if old is not None:
+                self._digests.pop(old['base64'], None)
+                self._digests.pop(old['s3_uri'], None)
+            self._entries[path] = entry
+            self._digests[entry['base64']] = entry['sha256']
+        return entry
+
+    def get_base64(self, path:str) -> str:
+        return self._entry(path)['base64']
+
+    def get_sha256(self, path:str) -> str:
+        return self._entry(path)['sha256']
+
+    def get_digest(self, reference:str) -> Optional[str]:
+        """
+            sha256 of the portrait behind a base64 string or s3 uri returned by this store, None for
+            anything else. a dict lookup, so request cache keys don't hash megabytes of base64 again
+        """
+        with self._lock:
+            return self._digests.get(reference)
+
+    def get_s3_uri(self, path:str) -> str:
+        if not self.s3_prefix:
+            raise ValueError("ReferenceImageStore has no s3_prefix configured")
+        entry = self._entry(path)
+        if entry['s3_uri'] is not None:
+            return entry['s3_uri']
+        with self._lock:
+            upload_lock = self._upload_locks.setdefault(entry['sha256'], threading.Lock())
+        # concurrent chapters asking for the same portrait upload it once, the others wait for the uri
+        with upload_lock:
+            if entry['s3_uri'] is None:
+                bucket, _, prefix = self.s3_prefix[5:].partition('/')
+                key = f"{prefix}/{entry['sha256']}.png" if prefix else f"{entry['sha256']}.png"
+                s3_client = self.s3_client or get_client('s3')
+                data = base64.b64decode(entry['base64'])
+                with telemetry.span('s3.put', bytes=len(data)):
+                    s3_client.put_object(Bucket=bucket, Key=key, Body=data, ContentType='image/png')
+                s3_uri = f"s3://{bucket}/{key}"
+                with self._lock:
+                    self._digests[s3_uri] = entry['sha256']
+                entry['s3_uri'] = s3_uri
+        return entry['s3_uri']
+
+    def get_reference(self, path:str) -> str:
+        """
+            what goes into the request's `files`: base64, or the s3 uri in s3 mode (see the class docstring)
+        """
+        return self.get_s3_uri(path) if self.s3_prefix else self.get_base64(path)
+
+
+default_reference_store = ReferenceImageStore()
@@ -0,0 +1,189 @@
+"""
+    persistent cache for chat model responses, for re-running notebooks and pipelines without paying
+    for identical Bedrock calls again:
+
+        install_response_cache('./.llm_cache.sqlite', ttl_seconds=7*24*3600)   # record + replay
+        install_response_cache('./.llm_cache.sqlite', replay_only=True)        # offline, deterministic
+
+    entries are keyed on the model's serialized config (model id, temperature, max_tokens, stop, ...)
+    and the rendered messages, which is what langchain passes to the cache for every chat model call.
+    streaming calls (astream) are not cached by langchain.
+
+    the global cache is looked up inside the chat model, after a rate_limited wrapper has already taken
+    its share of the quota. cached_llm puts the lookup in front instead, so hits don't wait on the limiter:
+
+        chat = ChatBedrockConverse(model=model_id, cache=False)
+        llm = cached_llm(rate_limited(chat, model_id), chat, SQLiteResponseCache('./.llm_cache.sqlite'))
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Optional, Sequence
+from langchain_core.caches import BaseCache
+from langchain_core.globals import set_llm_cache
+from langchain_core.load import dumps
+from langchain_core.messages import message_to_dict, messages_from_dict
+from langchain_core.outputs import ChatGeneration, Generation
+from langchain_core.runnables import Runnable
+
+
+class CacheMissError(Exception):
+    """
+        raised by a replay only cache for a call it has no recorded response for
+    """
+    pass
+
+
+def _dump_generation(generation:Generation) -> dict:
+    if isinstance(generation, ChatGeneration):
+        return {'message': message_to_dict(generation.message), 'info': generation.generation_info}
+    return {'text': generation.text, 'info': generation.generation_info}
+
+
+def _load_generation(data:dict) -> Generation:
+    if 'message' in data:
+        return ChatGeneration(message=messages_from_dict([data['message']])[0], generation_info=data['info'])
+    return Generation(text=data['text'], generation_info=data['info'])
+
+
+class SQLiteResponseCache(BaseCache):
+    """
+        responses in one sqlite file. entries older than ttl_seconds are ignored and removed,
+        past max_entries the least recently used ones are evicted. with replay_only a miss raises
+        CacheMissError instead of letting the call through and nothing new is written
+    """
+
+    def __init__(self, path:str = './.llm_cache.sqlite', ttl_seconds:Optional[float] = None,
+                 max_entries:Optional[int] = 10000, replay_only:bool = False):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.replay_only = replay_only
+        self.hits = 0
+        self.misses = 0
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS responses ("
+                               "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+
+    @staticmethod
+    def make_key(prompt:str, llm_string:str) -> str:
+        return hashlib.sha256(f"{llm_string}\x00{prompt}".encode('utf-8')).hexdigest()
+
+    def lookup(self, prompt:str, llm_string:str) -> Optional[Sequence[Generation]]:
+        key = self.make_key(prompt, llm_string)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row and self.ttl_seconds is not None and now - row[1] > self.ttl_seconds:
+                with self._conn:
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                with self._conn:
+                    self._conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        if row is None:
+            if self.replay_only:
+                raise CacheMissError(f"no recorded response for this call in {self.path} (key {key[:12]})")
+            return None
+        return [_load_generation(g) for g in json.loads(row[0])]
+
+    def update(self, prompt:str, llm_string:str, return_val:Sequence[Generation]):
+        if self.replay_only:
+            return
+        key = self.make_key(prompt, llm_string)
+        value = json.dumps([_dump_generation(g) for g in return_val], default=str)
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO responses (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                               (key, value, now, now))
+            if self.max_entries is not None:
+                self._conn.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed DESC "
+                                   "LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def clear(self, **kwargs):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM responses")
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'entries': entries}
+
+
+def install_response_cache(path:str = './.llm_cache.sqlite', ttl_seconds:Optional[float] = None,
+                           max_entries:Optional[int] = 10000, replay_only:bool = False) -> SQLiteResponseCache:
+    """
+        set a SQLiteResponseCache as langchain's global llm cache, every chat model without its own
+        cache setting (e.g. ChatBedrockConverse in the notebooks) then goes through it
+    """
+    cache = SQLiteResponseCache(path, ttl_seconds=ttl_seconds, max_entries=max_entries, replay_only=replay_only)
+    set_llm_cache(cache)
+    return cache
+
+
+class CachedLLM(Runnable):
+    """
+        llm (e.g. a rate_limited chat model) behind a response cache, see cached_llm.
+        invoke/ainvoke answer from the cache when they can and only call llm on a miss,
+        stream/astream go straight through
+    """
+
+    def __init__(self, llm, model, cache:BaseCache):
+        self.llm = llm
+        self.model = model
+        self.cache = cache
+
+    def _key(self, input, kwargs):
+        # the same (prompt, llm_string) langchain's own lookup uses
+        messages = self.model._convert_input(input).to_messages()
+        return dumps(messages), self.model._get_llm_string(**kwargs)
+
+    def invoke(self, input, config=None, **kwargs):
+        prompt, llm_string = self._key(input, kwargs)
+        cached = self.cache.lookup(prompt, llm_string)
+        if cached:
+            return cached[0].message
+        response = self.llm.invoke(input, config, **kwargs)
+        self.cache.update(prompt, llm_string, [ChatGeneration(message=response)])
+        return response
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        prompt, llm_string = self._key(input, kwargs)
+        cached = await self.cache.alookup(prompt, llm_string)
+        if cached:
+            return cached[0].message
+        response = await self.llm.ainvoke(input, config, **kwargs)
+        await self.cache.aupdate(prompt, llm_string, [ChatGeneration(message=response)])
+        return response
+
+    def stream(self, input, config=None, **kwargs):
+        yield from self.llm.stream(input, config, **kwargs)
+
+    async def astream(self, input, config=None, **kwargs):
+        async for chunk in self.llm.astream(input, config, **kwargs):
+            yield chunk
+
+
+def cached_llm(llm, model, cache:BaseCache) -> CachedLLM:
+    """
+        answer llm's calls from cache before llm (and the rate limiter inside it) is reached.
+        model is the chat model at the bottom of llm, its config keys the entries; give it cache=False
+        so a miss isn't looked up a second time
+    """
+    return CachedLLM(llm, model, cache)
@@ -0,0 +1,137 @@
+import os
+import binascii
+from io import BytesIO
+from typing import Iterator
+
+DEFAULT_CHUNK_SIZE = 256*1024
+
+
+class _Base64Sink():
+    """
+        decodes base64 text fed in arbitrary pieces, keeping only the <4 byte remainder between calls
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self._pending = b''
+        self._escape = False
+
+    def feed(self, data:bytes):
+        if self._escape:
+            data = b'\\' + data
+            self._escape = False
+        if b'\\' in data:
+            if data.endswith(b'\\'):
+                data, self._escape = data[:-1], True
+            # json may escape '/' and carry wrapped base64 lines
+            data = data.replace(b'\\/', b'/').replace(b'\\n', b'').replace(b'\\r', b'')
+        data = self._pending + data
+        cut = len(data) - len(data) % 4
+        if cut:
+            self.fileobj.write(binascii.a2b_base64(data[:cut]))
+        self._pending = data[cut:]
+
+    def close(self):
+        if self._pending:
+            self.fileobj.write(binascii.a2b_base64(self._pending + b'=' * (-len(self._pending) % 4)))
+            self._pending = b''
+
+
+def _scan_base64_array(stream, open_sink, key:str = 'images_base64', chunk_size:int = DEFAULT_CHUNK_SIZE) -> Iterator:
+    """
+        walk a json body like {"images_base64": ["...", "..."], ...} read from stream in chunks,
+        decoding every array element into the file object returned by open_sink(index).
+        yields whatever open_sink returned once that element is complete
+    """
+    needle = f'"{key}"'.encode('utf-8')
+    buf = b''
+    state = 'key'
+    sink = None
+    target = None
+    index = 0
+    while state != 'done':
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        buf = buf + chunk if buf else chunk
+        pos = 0
+        while pos < len(buf) and state != 'done':
+            if state == 'key':
+                found = buf.find(needle, pos)
+                if found == -1:
+                    # keep a tail in case the key is split between chunks
+                    pos = max(pos, len(buf) - len(needle) + 1)
+                    break
+                pos = found + len(needle)
+                state = 'array'
+            elif state == 'array':
+                c = buf[pos:pos+1]
+                pos += 1
+                if c == b'[':
+                    state = 'element'
+                elif c not in b' \t\r\n:':
+                    raise ValueError(f"expected an array after {key}, got {c!r}")
+            elif state == 'element':
+                c = buf[pos:pos+1]
+                pos += 1
+                if c == b'"':
+                    target, fileobj = open_sink(index)
+                    sink = _Base64Sink(fileobj)
+                    state = 'string'
+                elif c == b']':
+                    state = 'done'
+                elif c not in b' \t\r\n,':
+                    raise ValueError(f"expected a base64 string in {key}, got {c!r}")
+            elif state == 'string':
+                end = buf.find(b'"', pos)
+                if end == -1:
+                    sink.feed(buf[pos:])
+                    pos = len(buf)
+                    break
+                sink.feed(buf[pos:end])
+                sink.close()
+                pos = end + 1
+                yield target
+                index += 1
+                state = 'element'
+        buf = buf[pos:]
+    if state != 'done':
+        raise ValueError(f"response ended before the {key} array was complete")
+
+
+def iter_base64_images(stream, key:str = 'images_base64', chunk_size:int = DEFAULT_CHUNK_SIZE) -> Iterator[bytes]:
+    """
+        yield the decoded bytes of each image in the response, one at a time, without holding the
+        whole body, its str copy or the parsed json in memory
+    """
+    buffers = {}
+
+    def open_sink(index):
+        buffers[index] = BytesIO()
+        return index, buffers[index]
+
+    for index in _scan_base64_array(stream, open_sink, key=key, chunk_size=chunk_size):
+        yield buffers.pop(index).getvalue()
+
+
+def write_base64_images(stream, output_dir:str, prefix:str = 'image', suffix:str = '.png',
+                        key:str = 'images_base64', chunk_size:int = DEFAULT_CHUNK_SIZE) -> Iterator[str]:
+    """
+        decode each image in the response straight into a file under output_dir and yield its path,
+        at most one chunk of the response is in memory at a time
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    files = {}
+
+    def open_sink(index):
+        path = os.path.join(output_dir, f"{prefix}_{index}{suffix}")
+        files[index] = open(path, 'wb')
+        return path, files[index]
+
+    try:
+        for i, path in enumerate(_scan_base64_array(stream, open_sink, key=key, chunk_size=chunk_size)):
+            files.pop(i).close()
+            yield path
+    finally:
+        for f in files.values():
+            f.close()
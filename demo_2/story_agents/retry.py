@@ -0,0 +1,214 @@
+"""
+    retry policy for `prompt | llm | parser | ...` chains.
+    failures are classified before anything is re-sent to the model:
+
+        parse     - malformed json / schema mismatch. the raw completion is kept and repaired locally
+                    (repair_json), then a short corrective follow-up is tried, and only then a full regeneration
+        throttle  - bedrock throttling, retried with jittered exponential backoff
+        transient - timeouts / dropped connections / 5xx, retried with backoff
+        fatal     - everything else, raised immediately
+
+        result = await aretry_invoke(chain, args, RetryPolicy(max_attempts=6, time_budget=300))
+"""
+import time
+import random
+import asyncio
+import threading
+from json import JSONDecodeError
+from collections import Counter
+from typing import Any, Dict, Optional
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError, ReadTimeoutError
+from langchain_core.exceptions import OutputParserException
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.output_parsers.base import BaseOutputParser
+from langchain_core.pydantic_v1 import ValidationError
+from langchain_core.runnables import RunnableSequence
+from story_agents.graph_runner import is_throttling_error
+from story_agents.llm_utils import CustJsonOuputParser, TextOuputParser, repair_json
+from story_agents import telemetry
+
+PARSE = 'parse'
+THROTTLE = 'throttle'
+TRANSIENT = 'transient'
+FATAL = 'fatal'
+
+TRANSIENT_CODES = ('InternalServerException', 'InternalFailure', 'ServiceUnavailable', 'RequestTimeout',
+                   'ModelTimeoutException', 'ModelStreamErrorException')
+
+CORRECTIVE_PROMPT = ("Your previous answer could not be used: {error}\n"
+                     "Reply again with the complete, corrected JSON only, inside a ```json block, following the schema.")
+TEXT_CORRECTIVE_PROMPT = ("Your previous answer could not be used: {error}\n"
+                          "Reply again with the complete answer inside <answer></answer> tags.")
+
+
+class RetryError(Exception):
+    """
+        raised when the attempts or the time budget run out, the last failure is the __cause__
+    """
+    pass
+
+
+class RetryPolicy():
+
+    def __init__(self, max_attempts:int = 6, base_delay:float = 1.0, max_delay:float = 30.0,
+                 time_budget:Optional[float] = 600, repair:bool = True, corrective_followup:bool = True):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.time_budget = time_budget
+        self.repair = repair
+        self.corrective_followup = corrective_followup
+
+    def delay(self, kind:str, attempt:int) -> float:
+        if kind == PARSE:
+            # the model is not overloaded, nothing to wait for
+            return 0.0
+        base = self.base_delay * (2 if kind == THROTTLE else 1)
+        return random.uniform(0, min(self.max_delay, base * 2 ** attempt))
+
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def _count(name:str, n:float = 1):
+    with _stats_lock:
+        _stats[name] += n
+
+
+def retry_stats() -> Dict[str, float]:
+    """
+        process-wide counters: calls, attempts, failures per kind, repairs, follow-ups, regenerations,
+        gave_up and the seconds spent in backoff
+    """
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_retry_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def classify_exception(err:Exception) -> str:
+    if isinstance(err, (JSONDecodeError, ValidationError, OutputParserException)):
+        return PARSE
+    if is_throttling_error(err):
+        return THROTTLE
+    if isinstance(err, (BotoConnectionError, ReadTimeoutError, asyncio.TimeoutError, ConnectionError, TimeoutError)):
+        return TRANSIENT
+    if isinstance(err, ClientError):
+        code = err.response.get('Error', {}).get('Code')
+        status = err.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+        if code in TRANSIENT_CODES or status >= 500:
+            return TRANSIENT
+    return FATAL
+
+
+def _split_at_parser(chain):
+    """
+        (generate, parser, rest) for chain = generate | parser | *rest, or None when there is no parser step
+    """
+    steps = getattr(chain, 'steps', None)
+    if not isinstance(chain, RunnableSequence) or not steps:
+        return None
+    for i, step in enumerate(steps):
+        if isinstance(step, BaseOutputParser):
+            if i == 0:
+                return None
+            generate = steps[0] if i == 1 else RunnableSequence(*steps[:i])
+            return generate, step, steps[i+1:]
+    return None
+
+
+def _text(message) -> str:
+    content = getattr(message, 'content', message)
+    if isinstance(content, list):
+        return ''.join(block.get('text', '') if isinstance(block, dict) else str(block) for block in content)
+    return content if isinstance(content, str) else str(content)
+
+
+async def _finish(rest, value, config):
+    for step in rest:
+        value = await step.ainvoke(value, config)
+    return value
+
+
+async def _repair(parser, rest, raw, config):
+    """
+        re-parse the raw completion locally, raises the repair's own error when it cannot be fixed
+    """
+    if not isinstance(parser, CustJsonOuputParser):
+        raise ValueError("no local repair for this parser")
+    return await _finish(rest, repair_json(_text(raw)), config)
+
+
+def _corrective_prompt(parser, err:Exception) -> str:
+    prompt = TEXT_CORRECTIVE_PROMPT if isinstance(parser, TextOuputParser) else CORRECTIVE_PROMPT
+    return prompt.format(error=str(err)[:500])
+
+
+async def aretry_invoke(chain, args:Dict[str, Any], policy:Optional[RetryPolicy] = None, config=None):
+    """
+        chain.ainvoke(args) under policy. a completion that fails to parse is repaired locally first,
+        then sent back once with a short corrective message (when args has "messages"), before the
+        whole prompt is regenerated
+    """
+    policy = policy or RetryPolicy()
+    parts = _split_at_parser(chain)
+    deadline = time.monotonic() + policy.time_budget if policy.time_budget else None
+    _count('calls')
+    last_err = None
+    followup_args = None
+    followed_up = False
+    for attempt in range(policy.max_attempts):
+        _count('attempts')
+        if attempt:
+            telemetry.add('retries')
+        call_args = followup_args or args
+        raw = None
+        try:
+            if parts is None:
+                return await chain.ainvoke(call_args, config)
+            generate, parser, rest = parts
+            raw = await generate.ainvoke(call_args, config)
+            return await _finish([parser, *rest], raw, config)
+        except Exception as err:
+            last_err = err
+            kind = classify_exception(err)
+            _count(f'{kind}_errors')
+            telemetry.add(f'{kind}_errors')
+            if kind == FATAL:
+                raise
+            if kind == PARSE and raw is not None:
+                if policy.repair:
+                    try:
+                        result = await _repair(parser, rest, raw, config)
+                        _count('repaired')
+                        telemetry.add('repaired')
+                        return result
+                    except Exception:
+                        _count('repair_failed')
+                if policy.corrective_followup and not followed_up and 'messages' in args:
+                    # one cheap round trip: show the model its own answer and the error instead of starting over
+                    followup_args = {**args, 'messages': [*args['messages'], AIMessage(content=_text(raw)),
+                                                          HumanMessage(content=_corrective_prompt(parser, err))]}
+                    followed_up = True
+                    _count('followups')
+                    print(f'{type(err).__name__}, sending corrective follow-up [{attempt+1}/{policy.max_attempts}]')
+                    continue
+            followup_args = None
+            if attempt + 1 == policy.max_attempts:
+                break
+            if kind == PARSE:
+                _count('regenerations')
+            delay = policy.delay(kind, attempt)
+            if deadline is not None and time.monotonic() + delay > deadline:
+                break
+            print(f'{type(err).__name__} ({kind}), retry in {delay:.1f}s [{attempt+1}/{policy.max_attempts}]')
+            if delay:
+                _count('backoff_seconds', delay)
+                telemetry.add('backoff_s', delay)
+                await asyncio.sleep(delay)
+    _count('gave_up')
+    raise RetryError(f"giving up after {attempt+1} attempts: {last_err}") from last_err
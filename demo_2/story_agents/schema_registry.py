@@ -0,0 +1,142 @@
+"""
+    schema text for the structured output models, generated once per class and style:
+
+        get_schema(Outline)                 # Outline.schema_json(), as fc_desc has always used it
+        get_schema(Outline, 'minified')     # same schema, no whitespace and no auto-generated titles
+        get_schema(Outline, 'typescript')   # interface Outline { page_title: string; // ... }
+
+    models in structure_objects are registered by name, others (e.g. a notebook's StoryPrompt) with register()
+"""
+import json
+import threading
+from functools import lru_cache
+from typing import Dict, Type, Union
+from langchain_core.pydantic_v1 import BaseModel
+from story_agents import structure_objects
+
+SCHEMA_STYLES = ('json', 'minified', 'typescript')
+
+_registry: Dict[str, Type[BaseModel]] = {
+    name: obj for name, obj in vars(structure_objects).items()
+    if isinstance(obj, type) and issubclass(obj, BaseModel) and obj.__module__ == structure_objects.__name__
+}
+_registry_lock = threading.Lock()
+
+
+def register(model:Type[BaseModel]) -> Type[BaseModel]:
+    """
+        make model available to get_schema by name, usable as a class decorator
+    """
+    with _registry_lock:
+        _registry[model.__name__] = model
+    return model
+
+
+def registered_models() -> Dict[str, Type[BaseModel]]:
+    with _registry_lock:
+        return dict(_registry)
+
+
+def _auto_title(name:str) -> str:
+    return name.replace('_', ' ').title()
+
+
+def _strip_auto_titles(schema, name:str = None):
+    # pydantic titles every property after its name, which tells the model nothing
+    if isinstance(schema, dict):
+        out = {}
+        for key, value in schema.items():
+            if key == 'title' and name is not None and value in (name, _auto_title(name)):
+                continue
+            if key in ('properties', 'definitions'):
+                out[key] = {k: _strip_auto_titles(v, k) for k, v in value.items()}
+            else:
+                out[key] = _strip_auto_titles(value)
+        return out
+    if isinstance(schema, list):
+        return [_strip_auto_titles(v) for v in schema]
+    return schema
+
+
+_TS_TYPES = {'string': 'string', 'integer': 'number', 'number': 'number', 'boolean': 'boolean', 'null': 'null'}
+
+
+def _ts_type(prop:dict) -> str:
+    if '$ref' in prop:
+        return prop['$ref'].rsplit('/', 1)[-1]
+    if 'allOf' in prop and len(prop['allOf']) == 1:
+        return _ts_type(prop['allOf'][0])
+    if 'anyOf' in prop:
+        return ' | '.join(_ts_type(p) for p in prop['anyOf'])
+    if 'enum' in prop:
+        return ' | '.join(json.dumps(v) for v in prop['enum'])
+    kind = prop.get('type')
+    if kind == 'array':
+        item = _ts_type(prop.get('items') or {})
+        return f"({item})[]" if ' ' in item else f"{item}[]"
+    if kind == 'object':
+        if 'additionalProperties' in prop and isinstance(prop['additionalProperties'], dict):
+            return f"Record<string, {_ts_type(prop['additionalProperties'])}>"
+        return 'object'
+    return _TS_TYPES.get(kind, 'any')
+
+
+def _ts_comment(name:str, prop:dict) -> str:
+    notes = []
+    title = prop.get('title')
+    if title and title not in (name, _auto_title(name)):
+        notes.append(title)
+    if prop.get('description'):
+        notes.append(prop['description'])
+    if 'minItems' in prop or 'maxItems' in prop:
+        notes.append(f"{prop.get('minItems', 0)}..{prop.get('maxItems', 'n')} items")
+    return f" // {' - '.join(notes)}" if notes else ''
+
+
+def _ts_interface(name:str, schema:dict) -> str:
+    required = set(schema.get('required', []))
+    lines = []
+    if schema.get('description'):
+        lines.append(f"// {schema['description'].strip()}")
+    lines.append(f"interface {name} {{")
+    for prop_name, prop in schema.get('properties', {}).items():
+        optional = '' if prop_name in required else '?'
+        lines.append(f"  {prop_name}{optional}: {_ts_type(prop)};{_ts_comment(prop_name, prop)}")
+    lines.append('}')
+    return '\n'.join(lines)
+
+
+def to_typescript(model:Type[BaseModel]) -> str:
+    """
+        the model and the models it references as TypeScript-like interfaces, root first
+    """
+    schema = model.schema()
+    blocks = [_ts_interface(model.__name__, schema)]
+    for name, definition in schema.get('definitions', {}).items():
+        blocks.append(_ts_interface(name, definition))
+    return '\n'.join(blocks)
+
+
+def _resolve(model:Union[str, Type[BaseModel]]) -> Type[BaseModel]:
+    if isinstance(model, str):
+        with _registry_lock:
+            return _registry[model]
+    return model
+
+
+@lru_cache(maxsize=None)
+def _schema(model:Type[BaseModel], style:str) -> str:
+    if style == 'json':
+        return model.schema_json()
+    if style == 'minified':
+        return json.dumps(_strip_auto_titles(model.schema(), model.__name__), separators=(',', ':'), ensure_ascii=False)
+    if style == 'typescript':
+        return to_typescript(model)
+    raise ValueError(f"unknown schema style {style!r}, expected one of {SCHEMA_STYLES}")
+
+
+def get_schema(model:Union[str, Type[BaseModel]], style:str = 'json') -> str:
+    """
+        schema text of a model class (or registered model name) in the given style, cached per class
+    """
+    return _schema(_resolve(model), style)
@@ -0,0 +1,126 @@
+"""
+    producer/consumer stages over bounded asyncio queues, for work that flows item by item through
+    steps of different cost (write a chapter -> its image prompts -> its StoryDiffusion pages):
+
+        stages = [Stage('write', write_chapter, workers=4),
+                  Stage('image_prompt', image_prompt, workers=2),
+                  Stage('render', render, workers=4)]
+        pages = await StagePipeline(stages).arun(enumerate(outline.chapters))
+
+    each stage function is called as fn(key, value) and its result goes on to the next stage as soon as it
+    is returned, so a book takes about as long as its slowest stage rather than the sum of all of them.
+    a stage reads from a queue of at most maxsize items, a fast producer waits for a slow consumer instead
+    of piling up work. returning None, or raising, drops the item; errors are kept per (stage, key)
+"""
+import asyncio
+from collections import Counter
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, Iterable, Optional, Tuple
+
+_DONE = object()
+
+
+class Stage():
+    """
+        one step of a StagePipeline: `workers` concurrent calls of fn, fed from a queue of `maxsize`
+        items (defaults to twice the workers)
+    """
+
+    def __init__(self, name:str, fn:Callable[[Hashable, Any], Awaitable[Any]], workers:int = 1,
+                 maxsize:Optional[int] = None):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.maxsize = 2 * workers if maxsize is None else maxsize
+
+
+class StagePipeline():
+    """
+        runs (key, value) items through the stages in order. stats counts per stage the items done,
+        dropped (None) and failed, and the peak depth of its input queue
+    """
+
+    def __init__(self, stages:Iterable[Stage]):
+        self.stages = list(stages)
+        if not self.stages:
+            raise ValueError("a StagePipeline needs at least one stage")
+        self.errors: Dict[Tuple[str, Hashable], Exception] = {}
+        self.stats = {stage.name: Counter() for stage in self.stages}
+
+    async def astream(self, items) -> AsyncIterator[Tuple[Hashable, Any]]:
+        """
+            yields (key, result of the last stage) in completion order. items is an iterable or
+            async iterable of (key, value)
+        """
+        queues = [asyncio.Queue(maxsize=stage.maxsize) for stage in self.stages]
+        output = asyncio.Queue()
+
+        async def _put(index, item):
+            queue = queues[index] if index < len(queues) else output
+            await queue.put(item)
+            if index < len(queues):
+                stats = self.stats[self.stages[index].name]
+                stats['peak_queue'] = max(stats['peak_queue'], queue.qsize())
+
+        async def _feed():
+            if hasattr(items, '__aiter__'):
+                async for item in items:
+                    await _put(0, item)
+            else:
+                for item in items:
+                    await _put(0, item)
+
+        async def _work(index, stage):
+            stats = self.stats[stage.name]
+            while True:
+                item = await queues[index].get()
+                if item is _DONE:
+                    return
+                key, value = item
+                try:
+                    result = await stage.fn(key, value)
+                except Exception as err:
+                    print(f"{stage.name} {key} failed: {err!r}")
+                    self.errors[(stage.name, key)] = err
+                    stats['failed'] += 1
+                    continue
+                if result is None:
+                    stats['dropped'] += 1
+                    continue
+                stats['done'] += 1
+                await _put(index + 1, (key, result))
+
+        async def _close(index, running):
+            # once everything upstream has finished (or the item source failed), tell the next stage's workers to stop
+            error = None
+            try:
+                await asyncio.gather(*running)
+            except Exception as err:
+                error = err
+            consumers = self.stages[index].workers if index < len(self.stages) else 1
+            for _ in range(consumers):
+                await (queues[index] if index < len(queues) else output).put(_DONE)
+            if error is not None:
+                raise error
+
+        tasks = [asyncio.ensure_future(_close(0, [asyncio.ensure_future(_feed())]))]
+        for index, stage in enumerate(self.stages):
+            workers = [asyncio.ensure_future(_work(index, stage)) for _ in range(stage.workers)]
+            tasks.extend(workers)
+            tasks.append(asyncio.ensure_future(_close(index + 1, workers)))
+        try:
+            while True:
+                item = await output.get()
+                if item is _DONE:
+                    break
+                yield item
+            # surfaces an exception raised by the item source
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def arun(self, items) -> Dict[Hashable, Any]:
+        """
+            run astream to the end, {key: result of the last stage} for the items that made it through
+        """
+        return {key: result async for key, result in self.astream(items)}
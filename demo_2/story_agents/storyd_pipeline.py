@@ -0,0 +1,120 @@
+import os
+import json
+import asyncio
+from typing import Any, AsyncIterator, Iterable, List, Optional, Tuple
+from PIL import Image
+
+
+def chapter_dir(output_dir:str, index:int) -> str:
+    """
+        where agenerate_images(output_dir=...) should write a chapter's panels
+    """
+    return os.path.join(output_dir, f"chapter_{index:03d}")
+
+
+def write_chapter_manifest(output_dir:str, index:int, fnames:List[str]) -> List[str]:
+    """
+        mark a chapter whose panels are already on disk as done. written last (and atomically),
+        so a chapter only counts as done once all its images are there
+    """
+    manifest = os.path.join(chapter_dir(output_dir, index), "manifest.json")
+    os.makedirs(os.path.dirname(manifest), exist_ok=True)
+    with open(f"{manifest}.tmp", "w") as f:
+        json.dump({"chapter": index, "images": fnames}, f)
+    os.replace(f"{manifest}.tmp", manifest)
+    return fnames
+
+
+def save_chapter_images(images:list, output_dir:str, index:int) -> List[str]:
+    """
+        write one chapter's panels and its manifest. images that are already files in the chapter
+        folder (agenerate_images(output_dir=chapter_dir(...))) are listed as they are, not re-encoded
+    """
+    folder = chapter_dir(output_dir, index)
+    os.makedirs(folder, exist_ok=True)
+    fnames = []
+    for i, img in enumerate(images):
+        fname = getattr(img, 'filename', '')
+        if not (fname and os.path.dirname(os.path.abspath(fname)) == os.path.abspath(folder)):
+            fname = os.path.join(folder, f"{i}.png")
+            img.save(fname)
+        fnames.append(fname)
+    return write_chapter_manifest(output_dir, index, fnames)
+
+
+def load_chapter_images(output_dir:str, index:int) -> Optional[list]:
+    manifest = os.path.join(chapter_dir(output_dir, index), "manifest.json")
+    if not os.path.exists(manifest):
+        return None
+    with open(manifest) as f:
+        fnames = json.load(f)["images"]
+    return [Image.open(fname) for fname in fnames]
+
+
+async def agenerate_chapter_images(generator, storyd_prompts:Iterable[dict], max_in_flight:int = 4,
+                                   style:str = 'Comic book', comic_type:str = 'Classic Comic Style',
+                                   sd_type:str = "Unstable", height:int = 768, width:int = 768,
+                                   output_dir:Optional[str] = None) -> AsyncIterator[Tuple[int, Any]]:
+    """
+        pipeline chapters through the StoryDiffusion async endpoint.
+        pulls payloads lazily from storyd_prompts (e.g. prepare_storyd_prompts), keeps up to
+        max_in_flight requests submitted at once and yields (chapter_index, images) as they complete.
+        with output_dir each chapter is saved as soon as it arrives and chapters already on disk
+        are loaded instead of regenerated. a failed chapter yields (chapter_index, None)
+    """
+    prompts = enumerate(storyd_prompts)
+    pending = {}
+
+    async def _render(index, p):
+        if output_dir:
+            done = await asyncio.to_thread(load_chapter_images, output_dir, index)
+            if done is not None:
+                return done
+        print(f"Chapter:{index} \nprompts:{p['prompt_array']}")
+        images = await generator.agenerate_images(general_prompt = p['general_prompt'],
+                                                  style=style,
+                                                  comic_type = comic_type,
+                                                  prompt_array='\n'.join(p['prompt_array']),
+                                                  id_length= p['id_length'],
+                                                  sd_type = sd_type,
+                                                  ref_imgs=p['ref_imgs'],height=height,width=width,
+                                                  output_dir=chapter_dir(output_dir, index) if output_dir else None)
+        if output_dir:
+            # the panels were streamed to the chapter folder, only the manifest is left
+            await asyncio.to_thread(save_chapter_images, images, output_dir, index)
+        return images
+
+    def _fill():
+        while len(pending) < max_in_flight:
+            item = next(prompts, None)
+            if item is None:
+                return
+            index, p = item
+            pending[asyncio.ensure_future(_render(index, p))] = index
+
+    _fill()
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending.keys(), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                index = pending.pop(task)
+                try:
+                    images = task.result()
+                except Exception as err:
+                    print(f"Chapter {index} failed: {err}")
+                    images = None
+                yield index, images
+            _fill()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def agenerate_all_chapter_images(generator, storyd_prompts:Iterable[dict], max_in_flight:int = 4, **kwargs) -> list:
+    """
+        run agenerate_chapter_images to the end and return the image lists in chapter order
+    """
+    results = {}
+    async for index, images in agenerate_chapter_images(generator, storyd_prompts, max_in_flight=max_in_flight, **kwargs):
+        results[index] = images
+    return [results[i] for i in range(len(results))]
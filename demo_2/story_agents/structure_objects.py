@@ -109,6 +109,24 @@ class EditorSuggestion(BaseModel):
     def as_str(self) -> str:
         return "\n".join([f"{i+1}.{e}" for i,e in enumerate(self.suggestions)])
 
+
+class ImagePrompt(BaseModel):
+    prompt: str = Field(
+        description="an optimized prompt for the Stable Diffusion model based on the given instructions and guidelines, it should always be English",
+    )
+
+
+class StoryPrompt(BaseModel):
+    prompt: List[str] = Field(
+        description="""an optimized prompt of lines for the StoryDiffusion model based on the given instructions and guidelines,
+          it should always be English, make sure this list limits to maximum 5 items. 
+         Each line in the promt should be concise and less then 10 words and maximum 5 lines are allowed for the answer""",
+    )
+
+    @property
+    def as_str(self) -> str:
+        return '\n'.join(self.prompt[:5])
+
     
 class Story(BaseModel):
     """
@@ -0,0 +1,349 @@
+"""
+    spans and per-stage metrics for a book run:
+
+        tracer = Tracer(otel=True)              # otel: mirror every span to OpenTelemetry
+        set_tracer(tracer)
+        with span('write_chapter', chapter=3) as s:
+            ...
+            s.add('input_tokens', 812)          # numbers are summed per span name in the summary
+        tracer.write_summary('./book/telemetry.json')
+
+    numbers in ROLLUP also add up into the enclosing spans, so write_chapter carries the tokens of its llm
+    calls and the retries of its chain, and the book span the totals of the run.
+
+    instrumented: the pipeline's graph nodes and units, traced_llm calls (tokens), aretry_invoke (retries),
+    rate limiter and concurrency slot waits (queue_wait_s), StoryDiffusion and Bedrock image calls and
+    S3 transfers (bytes). with no tracer set, span() only costs a global lookup
+"""
+import json
+import time
+import asyncio
+import functools
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+from langchain_core.runnables import Runnable
+
+ROLLUP = ('input_tokens', 'output_tokens', 'cache_read_tokens', 'retries', 'queue_wait_s', 'bytes')
+# spans get numbers added from worker threads (asyncio.to_thread, thread pools) and their children's rollup,
+# one lock for every span's attrs keeps the read-modify-write of add() whole
+_attrs_lock = threading.Lock()
+
+
+class Span():
+    __slots__ = ('name', 'attrs', 'start', 'end', 'start_time', 'parent', 'error', '_otel')
+
+    def __init__(self, name:str, attrs:Dict[str, Any], parent:Optional['Span'] = None):
+        self.name = name
+        self.attrs = attrs
+        self.parent = parent
+        self.error = None
+        self.start_time = time.time()
+        self.start = time.perf_counter()
+        self.end = None
+        self._otel = None
+
+    def add(self, key:str, value:float = 1):
+        with _attrs_lock:
+            self.attrs[key] = self.attrs.get(key, 0) + value
+
+    def set(self, key:str, value:Any):
+        with _attrs_lock:
+            self.attrs[key] = value
+
+    def snapshot(self) -> Dict[str, Any]:
+        with _attrs_lock:
+            return dict(self.attrs)
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def to_dict(self) -> dict:
+        return {'name': self.name, 'parent': self.parent.name if self.parent else None,
+                'start_time': self.start_time, 'duration_s': round(self.duration, 6),
+                'error': self.error, **self.snapshot()}
+
+
+class _NoopSpan():
+    def add(self, key:str, value:float = 1):
+        pass
+
+    def set(self, key:str, value:Any):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def _percentile(values:List[float], q:float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+class Tracer():
+    """
+        collects finished spans in memory (up to max_spans) and summarises them per span name.
+        with otel each span is also started and ended on an OpenTelemetry tracer, parented like ours
+    """
+
+    def __init__(self, name:str = 'story_agents', otel:bool = False, max_spans:int = 100000):
+        self.name = name
+        self.max_spans = max_spans
+        self.spans: List[Span] = []
+        self.dropped = 0
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+        self._otel = None
+        if otel:
+            from opentelemetry import trace
+            self._otel = trace.get_tracer(name)
+
+    def start(self, name:str, attrs:Dict[str, Any], parent:Optional[Span]) -> Span:
+        s = Span(name, attrs, parent)
+        if self._otel is not None:
+            from opentelemetry import trace
+            context = trace.set_span_in_context(parent._otel) if parent is not None and parent._otel is not None else None
+            s._otel = self._otel.start_span(name, context=context, start_time=time.time_ns())
+        return s
+
+    def finish(self, s:Span):
+        s.end = time.perf_counter()
+        if s.parent is not None:
+            with _attrs_lock:
+                for key in ROLLUP:
+                    if key in s.attrs:
+                        s.parent.attrs[key] = s.parent.attrs.get(key, 0) + s.attrs[key]
+        if s._otel is not None:
+            from opentelemetry.trace import Status, StatusCode
+            s._otel.set_attributes({k: v for k, v in s.snapshot().items() if isinstance(v, (str, bool, int, float))})
+            if s.error:
+                s._otel.set_status(Status(StatusCode.ERROR, s.error))
+            s._otel.end()
+        with self._lock:
+            if len(self.spans) < self.max_spans:
+                self.spans.append(s)
+            else:
+                self.dropped += 1
+
+    def summary(self) -> Dict[str, Any]:
+        """
+            per span name: count, errors, total/mean/p50/p95/max seconds and the sum of every numeric attribute
+        """
+        with self._lock:
+            spans = list(self.spans)
+        groups: Dict[str, List[Span]] = {}
+        for s in spans:
+            groups.setdefault(s.name, []).append(s)
+        stages = {}
+        for name, group in groups.items():
+            durations = [s.duration for s in group]
+            entry = {'count': len(group), 'errors': sum(1 for s in group if s.error),
+                     'total_s': round(sum(durations), 3), 'mean_s': round(sum(durations) / len(durations), 4),
+                     'p50_s': round(_percentile(durations, 0.5), 4), 'p95_s': round(_percentile(durations, 0.95), 4),
+                     'max_s': round(max(durations), 4)}
+            for s in group:
+                for key, value in s.snapshot().items():
+                    if isinstance(value, (int, float)) and not isinstance(value, bool):
+                        entry[key] = entry.get(key, 0) + value
+            stages[name] = {k: round(v, 4) if isinstance(v, float) else v for k, v in entry.items()}
+        return {'wall_s': round(time.perf_counter() - self.started, 3), 'spans': len(spans), 'dropped_spans': self.dropped,
+                'stages': dict(sorted(stages.items(), key=lambda item: -item[1]['total_s']))}
+
+    def write_summary(self, path:str, include_spans:bool = False) -> str:
+        data = self.summary()
+        if include_spans:
+            with self._lock:
+                data['span_list'] = [s.to_dict() for s in self.spans]
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2, ensure_ascii=False, default=str)
+        return path
+
+
+_tracer: Optional[Tracer] = None
+_current: ContextVar[Optional[Span]] = ContextVar('story_agents_span', default=None)
+
+
+def get_tracer() -> Optional[Tracer]:
+    return _tracer
+
+
+def set_tracer(tracer:Optional[Tracer]) -> Optional[Tracer]:
+    """
+        make tracer the process wide one (None switches tracing off), returns the previous one
+    """
+    global _tracer
+    previous, _tracer = _tracer, tracer
+    return previous
+
+
+@contextmanager
+def span(name:str, **attrs):
+    tracer = _tracer
+    if tracer is None:
+        yield NOOP_SPAN
+        return
+    s = tracer.start(name, attrs, _current.get())
+    token = _current.set(s)
+    try:
+        yield s
+    except BaseException as err:
+        s.error = repr(err)
+        raise
+    finally:
+        _current.reset(token)
+        tracer.finish(s)
+
+
+def current_span():
+    return (_current.get() if _tracer is not None else None) or NOOP_SPAN
+
+
+def add(key:str, value:float = 1):
+    """
+        add to an attribute of the innermost open span
+    """
+    current_span().add(key, value)
+
+
+@asynccontextmanager
+async def timed_acquire(semaphore:asyncio.Semaphore):
+    """
+        async with semaphore, recording the time spent waiting for it as queue_wait_s
+    """
+    start = time.perf_counter()
+    async with semaphore:
+        add('queue_wait_s', time.perf_counter() - start)
+        yield
+
+
+def traced(name:Optional[str] = None):
+    """
+        decorator running each call of a function (sync or async) in a span named after it
+    """
+    def _decorate(fn):
+        span_name = name or fn.__name__
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def _async(*args, **kwargs):
+                with span(span_name):
+                    return await fn(*args, **kwargs)
+            return _async
+
+        @functools.wraps(fn)
+        def _sync(*args, **kwargs):
+            with span(span_name):
+                return fn(*args, **kwargs)
+        return _sync
+    return _decorate
+
+
+def _record_usage(s, prompt, response):
+    usage = getattr(response, 'usage_metadata', None) or {}
+    if usage:
+        s.add('input_tokens', usage.get('input_tokens', 0))
+        s.add('output_tokens', usage.get('output_tokens', 0))
+        details = usage.get('input_token_details') or {}
+        if details.get('cache_read'):
+            s.add('cache_read_tokens', details['cache_read'])
+    else:
+        # no usage reported, estimate like the rate limiter does
+        from story_agents.graph_runner import estimate_tokens, _prompt_text
+        s.add('input_tokens', estimate_tokens(_prompt_text(prompt)))
+        s.add('output_tokens', estimate_tokens(str(getattr(response, 'content', response))))
+
+
+class TracedLLM(Runnable):
+    """
+        a chat model whose calls are spans with their input/output tokens, see traced_llm. keyword arguments
+        (stop=...) go through to the model, and stream/astream stream through in a span that lasts until the
+        stream ends or is closed, with the usage of the aggregated chunks
+    """
+
+    def __init__(self, llm, name:str = 'llm', model_id:Optional[str] = None):
+        self.llm = llm
+        self.span_name = name
+        self.name = f"traced_{name}"
+        self.model_id = model_id
+
+    def invoke(self, input, config=None, **kwargs):
+        with span(self.span_name, model=str(self.model_id)) as s:
+            response = self.llm.invoke(input, config, **kwargs)
+            _record_usage(s, input, response)
+            return response
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        with span(self.span_name, model=str(self.model_id)) as s:
+            response = await self.llm.ainvoke(input, config, **kwargs)
+            _record_usage(s, input, response)
+            return response
+
+    def _open(self):
+        # not made the current span: a generator cannot hold span()'s context across its yields
+        tracer = _tracer
+        if tracer is None:
+            return None, NOOP_SPAN
+        return tracer, tracer.start(self.span_name, {'model': str(self.model_id)}, _current.get())
+
+    def _close(self, tracer, s, input, message, error):
+        if tracer is None:
+            return
+        if message is not None:
+            _record_usage(s, input, message)
+        s.error = error
+        tracer.finish(s)
+
+    def stream(self, input, config=None, **kwargs):
+        tracer, s = self._open()
+        message, error = None, None
+        try:
+            for chunk in self.llm.stream(input, config, **kwargs):
+                message = chunk if message is None else message + chunk
+                yield chunk
+        except Exception as err:
+            error = repr(err)
+            raise
+        finally:
+            self._close(tracer, s, input, message, error)
+
+    async def astream(self, input, config=None, **kwargs):
+        tracer, s = self._open()
+        message, error = None, None
+        try:
+            async for chunk in self.llm.astream(input, config, **kwargs):
+                message = chunk if message is None else message + chunk
+                yield chunk
+        except Exception as err:
+            error = repr(err)
+            raise
+        finally:
+            self._close(tracer, s, input, message, error)
+
+
+def traced_llm(llm, name:str = 'llm', model_id:Optional[str] = None) -> TracedLLM:
+    """
+        wrap a chat model (or rate_limited one) so every call is a span with its input/output tokens.
+        drop-in for llm in `prompt | llm | parser`, streaming included
+    """
+    model_id = model_id or getattr(llm, 'model_id', None) or getattr(llm, 'model', None) or getattr(llm, 'name', None)
+    return TracedLLM(llm, name, model_id)
+
+
+def configure_opentelemetry(service_name:str = 'story_agents'):
+    """
+        set an OpenTelemetry SDK tracer provider exporting over OTLP (OTEL_EXPORTER_OTLP_* environment
+        variables apply), unless the application already configured one. needs opentelemetry-sdk and
+        opentelemetry-exporter-otlp
+    """
+    from opentelemetry import trace
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    if isinstance(trace.get_tracer_provider(), TracerProvider):
+        return trace.get_tracer_provider()
+    provider = TracerProvider(resource=Resource.create({'service.name': service_name}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+    return provider
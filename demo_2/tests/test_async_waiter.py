@@ -0,0 +1,68 @@
+import asyncio
+import json
+import threading
+import time
+import pytest
+from bench.fakes import FakeS3Client, FakeSqsClient
+from story_agents.async_waiter import FAILURE, SUCCESS, BackoffWaiter, SqsCompletionListener, WaiterTimeoutError
+
+
+def _waiter(s3, timeout=5.0):
+    return BackoffWaiter(s3, initial_delay=0.01, max_delay=0.05, timeout=timeout)
+
+
+def test_wait_returns_once_the_output_appears():
+    s3 = FakeS3Client()
+    threading.Timer(0.1, s3.put_object, kwargs={'Bucket': 'b', 'Key': 'out.json', 'Body': b'{}'}).start()
+    assert _waiter(s3).wait('s3://b/out.json', 's3://b/err.json') == SUCCESS
+    # polls started sub-second and backed off, not one per 10 seconds
+    assert 2 < s3.calls['head_object'] < 40
+
+
+def test_await_completion_reports_failure():
+    s3 = FakeS3Client()
+    s3.put_object(Bucket='b', Key='err.json', Body=b'boom')
+    assert asyncio.run(_waiter(s3).await_completion('s3://b/out.json', 's3://b/err.json')) == FAILURE
+
+
+def test_timeout():
+    with pytest.raises(WaiterTimeoutError):
+        _waiter(FakeS3Client(), timeout=0.1).wait('s3://b/out.json')
+    with pytest.raises(WaiterTimeoutError):
+        asyncio.run(_waiter(FakeS3Client(), timeout=0.1).await_completion('s3://b/out.json'))
+
+
+def _notification(location, completed=True):
+    return json.dumps({'invocationStatus': 'Completed' if completed else 'Failed',
+                       'responseParameters': {'outputLocation': location}})
+
+
+def test_listener_keeps_early_notifications_but_bounds_the_unclaimed():
+    sqs = FakeSqsClient()
+    listener = SqsCompletionListener(sqs, 'queue', wait_time_seconds=0.05, max_unclaimed=3)
+    try:
+        for i in range(10):
+            sqs.send_message(QueueUrl='queue', MessageBody=_notification(f's3://b/other/{i}'))
+        sqs.send_message(QueueUrl='queue', MessageBody=_notification('s3://b/out.json'))
+        deadline = time.monotonic() + 5
+        while listener.status('s3://b/out.json') is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # the notification beat register(), the wait still ends right away
+        assert listener.register('s3://b/out.json').is_set()
+        assert len(listener._unclaimed) <= 3
+        listener.forget('s3://b/out.json')
+        assert listener.status('s3://b/out.json') is None
+    finally:
+        listener.stop()
+
+
+def test_unclaimed_notifications_expire():
+    listener = SqsCompletionListener(FakeSqsClient(), 'queue', wait_time_seconds=0.05, unclaimed_ttl=0.05)
+    try:
+        listener._complete('s3://b/stale.json', SUCCESS)
+        assert listener.status('s3://b/stale.json') == SUCCESS
+        time.sleep(0.1)
+        assert not listener.register('s3://b/new.json').is_set()
+        assert listener.status('s3://b/stale.json') is None
+    finally:
+        listener.stop()
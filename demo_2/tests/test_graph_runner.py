@@ -0,0 +1,57 @@
+import asyncio
+import pytest
+from botocore.exceptions import ClientError
+from langchain_core.messages import AIMessageChunk
+from bench.fakes import FakeChatModel
+from story_agents.graph_runner import ModelRateLimiter, get_rate_limiter, rate_limited
+
+
+def _limiter():
+    return ModelRateLimiter('test', requests_per_minute=60000, tokens_per_minute=10**9)
+
+
+def test_stop_reaches_the_model():
+    llm = rate_limited(FakeChatModel(latency=0, respond=lambda t: "<answer>hi</answer> more"), limiter=_limiter())
+    assert llm.invoke("x", stop=["</answer>"]).content == "<answer>hi"
+    assert asyncio.run(llm.ainvoke("x", stop=["</answer>"])).content == "<answer>hi"
+
+
+def test_astream_keeps_chunks():
+    fake = FakeChatModel(latency=0, respond=lambda t: "a" * 100, stream_chunk_chars=10)
+    limiter = _limiter()
+    llm = rate_limited(fake, limiter=limiter)
+
+    async def _chunks():
+        return [chunk async for chunk in llm.astream("x")]
+    chunks = asyncio.run(_chunks())
+    assert len(chunks) == 10 and all(isinstance(c, AIMessageChunk) for c in chunks)
+    assert limiter.stats['calls'] == 1
+
+
+def test_astream_retries_throttling_before_the_first_chunk():
+    class Flaky(FakeChatModel):
+        async def astream(self, input, config=None, **kwargs):
+            self.calls['attempts'] += 1
+            if self.calls['attempts'] == 1:
+                raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'slow down'}}, 'Converse')
+            async for chunk in super().astream(input, config, **kwargs):
+                yield chunk
+
+    fake = Flaky(latency=0, respond=lambda t: "ok")
+    llm = rate_limited(fake, limiter=_limiter(), base_delay=0.0)
+
+    async def _text():
+        return ''.join([chunk.content async for chunk in llm.astream("x")])
+    assert asyncio.run(_text()) == "ok"
+    assert fake.calls['attempts'] == 2
+
+
+def test_get_rate_limiter_rejects_conflicting_limits():
+    limiter = get_rate_limiter('conflict-test', requests_per_minute=10, tokens_per_minute=1000)
+    assert get_rate_limiter('conflict-test') is limiter
+    assert get_rate_limiter('conflict-test', requests_per_minute=10) is limiter
+    assert rate_limited(FakeChatModel(latency=0), model_id='conflict-test').limiter is limiter
+    with pytest.raises(ValueError):
+        get_rate_limiter('conflict-test', requests_per_minute=20)
+    with pytest.raises(ValueError):
+        rate_limited(FakeChatModel(latency=0), model_id='conflict-test', tokens_per_minute=5)
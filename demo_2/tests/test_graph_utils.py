@@ -0,0 +1,51 @@
+import asyncio
+import json
+import threading
+from story_agents.graph_runner import run_graphs
+from story_agents.graph_utils import FinalStateReducer, SpillWriter
+
+
+class _Workflow():
+    def __init__(self, steps):
+        self.steps = steps
+
+    async def astream(self, input):
+        for step in range(self.steps):
+            await asyncio.sleep(0)
+            yield {'writer': {'env_var': {'run': input['run'], 'step': step, 'text': 'x' * 2000}}}
+
+
+def test_run_graphs_spill_lines_never_interleave(tmp_path):
+    path = str(tmp_path / 'audit.jsonl')
+    init_states = [{'run': i} for i in range(8)]
+    results = asyncio.run(run_graphs(_Workflow(25), init_states, 'writer', spill_path=path))
+    assert [r['run'] for r in results] == list(range(8))
+    with open(path, encoding='utf-8') as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) == 8 * 25
+    for record in records:
+        assert record['run'] == str(record['update']['env_var']['run'])
+
+
+def test_shared_writer_from_threads(tmp_path):
+    path = str(tmp_path / 'audit.jsonl')
+    writer = SpillWriter(path)
+
+    def _run(i):
+        reducer = FinalStateReducer(writer, run_id=str(i))
+        for step in range(50):
+            reducer.update({'node': {'env_var': {'step': step, 'text': str(i) * 5000}}})
+        reducer.close()
+
+    threads = [threading.Thread(target=_run, args=(i,)) for i in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # the reducers do not own the shared writer, so it is still open here
+    writer.write({'run': 'end'})
+    writer.close()
+    with open(path, encoding='utf-8') as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) == 6 * 50 + 1
+    assert all(set(r['update']['env_var']['text']) == {r['run']} for r in records[:-1])
@@ -0,0 +1,68 @@
+import os
+from story_agents.image_cache import ImageCache
+
+
+def test_round_trip_and_reload(tmp_path):
+    cache = ImageCache(str(tmp_path))
+    key = ImageCache.make_key('model', {'prompt': 'a boy'})
+    assert cache.get(key) is None
+    cache.put(key, [b'one', b'two'])
+    assert cache.get(key) == [b'one', b'two']
+    assert ImageCache(str(tmp_path)).get(key) == [b'one', b'two']
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+
+def test_lru_eviction(tmp_path):
+    cache = ImageCache(str(tmp_path), max_bytes=10)
+    keys = [ImageCache.make_key(i) for i in range(3)]
+    cache.put(keys[0], [b'aaaa'])
+    cache.put(keys[1], [b'bbbb'])
+    assert cache.get(keys[0]) == [b'aaaa']
+    cache.put(keys[2], [b'cccc'])
+    # keys[1] was the least recently used
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) == [b'aaaa'] and cache.get(keys[2]) == [b'cccc']
+    assert cache.stats()['bytes'] == 8
+
+
+def test_put_files_and_leftover_tmp_dirs(tmp_path):
+    src = tmp_path / 'src.png'
+    src.write_bytes(b'png')
+    cache_dir = str(tmp_path / 'cache')
+    cache = ImageCache(cache_dir)
+    key = ImageCache.make_key('file')
+    cache.put_files(key, [str(src)])
+    assert cache.get(key) == [b'png']
+    leftover = os.path.join(cache_dir, key[:2], '.tmpdeadbeef')
+    os.makedirs(leftover)
+    ImageCache(cache_dir)
+    assert not os.path.exists(leftover)
+
+
+def test_malformed_entries_are_quarantined_and_stray_files_ignored(tmp_path):
+    cache_dir = str(tmp_path)
+    cache = ImageCache(cache_dir)
+    good = ImageCache.make_key('good')
+    cache.put(good, [b'one'])
+    (tmp_path / 'notes.txt').write_text('not an entry')
+    (tmp_path / 'ab').write_text('a file where a prefix directory would be')
+    prefix = tmp_path / 'cd'
+    prefix.mkdir()
+    (prefix / ('cd' + '0' * 62)).write_text('a file where an entry directory would be')
+    (prefix / ('cd' + '1' * 62)).mkdir()
+    (prefix / ('cd' + '2' * 62)).mkdir()
+    (prefix / ('cd' + '2' * 62) / 'thumbnail.jpg').write_bytes(b'x')
+    (prefix / ('ef' + '3' * 62)).mkdir()
+    (prefix / ('ef' + '3' * 62) / '0.png').write_bytes(b'misplaced')
+
+    reloaded = ImageCache(cache_dir)
+    stats = reloaded.stats()
+    assert stats['entries'] == 1 and stats['bytes'] == 3 and stats['quarantined'] == 4
+    assert reloaded.get(good) == [b'one']
+    assert os.listdir(prefix) == []
+    assert len(os.listdir(os.path.join(cache_dir, '.quarantine'))) == 4
+    assert (tmp_path / 'notes.txt').exists() and (tmp_path / 'ab').exists()
+    # a quarantined key can be stored again
+    key = 'cd' + '2' * 62
+    reloaded.put(key, [b'fresh'])
+    assert reloaded.get(key) == [b'fresh']
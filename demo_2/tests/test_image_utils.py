@@ -0,0 +1,104 @@
+import re
+import time
+import asyncio
+from bench.fakes import FakeBedrockRuntimeClient
+from story_agents.image_utils import ImageGenerator, TagIndex, calc_id_length_prompt, prepare_storyd_prompts
+from story_agents.structure_objects import Character, Persona
+
+
+def _old_prepare_storyd_prompts(story_lines, characters, img_dicts):
+    # the regex based version TagIndex replaced, minus its debug print
+    character_names = [characters.main_character.name]
+    name_figure_map = {characters.main_character.name: characters.main_character.figure}
+    for ch in characters.supporting_character:
+        character_names += [ch.name]
+        name_figure_map[ch.name] = ch.figure
+    for line in story_lines:
+        name_counter = {}
+        for name in character_names:
+            if f"[{name}]" in line:
+                name_counter[name] = name_counter.get(name, 0) + 1
+        name_counter = name_counter or {'[NC]': 1}
+        ref_imgs = []
+        figures = []
+        for key in list(name_counter.keys()):
+            if key != '[NC]':
+                ref_imgs.append(img_dicts[key])
+                figures.append(f"[{key}] {name_figure_map[key]} img")
+            else:
+                figures.append("[NC]")
+        prompt_array_new = []
+        pattern = r"\[(.*?)\]"
+        for text in line.split("\n"):
+            new_prompt = text
+            match = re.findall(pattern, text)
+            if match and match[0] != 'NC' and match[0] not in list(name_counter.keys())[:2]:
+                new_prompt = new_prompt.replace(f"[{match[0]}]", name_figure_map[key], 1)
+            match = re.findall(pattern, new_prompt)
+            if match and len(match) > 1:
+                for k in match[1:]:
+                    if k != 'NC' and k in list(name_counter.keys()):
+                        new_prompt = new_prompt.replace(f"[{k}]", name_figure_map[k])
+            if not re.findall(pattern, new_prompt):
+                new_prompt = '[NC]' + new_prompt
+            prompt_array_new.append(new_prompt + '#' + text)
+        general_prompt = '\n'.join(figures[:2])
+        prompt_array_new = [f.replace(' img', '') for f in figures[:2]] + prompt_array_new
+        id_length = min(calc_id_length_prompt(general_prompt, prompt_array_new), 2)
+        yield {'prompt_array': prompt_array_new, 'id_length': id_length, 'ref_imgs': ref_imgs[:2],
+               'general_prompt': general_prompt}
+
+
+def _persona(name, figure):
+    return Persona(name=name, role="explorer", background="sailor", figure=figure, appearance="raincoat")
+
+
+CHARACTERS = Character(main_character=_persona("Liam", "a boy"),
+                       supporting_character=[_persona("Mia", "a girl"), _persona("Tom", "an old man")])
+IMG_DICTS = {"Liam": "liam.png", "Mia": "mia.png", "Tom": "tom.png"}
+STORY_LINES = [
+    "[Liam] finds a map\n[Liam] and [Mia] read it",
+    "[Mia] waves\nthe boat leaves the harbour\n[NC] waves crash",
+    "[Liam] meets [Mia] and [Tom]\n[Mia] laughs with [Liam]\n[Tom] steers the boat",
+    "[Tom] tells a story\n[Tom] points at [Mia]",
+    "the sea is calm",
+    "[Liam] [Liam] repeats himself\n[Mia] [NC] [Liam] look around",
+]
+
+
+def test_tag_index_matches_the_regex():
+    text = "[Liam] meets [Mia]\nno tags\n[NC] [] [Tom]"
+    index = TagIndex(text)
+    assert index.lines == text.split("\n")
+    assert [[tag for tag, _, _ in records] for records in index.records] == [re.findall(r"\[(.*?)\]", line) for line in index.lines]
+    assert index.tags == {"Liam", "Mia", "NC", "", "Tom"}
+
+
+def test_prepare_storyd_prompts_matches_the_old_version():
+    new = list(prepare_storyd_prompts(STORY_LINES, CHARACTERS, IMG_DICTS))
+    old = list(_old_prepare_storyd_prompts(STORY_LINES, CHARACTERS, IMG_DICTS))
+    assert new == old
+
+
+class _SlowFirstClient(FakeBedrockRuntimeClient):
+    # invoke_model for the prompt 'slow' hangs well past any deadline
+    def invoke_model(self, body, **kwargs):
+        if '"slow"' in body:
+            time.sleep(1.0)
+        return super().invoke_model(body=body, **kwargs)
+
+
+def test_batch_deadline_returns_none_for_slow_images():
+    generator = ImageGenerator(client=_SlowFirstClient(latency=0.01, jitter=0))
+    start = time.perf_counter()
+    images = generator.generate_images_batch(['slow', 'fast', 'fast'], max_concurrency=3, timeout=0.3)
+    assert time.perf_counter() - start < 0.9
+    assert images[0] is None and images[1] is not None and images[2] is not None
+
+
+def test_async_deadline_returns_none_for_slow_images():
+    generator = ImageGenerator(client=_SlowFirstClient(latency=0.01, jitter=0))
+    start = time.perf_counter()
+    images = asyncio.run(generator.agenerate_images_batch(['fast', 'slow'], max_concurrency=2, timeout=0.3))
+    assert time.perf_counter() - start < 0.9
+    assert images[0] is not None and images[1] is None
@@ -0,0 +1,26 @@
+import os
+import threading
+from PIL import Image
+from story_agents.image_utils import save_all_images_names
+from story_agents.image_writer import _write
+
+
+def test_concurrent_writes_to_one_path_leave_a_whole_file(tmp_path):
+    path = str(tmp_path / 'page.png')
+    payloads = [bytes([i]) * 200000 for i in range(8)]
+    threads = [threading.Thread(target=_write, args=(path, data)) for data in payloads]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    with open(path, 'rb') as f:
+        assert f.read() in payloads
+    assert os.listdir(tmp_path) == ['page.png']
+
+
+def test_save_all_images_names_in_worker_processes(tmp_path):
+    images = [Image.new('RGB', (32, 32), color) for color in ('red', 'blue')] + [None]
+    paths = save_all_images_names(images, ['a', 'b', 'c'], str(tmp_path))
+    assert paths == [str(tmp_path / 'a.png'), str(tmp_path / 'b.png'), None]
+    with Image.open(paths[1]) as img:
+        assert img.getpixel((0, 0)) == (0, 0, 255)
@@ -0,0 +1,184 @@
+import asyncio
+from json import JSONDecodeError
+import pytest
+from bench.fakes import FakeChatModel
+from story_agents.graph_runner import ModelRateLimiter, rate_limited
+from story_agents.llm_utils import (CustJsonOuputParser, TextOuputParser, early_stop_llm, early_stop_stats, load_answer_json,
+                                    repair_json, reset_early_stop_stats)
+from story_agents.telemetry import traced_llm
+
+ANSWER = "<thinking>warm</thinking>\n<answer>Mia waves.</answer>\n\nSome notes on the answer."
+JSON_ANSWER = '```json\n{"content": "ok"}\n```\n\nSome notes on the answer.'
+
+
+def test_text_parser_raises_a_parse_error_without_answer():
+    with pytest.raises(JSONDecodeError):
+        TextOuputParser(verbose=False).parse("no answer here")
+    with pytest.raises(JSONDecodeError):
+        TextOuputParser(verbose=False).parse("<answer>hi")
+    assert TextOuputParser(verbose=False, allow_unclosed=True).parse("<answer> hi") == "hi"
+
+
+@pytest.mark.parametrize("wrap", [lambda m: m, traced_llm,
+                                  lambda m: rate_limited(m, limiter=ModelRateLimiter('t', 60000, 10**9)),
+                                  lambda m: traced_llm(rate_limited(m, limiter=ModelRateLimiter('t', 60000, 10**9)))])
+def test_stop_sequence_is_put_back_for_the_default_parser(wrap):
+    model = FakeChatModel(latency=0, respond=lambda t: ANSWER)
+    parser = TextOuputParser(verbose=False)
+    chain = early_stop_llm(wrap(model), parser) | parser
+    reset_early_stop_stats()
+    assert chain.invoke("x") == "Mia waves."
+    assert asyncio.run(chain.ainvoke("x")) == "Mia waves."
+    assert early_stop_stats()['stop_sequences'] == 2
+
+
+def test_stream_closed_at_the_delimiter():
+    model = FakeChatModel(latency=0, respond=lambda t: ANSWER, stream_chunk_chars=8)
+    parser = TextOuputParser(verbose=False)
+    reset_early_stop_stats()
+    message = asyncio.run(early_stop_llm(model, parser, stop_sequences=False).ainvoke("x"))
+    assert message.content.endswith("</answer>") and message.response_metadata['early_stop']
+    assert model.calls['streamed_chars'] < len(ANSWER)
+    assert parser.parse(message.content) == "Mia waves."
+
+
+def test_json_fence_ends_the_stream():
+    model = FakeChatModel(latency=0, respond=lambda t: JSON_ANSWER, stream_chunk_chars=8)
+    parser = CustJsonOuputParser(verbose=False)
+    chain = early_stop_llm(traced_llm(model), parser) | parser
+    assert asyncio.run(chain.ainvoke("x")) == {"content": "ok"}
+    assert model.calls['streamed_chars'] < len(JSON_ANSWER)
+
+
+def test_no_stop_sequence_put_back_when_the_answer_never_opened():
+    model = FakeChatModel(latency=0, respond=lambda t: "I cannot answer that.")
+    parser = TextOuputParser(verbose=False)
+    with pytest.raises(JSONDecodeError):
+        (early_stop_llm(model, parser) | parser).invoke("x")
+
+
+def _reference_swap_roles(messages, name):
+    from langchain_core.messages import AIMessage, HumanMessage
+    return [HumanMessage(**m.dict(exclude={"type"})) if isinstance(m, AIMessage) and m.name != name else m
+            for m in messages]
+
+
+def _reference_merge(messages):
+    from langchain_core.messages import AIMessage, HumanMessage
+    from story_agents.llm_utils import convert_message_name
+    merged = []
+    for message in map(convert_message_name, messages):
+        if merged and isinstance(merged[0], AIMessage):
+            merged[0] = HumanMessage(content=merged[0].content)
+        if merged and isinstance(merged[-1], AIMessage) == isinstance(message, AIMessage):
+            content = merged[-1].content + "\n\n" + message.content
+            merged[-1] = AIMessage(content=content) if isinstance(message, AIMessage) else HumanMessage(content=content)
+        else:
+            merged.append(message)
+    return merged
+
+
+def _log(turns):
+    from langchain_core.messages import AIMessage, HumanMessage
+    agents = ('cartoonist', 'editor')
+    log = [HumanMessage(content="the topic", name='editor')]
+    for i in range(turns):
+        name = agents[i % 2] if i % 3 else agents[(i - 1) % 2]
+        log = log + [AIMessage(content=f"turn {i}", name=name)]
+        yield log
+
+
+def _dump(messages):
+    return [(m.type, m.name, m.content) for m in messages]
+
+
+@pytest.mark.parametrize("merge", [False, True])
+def test_role_view_matches_swap_roles_on_a_growing_log(merge):
+    from story_agents.llm_utils import role_view
+    for log in _log(12):
+        for name in ('cartoonist', 'editor'):
+            expected = _reference_swap_roles(log, name)
+            if merge:
+                expected = _reference_merge(expected)
+            assert _dump(role_view(log, name, merge=merge)) == _dump(expected)
+
+
+def test_swap_roles_and_reconstruct_keep_their_results():
+    from story_agents.llm_utils import reconstruct_to_claude_messages, swap_roles
+    log = list(_log(7))[-1]
+    assert _dump(swap_roles(log, 'editor')) == _dump(_reference_swap_roles(log, 'editor'))
+    assert _dump(reconstruct_to_claude_messages(log)) == _dump(_reference_merge(log))
+
+
+def test_role_view_does_not_keep_lists_built_per_call():
+    from langchain_core.messages import AIMessage, HumanMessage
+    from story_agents import llm_utils
+    before = len(llm_utils._role_views)
+    kept = []
+    for i in range(50):
+        # like ConversationMemory.view: a new task message and list on every call
+        messages = [HumanMessage(content=f"task with summary {i}"), AIMessage(content="draft", name='cartoonist')]
+        kept.append(messages)
+        assert _dump(llm_utils.role_view(messages, 'editor')) == _dump(_reference_swap_roles(messages, 'editor'))
+    assert len(llm_utils._role_views) == before
+
+
+@pytest.mark.parametrize("raw, expected", [
+    ('{"a": "plain"}', {"a": "plain"}),
+    ('{"a": "she said "hi" twice"}', {"a": 'she said "hi" twice'}),
+    ('{"a": "line\\\\nbreak"}', {"a": "line\nbreak"}),
+    ('{"a": "it\\\'s"}', {"a": "it's"}),
+    ('{"a": "C:\\\\path \\q"}', {"a": "C:\\path \\q"}),
+    ('{"a": "x",\r\n "b": "y"}', {"a": "x", "b": "y"}),
+    ('{"a": "raw\nnewline"}', {"a": "raw\nnewline"}),
+])
+def test_load_answer_json_sanitizes(raw, expected):
+    assert load_answer_json(raw) == expected
+
+
+@pytest.mark.parametrize("raw, expected", [
+    ('```json\n{"a": 1, "b": [1, 2,],}\n```', {"a": 1, "b": [1, 2]}),
+    ('Sure! {"a": "cut off', {"a": "cut off"}),
+    ('{"a": "raw\nnewline", "b": "she said "hi""}', {"a": "raw\nnewline", "b": 'she said "hi"'}),
+    ('```json\n{"chapters": [{"title": "one"}, {"title": "tw', {"chapters": [{"title": "one"}, {"title": "tw"}]}),
+])
+def test_repair_json(raw, expected):
+    assert repair_json(raw) == expected
+
+
+def test_repair_json_without_json_raises():
+    with pytest.raises(JSONDecodeError):
+        repair_json("no json here")
+
+
+def test_measured_early_stops_estimate_the_savings():
+    commentary = "x" * 400
+    model = FakeChatModel(latency=0.2, respond=lambda t: JSON_ANSWER + commentary, stream_chunk_chars=20)
+    parser = CustJsonOuputParser(verbose=False)
+    llm = early_stop_llm(model, parser, measure_every=2)
+    reset_early_stop_stats()
+
+    async def _run():
+        for _ in range(4):
+            assert await (llm | parser).ainvoke("x") == {"content": "ok"}
+        for _ in range(100):
+            if early_stop_stats().get('measured_calls', 0) == 2:
+                break
+            await asyncio.sleep(0.02)
+    asyncio.run(_run())
+    stats = early_stop_stats()
+    assert stats['early_stops'] == 4 and stats['measured_calls'] == 2
+    tail = len(JSON_ANSWER + commentary) - (JSON_ANSWER.index('```\n') + 3)
+    assert stats['saved_chars_per_call'] == tail
+    assert stats['saved_tokens'] == tail / 4 * 2
+    # most of the 0.2s completion is commentary
+    assert 0.1 < stats['saved_seconds_per_call'] < 0.5
+
+
+def test_measure_every_zero_closes_every_stream():
+    model = FakeChatModel(latency=0, respond=lambda t: JSON_ANSWER)
+    parser = CustJsonOuputParser(verbose=False)
+    reset_early_stop_stats()
+    for _ in range(3):
+        (early_stop_llm(model, parser, measure_every=0) | parser).invoke("x")
+    assert 'measured_calls' not in early_stop_stats() and 'saved_seconds' not in early_stop_stats()
@@ -0,0 +1,32 @@
+from langchain_core.messages import AIMessage, HumanMessage
+from story_agents.memory import ConversationMemory
+
+
+def _conversation(turns:int):
+    messages = [HumanMessage(content="write chapter 1 " * 20, name='editor')]
+    for i in range(turns):
+        messages.append(AIMessage(content=f"draft {i} " + "Liam sails. " * 100, name='cartoonist'))
+        messages.append(AIMessage(content=f"review {i} " + "more dialogue. " * 100, name='editor'))
+    return messages
+
+
+def _tokens(view):
+    return sum(len(m.content) // 4 + 1 for m in view)
+
+
+def test_per_node_budgets():
+    messages = _conversation(6)
+    memory = ConversationMemory(token_budget={'write_chapter': 1200, 'refine_chapter': 1000})
+    write = memory.view(messages, 'write_chapter')
+    refine = memory.view(messages, 'refine_chapter')
+    other = memory.view(messages, 'generate_outline')
+    assert _tokens(refine) <= 1000 < _tokens(write) <= 1200 < _tokens(other)
+    report = memory.report()
+    assert report['write_chapter'].get('over_budget', 0) == 0 and report['refine_chapter'].get('over_budget', 0) == 0
+
+
+def test_budget_argument_overrides():
+    messages = _conversation(6)
+    memory = ConversationMemory(token_budget=5000)
+    assert _tokens(memory.view(messages, 'write_chapter', budget=1000)) <= 1000 < _tokens(memory.view(messages, 'write_chapter'))
+    assert memory.budget('write_chapter') == 5000 and memory.budget('write_chapter', 1000) == 1000
@@ -0,0 +1,50 @@
+import pytest
+from bench.fakes import FakeChatModel, fake_book_respond
+from story_agents.pipeline import BookPipeline, CheckpointStore, PipelineError
+from story_agents.schema_registry import get_schema
+from story_agents.structure_objects import DetailChapter
+
+
+def test_checkpoint_store_round_trip(tmp_path):
+    store = CheckpointStore(str(tmp_path))
+    assert store.load('chapters/000') is None
+    chapter = DetailChapter(chapter_title="Chapter 0", content="Liam sails.")
+    store.save('chapters/000', chapter)
+    assert store.done('chapters/000')
+    assert store.load('chapters/000', DetailChapter) == chapter
+    assert not (tmp_path / 'chapters' / '000.json.tmp').exists()
+
+
+def test_resume_only_redoes_the_failed_units(tmp_path):
+    def make(fail_chapters=()):
+        llm = FakeChatModel(latency=0, respond=fake_book_respond(3, fail_chapters=fail_chapters))
+        return BookPipeline(llm, work_dir=str(tmp_path), verbose=False), llm
+
+    pipeline, first_llm = make(fail_chapters=(1,))
+    with pytest.raises(PipelineError):
+        pipeline.run("a lighthouse")
+    assert list(pipeline.failed) == ['chapters/001']
+    assert not (tmp_path / 'chapters' / '001.json').exists()
+
+    pipeline, llm = make()
+    book = pipeline.run()
+    assert not pipeline.failed
+    # outline, characters and the two written chapters come from their checkpoints
+    assert dict(book['stats']) == {'resumed': 4, 'completed': 1}
+    assert (tmp_path / 'chapters' / '001.json').exists()
+    assert llm.calls['requests'] < first_llm.calls['requests']
+
+
+def test_prompts_carry_the_compact_schema(tmp_path):
+    prompts = []
+    respond = fake_book_respond(2)
+
+    def recording(text):
+        prompts.append(text)
+        return respond(text)
+
+    BookPipeline(FakeChatModel(latency=0, respond=recording), work_dir=str(tmp_path), verbose=False).run("a lighthouse")
+    chapter_prompts = [p for p in prompts if 'write stories for specific chapter' in p]
+    assert chapter_prompts
+    assert all(get_schema(DetailChapter, 'minified') in p for p in chapter_prompts)
+    assert not any(DetailChapter.schema_json() in p for p in prompts)
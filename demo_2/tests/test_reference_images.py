@@ -0,0 +1,41 @@
+import hashlib
+import os
+import threading
+import time
+from bench.fakes import FakeS3Client
+from story_agents.reference_images import ReferenceImageStore
+
+
+class _SlowS3(FakeS3Client):
+    def put_object(self, **kwargs):
+        time.sleep(0.05)
+        return super().put_object(**kwargs)
+
+
+def test_digest_is_looked_up_not_recomputed(tmp_path):
+    path = tmp_path / 'Liam.png'
+    path.write_bytes(b'portrait')
+    store = ReferenceImageStore()
+    reference = store.get_reference(str(path))
+    assert store.get_digest(reference) == hashlib.sha256(b'portrait').hexdigest()
+    assert store.get_digest('not from the store') is None
+    path.write_bytes(b'new portrait')
+    os.utime(path, ns=(time.time_ns() + 10**9,) * 2)
+    assert store.get_digest(store.get_reference(str(path))) == hashlib.sha256(b'new portrait').hexdigest()
+    assert store.get_digest(reference) is None
+
+
+def test_concurrent_s3_references_upload_once(tmp_path):
+    path = tmp_path / 'Liam.png'
+    path.write_bytes(b'portrait')
+    s3 = _SlowS3()
+    store = ReferenceImageStore(s3_prefix='s3://bucket/refs', s3_client=s3)
+    uris = []
+    threads = [threading.Thread(target=lambda: uris.append(store.get_reference(str(path)))) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert s3.calls['put_object'] == 1
+    assert set(uris) == {f"s3://bucket/refs/{hashlib.sha256(b'portrait').hexdigest()}.png"}
+    assert store.get_digest(uris[0]) == hashlib.sha256(b'portrait').hexdigest()
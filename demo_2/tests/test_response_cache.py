@@ -0,0 +1,40 @@
+import asyncio
+import pytest
+from langchain_core.outputs import Generation
+from bench.fakes import FakeBedrockChatModel
+from story_agents.graph_runner import ModelRateLimiter, rate_limited
+from story_agents.response_cache import CacheMissError, SQLiteResponseCache, cached_llm
+
+
+def test_replay_only_raises_on_a_miss_and_writes_nothing(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    SQLiteResponseCache(path).update('prompt', 'llm', [Generation(text='recorded')])
+    replay = SQLiteResponseCache(path, replay_only=True)
+    assert replay.lookup('prompt', 'llm')[0].text == 'recorded'
+    with pytest.raises(CacheMissError):
+        replay.lookup('other prompt', 'llm')
+    replay.update('other prompt', 'llm', [Generation(text='new')])
+    assert replay.stats()['entries'] == 1
+
+
+def test_eviction_and_ttl(tmp_path):
+    cache = SQLiteResponseCache(str(tmp_path / 'cache.sqlite'), max_entries=2)
+    for i in range(3):
+        cache.update(f'p{i}', 'llm', [Generation(text=str(i))])
+    assert cache.stats()['entries'] == 2
+    assert cache.lookup('p0', 'llm') is None
+    expired = SQLiteResponseCache(str(tmp_path / 'cache.sqlite'), ttl_seconds=-1)
+    assert expired.lookup('p2', 'llm') is None
+    assert expired.stats()['entries'] == 1
+
+
+def test_cache_hits_do_not_take_rate_limit_budget(tmp_path):
+    chat = FakeBedrockChatModel(latency=0, respond=lambda text: 'answer to ' + text, cache=False)
+    limiter = ModelRateLimiter('cached', requests_per_minute=60000, tokens_per_minute=10**9)
+    llm = cached_llm(rate_limited(chat, limiter=limiter), chat, SQLiteResponseCache(str(tmp_path / 'cache.sqlite')))
+    first = llm.invoke('hello')
+    assert llm.invoke('hello').content == first.content
+    assert asyncio.run(llm.ainvoke('hello')).content == first.content
+    assert chat.calls == 1 and limiter.stats['calls'] == 1
+    llm.invoke('hello', stop=['x'])
+    assert chat.calls == 2 and limiter.stats['calls'] == 2
@@ -0,0 +1,59 @@
+import asyncio
+from json import JSONDecodeError
+import pytest
+from langchain_core.messages import HumanMessage
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from bench.fakes import FakeChatModel
+from story_agents.llm_utils import CustJsonOuputParser, TextOuputParser
+from story_agents.retry import PARSE, RetryError, RetryPolicy, aretry_invoke, classify_exception, reset_retry_stats, retry_stats
+
+
+def _answers(*texts):
+    # respond with texts in turn, the last one from then on
+    calls = []
+
+    def respond(prompt):
+        calls.append(prompt)
+        return texts[min(len(calls), len(texts)) - 1]
+    respond.calls = calls
+    return respond
+
+
+def test_missing_answer_block_is_a_parse_error():
+    with pytest.raises(Exception) as info:
+        TextOuputParser(verbose=False).parse("no tags")
+    assert classify_exception(info.value) == PARSE
+
+
+def test_missing_answer_block_is_regenerated():
+    respond = _answers("Sure, here it is: Mia waves.", "<answer>Mia waves.</answer>")
+    chain = ChatPromptTemplate.from_messages([("user", "{task}")]) | FakeChatModel(latency=0, respond=respond) | TextOuputParser(verbose=False)
+    reset_retry_stats()
+    assert asyncio.run(aretry_invoke(chain, {"task": "write"}, RetryPolicy(max_attempts=3))) == "Mia waves."
+    stats = retry_stats()
+    assert stats['parse_errors'] == 1 and stats['regenerations'] == 1 and len(respond.calls) == 2
+
+
+def test_text_followup_asks_for_answer_tags():
+    respond = _answers("Mia waves.", "<answer>Mia waves.</answer>")
+    prompt = ChatPromptTemplate.from_messages([MessagesPlaceholder(variable_name="messages")])
+    chain = prompt | FakeChatModel(latency=0, respond=respond) | TextOuputParser(verbose=False)
+    reset_retry_stats()
+    result = asyncio.run(aretry_invoke(chain, {"messages": [HumanMessage(content="write")]}, RetryPolicy(max_attempts=3)))
+    assert result == "Mia waves."
+    assert retry_stats()['followups'] == 1 and '<answer></answer>' in respond.calls[-1]
+
+
+def test_malformed_json_is_repaired_without_a_call():
+    respond = _answers('```json\n{"content": "a "quoted" word",}\n```')
+    chain = ChatPromptTemplate.from_messages([("user", "{task}")]) | FakeChatModel(latency=0, respond=respond) | CustJsonOuputParser(verbose=False)
+    reset_retry_stats()
+    assert asyncio.run(aretry_invoke(chain, {"task": "write"})) == {"content": 'a "quoted" word'}
+    assert retry_stats()['repaired'] == 1 and len(respond.calls) == 1
+
+
+def test_gives_up_after_max_attempts():
+    chain = ChatPromptTemplate.from_messages([("user", "{task}")]) | FakeChatModel(latency=0, respond=_answers("nothing")) | TextOuputParser(verbose=False)
+    with pytest.raises(RetryError) as info:
+        asyncio.run(aretry_invoke(chain, {"task": "write"}, RetryPolicy(max_attempts=2)))
+    assert isinstance(info.value.__cause__, JSONDecodeError)
@@ -0,0 +1,47 @@
+import asyncio
+import pytest
+from story_agents.stage_queue import Stage, StagePipeline
+
+
+def test_failures_are_kept_per_stage_and_key():
+    async def double(key, value):
+        if key == 2:
+            raise ValueError('bad item')
+        return value * 2
+
+    async def skip_odd(key, value):
+        return None if key % 2 else value + 1
+
+    pipeline = StagePipeline([Stage('double', double, workers=2), Stage('skip_odd', skip_odd)])
+    results = asyncio.run(pipeline.arun((i, i) for i in range(6)))
+    assert results == {0: 1, 4: 9}
+    assert list(pipeline.errors) == [('double', 2)]
+    assert pipeline.stats['double']['failed'] == 1 and pipeline.stats['skip_odd']['dropped'] == 3
+
+
+def test_a_failing_item_source_is_raised():
+    async def source():
+        yield 0, 0
+        raise RuntimeError('source broke')
+
+    async def identity(key, value):
+        return value
+
+    async def _run():
+        return await StagePipeline([Stage('identity', identity)]).arun(source())
+    with pytest.raises(RuntimeError, match='source broke'):
+        asyncio.run(_run())
+
+
+def test_backpressure_bounds_the_queues():
+    async def fast(key, value):
+        return value
+
+    async def slow(key, value):
+        await asyncio.sleep(0.005)
+        return value
+
+    pipeline = StagePipeline([Stage('fast', fast, workers=4), Stage('slow', slow, maxsize=3)])
+    results = asyncio.run(pipeline.arun((i, i) for i in range(40)))
+    assert len(results) == 40
+    assert pipeline.stats['slow']['peak_queue'] <= 3
@@ -0,0 +1,53 @@
+import asyncio
+import json
+import os
+from bench.fakes import FakeAsyncEndpoint, FakeS3Client, fake_storyd_book_response
+from story_agents.async_waiter import BackoffWaiter
+from story_agents.image_cache import ImageCache
+from story_agents.image_utils import StoryDiffusionGenerator
+from story_agents.storyd_pipeline import agenerate_chapter_images, chapter_dir, load_chapter_images
+
+
+def _generator(cache=None):
+    s3 = FakeS3Client()
+    endpoint = FakeAsyncEndpoint(s3, latency=0.01, response_factory=fake_storyd_book_response)
+    return StoryDiffusionGenerator("fake-endpoint", cache=cache, waiter=BackoffWaiter(s3, initial_delay=0.01, max_delay=0.02),
+                                   predictor_async=endpoint, s3_client=s3)
+
+
+def _prompts(n):
+    return [{'general_prompt': "[Liam] a boy img", 'prompt_array': [f"[Liam] sails {i}", "[NC] the sea"],
+             'id_length': 1, 'ref_imgs': []} for i in range(n)]
+
+
+def test_panels_are_streamed_to_disk_not_re_encoded(tmp_path):
+    output_dir = str(tmp_path)
+
+    async def _run():
+        return [item async for item in agenerate_chapter_images(_generator(), _prompts(2), output_dir=output_dir)]
+    results = dict(asyncio.run(_run()))
+    assert sorted(results) == [0, 1]
+    for index in (0, 1):
+        with open(os.path.join(chapter_dir(output_dir, index), "manifest.json")) as f:
+            fnames = json.load(f)["images"]
+        assert fnames == [img.filename for img in results[index]]
+        assert all(os.path.dirname(f) == chapter_dir(output_dir, index) for f in fnames)
+        # the files write_base64_images streamed, save_chapter_images would have named them 0.png, 1.png...
+        assert all('_' in os.path.basename(f) for f in fnames)
+        assert [img.size for img in load_chapter_images(output_dir, index)] == [img.size for img in results[index]]
+
+
+def test_cache_hits_sharing_an_output_dir_keep_their_own_files(tmp_path):
+    generator = _generator(ImageCache(str(tmp_path / "cache")))
+    output_dir = str(tmp_path / "out")
+
+    def _render(prompt):
+        return asyncio.run(generator.agenerate_images(general_prompt="[Liam] a boy img", prompt_array=prompt,
+                                                      id_length=1, ref_imgs=[], output_dir=output_dir))
+    first, second = _render("[Liam] sails"), _render("[Liam] swims")
+    first_hit, second_hit = _render("[Liam] sails"), _render("[Liam] swims")
+    assert generator.cache.hits == 2
+    hit_files = [img.filename for img in first_hit + second_hit]
+    assert len(set(hit_files)) == len(hit_files)
+    for fresh, hit in zip(first + second, first_hit + second_hit):
+        assert fresh.tobytes() == hit.tobytes()
@@ -0,0 +1,69 @@
+import asyncio
+import contextvars
+import threading
+from langchain_core.messages import AIMessageChunk
+from bench.fakes import FakeChatModel
+from story_agents.telemetry import Tracer, set_tracer, span, traced_llm
+
+
+def test_stop_reaches_the_model():
+    llm = traced_llm(FakeChatModel(latency=0, respond=lambda t: "<answer>hi</answer> more"))
+    assert llm.invoke("x", stop=["</answer>"]).content == "<answer>hi"
+    assert asyncio.run(llm.ainvoke("x", stop=["</answer>"])).content == "<answer>hi"
+
+
+def test_astream_keeps_chunks_in_one_span():
+    tracer = Tracer()
+    previous = set_tracer(tracer)
+    try:
+        llm = traced_llm(FakeChatModel(latency=0, respond=lambda t: "a" * 100, stream_chunk_chars=10))
+
+        async def _chunks():
+            with span('node'):
+                return [chunk async for chunk in llm.astream("x")]
+        chunks = asyncio.run(_chunks())
+    finally:
+        set_tracer(previous)
+    assert len(chunks) == 10 and all(isinstance(c, AIMessageChunk) for c in chunks)
+    stages = tracer.summary()['stages']
+    assert stages['llm']['count'] == 1
+    # no usage in the chunks, estimated from the streamed text and rolled up into the node
+    assert stages['llm']['output_tokens'] == 26
+    assert stages['node']['output_tokens'] == 26
+
+
+def test_closed_stream_still_ends_its_span():
+    tracer = Tracer()
+    previous = set_tracer(tracer)
+    try:
+        llm = traced_llm(FakeChatModel(latency=0, respond=lambda t: "a" * 100, stream_chunk_chars=10))
+        stream = llm.stream("x")
+        next(stream)
+        stream.close()
+    finally:
+        set_tracer(previous)
+    assert tracer.summary()['stages']['llm']['count'] == 1
+
+
+def test_concurrent_adds_and_rollup_are_not_lost():
+    tracer = Tracer()
+    previous = set_tracer(tracer)
+    try:
+        with span('book') as book:
+            def work():
+                for _ in range(2000):
+                    book.add('bytes', 1)
+                    with span('chunk') as chunk:
+                        chunk.add('input_tokens', 2)
+
+            # like asyncio.to_thread, each thread runs in a copy of the context and sees book as its parent
+            threads = [threading.Thread(target=contextvars.copy_context().run, args=(work,)) for _ in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+    finally:
+        set_tracer(previous)
+    stages = tracer.summary()['stages']
+    assert stages['book']['bytes'] == 8 * 2000
+    assert stages['book']['input_tokens'] == 8 * 2000 * 2